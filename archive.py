@@ -0,0 +1,176 @@
+import os
+import sqlite3
+from datetime import datetime, timedelta
+
+from repository import now
+
+
+# Сколько дней взносы и возвращённые долги остаются в рабочих таблицах
+ARCHIVE_HORIZON_DAYS = int(os.environ.get('ARCHIVE_HORIZON_DAYS', 365))
+# Строк за одну транзакцию: между пачками бот успевает писать
+ARCHIVE_BATCH = 5000
+# Страниц, освобождаемых за один шаг incremental_vacuum
+VACUUM_PAGES = 2000
+# PRAGMA auto_vacuum: 0 — выключен, 1 — полный, 2 — инкрементальный
+AUTO_VACUUM_INCREMENTAL = 2
+# Доля пустого места в страницах индексов таблицы, с которой её REINDEX окупается
+REINDEX_SPARSE = float(os.environ.get('ARCHIVE_REINDEX_SPARSE', 0.3))
+
+# Пачка — строки до :last включительно, где :last — id последней из
+# первых :limit подходящих строк. Перенос и удаление идут одной
+# транзакцией с одним и тем же условием, поэтому строка не теряется и не
+# попадает в обе таблицы
+LAST_DEBT = '''
+SELECT MAX(debt_id) FROM (
+    SELECT debt_id FROM debts
+    WHERE status = 'returned' AND creation_date < :before
+    ORDER BY debt_id
+    LIMIT :limit
+)
+'''
+ARCHIVE_DEBTS = '''
+INSERT INTO debts_archive (debt_id, user_id, username, amount, due_date, status, creation_date, archived_at)
+SELECT debt_id, user_id, username, amount, due_date, status, creation_date, :archived_at FROM debts
+WHERE status = 'returned' AND creation_date < :before AND debt_id <= :last
+'''
+DELETE_DEBTS = "DELETE FROM debts WHERE status = 'returned' AND creation_date < :before AND debt_id <= :last"
+
+LAST_CONTRIBUTION = '''
+SELECT MAX(contribution_id) FROM (
+    SELECT contribution_id FROM contributions
+    WHERE contribution_date < :before
+    ORDER BY contribution_id
+    LIMIT :limit
+)
+'''
+ARCHIVE_CONTRIBUTIONS = '''
+INSERT INTO contributions_archive (contribution_id, user_id, username, amount, month_year, contribution_date,
+                                   archived_at)
+SELECT contribution_id, user_id, username, amount, month_year, contribution_date, :archived_at FROM contributions
+WHERE contribution_date < :before AND contribution_id <= :last
+'''
+DELETE_CONTRIBUTIONS = 'DELETE FROM contributions WHERE contribution_date < :before AND contribution_id <= :last'
+
+SET_ARCHIVING = 'INSERT INTO archive_in_progress (id) VALUES (1)'
+CLEAR_ARCHIVING = 'DELETE FROM archive_in_progress'
+
+SELECT_INDEX_USAGE = '''
+SELECT SUM(pgsize), SUM(unused) FROM dbstat
+WHERE name IN (SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = ?)
+'''
+SELECT_HOT_SIZE = '''
+SELECT SUM(pgsize) FROM dbstat
+WHERE name IN (SELECT name FROM sqlite_master WHERE tbl_name IN ('debts', 'contributions'))
+'''
+
+# Таблица -> (последний id пачки, перенос, удаление)
+ARCHIVES = {
+    'debts': (LAST_DEBT, ARCHIVE_DEBTS, DELETE_DEBTS),
+    'contributions': (LAST_CONTRIBUTION, ARCHIVE_CONTRIBUTIONS, DELETE_CONTRIBUTIONS),
+}
+
+
+def horizon(days=ARCHIVE_HORIZON_DAYS):
+    return (datetime.now() - timedelta(days=days)).strftime('%Y-%m-%d %H:%M:%S')
+
+
+# Переносит в архив строки старше before (формат now()) пачками по
+# batch; возвращает, сколько строк перенесено
+def archive_table(manager, table, before, batch=ARCHIVE_BATCH):
+    last_sql, archive_sql, delete_sql = ARCHIVES[table]
+    moved = 0
+    while True:
+        with manager.transaction() as conn:
+            params = {'before': before, 'limit': batch}
+            last = conn.execute(last_sql, params).fetchone()[0]
+            if last is None:
+                return moved
+            params.update(last=last, archived_at=now())
+            conn.execute(archive_sql, params)
+            # Месячные итоги считаются и по архиву: флаг не даёт триггеру
+            # вычесть перенесённые взносы из них
+            conn.execute(SET_ARCHIVING)
+            moved += conn.execute(delete_sql, params).rowcount
+            conn.execute(CLEAR_ARCHIVING)
+
+
+def archive(manager, before=None):
+    before = before or horizon()
+    return {table: archive_table(manager, table, before) for table in ARCHIVES}
+
+
+# Доля пустого места в страницах индексов таблицы (по dbstat; None, если
+# SQLite собран без него)
+def index_sparseness(manager, table):
+    try:
+        size, unused = manager.connection().execute(SELECT_INDEX_USAGE, (table,)).fetchone()
+    except sqlite3.OperationalError:
+        return None
+    return unused / size if size else 0.0
+
+
+# Индексы рабочих таблиц упорядочены по пользователю, поэтому перенос
+# старых строк оставляет в них полупустые страницы; REINDEX строит их
+# заново плотными, а освободившиеся страницы забирает incremental_vacuum.
+# REINDEX держит блокировку записи всё время перестройки — только в окно
+# обслуживания и только для таблиц, где пустого места не меньше threshold
+# (без dbstat — для каждой). Возвращает таблицы, которые перестроены
+def reindex(manager, tables=tuple(ARCHIVES), threshold=REINDEX_SPARSE):
+    rebuilt = []
+    for table in tables:
+        sparseness = index_sparseness(manager, table)
+        if sparseness is not None and sparseness < threshold:
+            continue
+        with manager.transaction() as conn:
+            conn.execute(f'REINDEX {table}')
+        rebuilt.append(table)
+    return rebuilt
+
+
+def is_incremental(manager):
+    return manager.connection().execute('PRAGMA auto_vacuum').fetchone()[0] == AUTO_VACUUM_INCREMENTAL
+
+
+# Старая база создана без auto_vacuum: режим меняется только полным
+# VACUUM, один раз. VACUUM переписывает весь файл и всё это время держит
+# базу, поэтому перевод — только по явной просьбе (archive --convert-vacuum).
+# Возвращает True, если перевод понадобился
+def enable_incremental_vacuum(manager):
+    if is_incremental(manager):
+        return False
+    conn = manager.connection()
+    conn.execute(f'PRAGMA auto_vacuum = {AUTO_VACUUM_INCREMENTAL}')
+    conn.execute('VACUUM')
+    return True
+
+
+# Возвращает свободные страницы файлу шагами по pages страниц; после
+# контрольной точки WAL файл становится меньше. Возвращает число страниц
+def incremental_vacuum(manager, pages=VACUUM_PAGES):
+    freed = 0
+    while True:
+        with manager.transaction() as conn:
+            free = conn.execute('PRAGMA freelist_count').fetchone()[0]
+            conn.execute(f'PRAGMA incremental_vacuum({pages})').fetchall()
+            step = free - conn.execute('PRAGMA freelist_count').fetchone()[0]
+        freed += step
+        if not step:
+            break
+    manager.connection().execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    return freed
+
+
+# Размер файла, свободные страницы и сколько байт занимают рабочие таблицы
+# с индексами (по dbstat; None, если SQLite собран без него)
+def space(manager):
+    conn = manager.connection()
+    try:
+        hot = conn.execute(SELECT_HOT_SIZE).fetchone()[0]
+    except sqlite3.OperationalError:
+        hot = None
+    return {
+        'file': os.path.getsize(manager.path),
+        'pages': conn.execute('PRAGMA page_count').fetchone()[0],
+        'free': conn.execute('PRAGMA freelist_count').fetchone()[0],
+        'hot': hot,
+    }
@@ -0,0 +1,2017 @@
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import random
+import re
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from itertools import zip_longest
+from urllib.request import Request, urlopen
+
+import db
+import migrations
+import repository
+from metrics import instrument, metrics
+from money import format_money
+
+
+def temp_db_path():
+    fd, path = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    return path
+
+
+def remove_db(path):
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+
+def seed_users(path, users):
+    conn = sqlite3.connect(path)
+    migrations.migrate(conn)
+    conn.executemany('INSERT INTO users (user_id, username) VALUES (?, ?)',
+                     ((i, f'user{i}') for i in range(users)))
+    conn.executemany('INSERT INTO savings (user_id, username) VALUES (?, ?)',
+                     ((i, f'user{i}') for i in range(users)))
+    conn.commit()
+    conn.close()
+
+
+# Одно «сообщение»: чтение баланса и взнос, как в my_balance и process_contribution
+def handle_message(get_conn, release, user_id):
+    conn = get_conn()
+    conn.execute('SELECT balance, monthly_contribution FROM savings WHERE user_id = ?', (user_id,)).fetchone()
+    release(conn)
+
+    conn = get_conn()
+    username = conn.execute('SELECT username FROM users WHERE user_id = ?', (user_id,)).fetchone()[0]
+    conn.execute('BEGIN')
+    conn.execute('''
+    INSERT INTO contributions (user_id, username, amount, month_year, contribution_date)
+    VALUES (?, ?, ?, ?, ?)
+    ''', (user_id, username, 10000, '07.2023', datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+    conn.execute('UPDATE savings SET balance = balance + ? WHERE user_id = ?', (10000, user_id))
+    conn.execute('COMMIT')
+    release(conn)
+
+    conn = get_conn()
+    conn.execute('SELECT balance FROM savings WHERE user_id = ?', (user_id,)).fetchone()
+    release(conn)
+
+
+def run_messages(get_conn, release, messages, users):
+    started = time.perf_counter()
+    for i in range(messages):
+        handle_message(get_conn, release, i % users)
+    return messages / (time.perf_counter() - started)
+
+
+def bench_pool(args):
+    path = temp_db_path()
+    try:
+        seed_users(path, args.users)
+
+        connect = lambda: sqlite3.connect(path, check_same_thread=False)
+        per_call = run_messages(connect, lambda conn: conn.close(), args.messages, args.users)
+
+        manager = db.ConnectionManager(path)
+        pooled = run_messages(manager.connection, lambda conn: None, args.messages, args.users)
+        manager.close_all()
+    finally:
+        remove_db(path)
+
+    print(f"sqlite3.connect на каждый вызов: {per_call:10.0f} сообщений/с")
+    print(f"ConnectionManager:               {pooled:10.0f} сообщений/с")
+    print(f"Ускорение: x{pooled / per_call:.2f}")
+
+
+def time_query(conn, sql, params_list):
+    started = time.perf_counter()
+    for params in params_list:
+        conn.execute(sql, params).fetchall()
+    return (time.perf_counter() - started) / len(params_list) * 1e6
+
+
+# «Мои взносы» по рабочей таблице: замер «до» идёт на схеме версии 1, а
+# contributions_history из репозитория появляется только с архивом
+RECENT_CONTRIBUTIONS = '''
+SELECT amount, month_year, contribution_date FROM contributions
+WHERE user_id = ?
+ORDER BY contribution_date DESC
+LIMIT ?
+'''
+
+
+def measure_lookups(conn, users, queries):
+    user_ids = [(i * 7919) % users for i in range(queries)]
+    return {
+        'my_contributions': time_query(conn, RECENT_CONTRIBUTIONS,
+                                       [(u, 10) for u in user_ids]),
+        'my_debts': time_query(conn, repository.SELECT_ACTIVE_DEBTS,
+                               [(u,) for u in user_ids]),
+        'process_return': time_query(conn, repository.SELECT_ACTIVE_DEBT_BY_DATE,
+                                     [(u, '07-15') for u in user_ids]),
+    }
+
+
+def bench_indexes(args):
+    path = temp_db_path()
+    try:
+        conn = sqlite3.connect(path, isolation_level=None)
+        migrations.migrate(conn, target=1)
+
+        started = time.perf_counter()
+        conn.execute('BEGIN')
+        conn.executemany(repository.INSERT_CONTRIBUTION, (
+            (i % args.users, f'user{i % args.users}', 100.0, f'{i % 12 + 1:02d}.2023',
+             f'2023-{i % 12 + 1:02d}-{i % 28 + 1:02d} 12:00:00')
+            for i in range(args.contributions)
+        ))
+        conn.executemany(repository.INSERT_DEBT, (
+            (i % args.users, f'user{i % args.users}', 500.0, f'{i % 28 + 1:02d}.07', '2023-06-01 12:00:00')
+            for i in range(args.debts)
+        ))
+        conn.execute('COMMIT')
+        print(f"Засеяно {args.contributions} взносов и {args.debts} долгов за {time.perf_counter() - started:.1f} с")
+
+        before = measure_lookups(conn, args.users, args.queries)
+        started = time.perf_counter()
+        migrations.migrate(conn)
+        print(f"Миграция до версии {migrations.get_version(conn)} за {time.perf_counter() - started:.1f} с")
+        after = measure_lookups(conn, args.users, args.queries)
+        conn.close()
+    finally:
+        remove_db(path)
+
+    print(f"{'запрос':<20}{'до, мкс':>12}{'после, мкс':>14}")
+    for name in before:
+        print(f"{name:<20}{before[name]:>12.1f}{after[name]:>14.1f}")
+
+
+LOAD_MIX = (
+    '👀 Мой баланс',
+    '💰 Общий баланс',
+    'вношу 100 за 07.2023',
+    '💸 Мои взносы',
+    'беру 10 до 15.07',
+    '🔔 Мои долги',
+)
+
+
+# Ответы склеиваются в очереди отправки, поэтому обработанные обновления
+# считаются по доставленным текстам, а не по числу sendMessage
+def wait_delivered(outbox, count, timeout):
+    deadline = time.monotonic() + timeout
+    while outbox.delivered < count:
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.005)
+    return True
+
+
+async def drive_application(application, count, timeout):
+    outbox = application.bot_data['outbox']
+    async with application:
+        await application.start()
+        await application.updater.start_polling(poll_interval=0.0, timeout=0)
+        started = time.perf_counter()
+        done = await asyncio.to_thread(wait_delivered, outbox, count, timeout)
+        elapsed = time.perf_counter() - started
+        await application.updater.stop()
+        await application.stop()
+        await application.post_stop(application)
+    if not done:
+        raise RuntimeError(f"Обработано только {outbox.delivered} из {count} обновлений за {timeout} с")
+    return count / elapsed
+
+
+def run_load(updates, users, concurrent, latency):
+    import main as bot
+    from fake_bot_api import FakeBotAPI
+
+    path = temp_db_path()
+    db.manager = db.ConnectionManager(path)
+    bot.repo = repository.SavingsRepository()
+    fake = FakeBotAPI(latency=latency).start()
+    try:
+        seed_load_users(bot, users)
+        fake.add_updates(load_updates(None, updates, users))
+        concurrent_updates = bot.CONCURRENT_UPDATES if concurrent else False
+        # Лимиты Telegram и защита от флуда здесь не проверяются: меряется обработка обновлений
+        application = bot.build_application('123:fake', concurrent_updates=concurrent_updates,
+                                            base_url=fake.base_url, reminders=False, send_rate=0, chat_rate=0,
+                                            throttling=False)
+        return asyncio.run(drive_application(application, updates, timeout=60))
+    finally:
+        fake.stop()
+        db.manager.close_all()
+        remove_db(path)
+
+
+def load_updates(path, updates, users):
+    from fake_bot_api import make_update
+
+    if path:
+        # Записанные обновления: по одному JSON-объекту Update на строку
+        with open(path, encoding='utf-8') as f:
+            return [json.loads(line) for line in f if line.strip()]
+    return [make_update(i + 1, i % users + 1, LOAD_MIX[i % len(LOAD_MIX)]) for i in range(updates)]
+
+
+def seed_load_users(bot, users):
+    bot.init_db()
+    for user_id in range(1, users + 1):
+        bot.repo.add_user(user_id, f'user{user_id}', 'Тест', None)
+        bot.repo.add_contribution(user_id, 100000, '06.2023')
+
+
+def post_json(url, data, headers=None):
+    body = json.dumps(data).encode()
+    request = Request(url, data=body, headers={'Content-Type': 'application/json', **(headers or {})})
+    with urlopen(request) as response:
+        return response.status
+
+
+def bench_webhook(args):
+    from werkzeug.serving import make_server
+
+    import main as bot
+    import webhook
+    from fake_bot_api import FakeBotAPI
+
+    path = temp_db_path()
+    db.manager = db.ConnectionManager(path)
+    bot.repo = repository.SavingsRepository()
+    fake = FakeBotAPI(latency=args.latency).start()
+    flask_app = webhook.create_app(
+        lambda: bot.build_application('123:fake', base_url=fake.base_url, reminders=False,
+                                      send_rate=0, chat_rate=0, throttling=False)
+    )
+    server = make_server('127.0.0.1', 0, flask_app, threaded=True)
+    server_thread = ThreadPoolExecutor(max_workers=1)
+    server_thread.submit(server.serve_forever)
+    try:
+        seed_load_users(bot, args.users)
+        updates = load_updates(args.updates_file, args.updates, args.users)
+        url = f'http://127.0.0.1:{server.server_port}{webhook.WEBHOOK_PATH}'
+        headers = {'X-Telegram-Bot-Api-Secret-Token': webhook.WEBHOOK_SECRET} if webhook.WEBHOOK_SECRET else {}
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.clients) as clients:
+            statuses = list(clients.map(lambda update: post_json(url, update, headers), updates))
+        accepted = time.perf_counter() - started
+        outbox = flask_app.extensions['bot_runner']['runner'].application.bot_data['outbox']
+        if not wait_delivered(outbox, len(updates), timeout=60):
+            raise RuntimeError(f"Обработано только {outbox.delivered} из {len(updates)} обновлений")
+        processed = time.perf_counter() - started
+    finally:
+        runner = flask_app.extensions['bot_runner']['runner']
+        if runner is not None:
+            runner.stop()
+        server.shutdown()
+        server_thread.shutdown()
+        fake.stop()
+        db.manager.close_all()
+        remove_db(path)
+
+    print(f"Принято webhook:   {len(updates) / accepted:8.0f} обновлений/с (HTTP {sorted(set(statuses))})")
+    print(f"Обработано ботом:  {len(updates) / processed:8.0f} обновлений/с")
+
+
+# Прежняя схема: 14 обработчиков с регулярными выражениями по очереди,
+# затем цепочка if/elif в handle_text с повторными вызовами is_admin
+LEGACY_BUTTON_PATTERNS = [re.compile(p) for p in (
+    '^👀 Мой баланс$', '^💰 Общий баланс$', '^🎯 Внести в копилку$', '^💸 Мои взносы$',
+    '^🍪 Взять в долг$', '^💪 Вернуть долг$', '^🔔 Мои долги$', '^🔐 Админка$',
+    '^👥 Список пользователей$', '^📊 Изменить баланс$', '^📝 Изменить взнос$',
+    '^📋 Список долгов$', '^✏️ Редактировать долг$', '^🔙 Назад$',
+)]
+
+
+def legacy_resolve(message, user_id, is_admin):
+    for index, pattern in enumerate(LEGACY_BUTTON_PATTERNS):
+        if pattern.search(message):
+            return index
+    text = message.lower()
+    if is_admin(user_id):
+        if text.startswith(('закрыть ', 'долг ', 'дата ')):
+            return 'debt_edit'
+    if is_admin(user_id):
+        if text.startswith('баланс'):
+            return 'balance_change'
+    if is_admin(user_id):
+        if text.startswith('взнос'):
+            return 'contribution_change'
+    if text.startswith('беру') and 'до' in text:
+        return 'borrow'
+    elif text.startswith('возвращаю') and 'за' in text:
+        return 'return'
+    elif text.startswith('вношу') or text.startswith('установить взнос'):
+        return 'contribution'
+    elif is_admin(user_id):
+        if text in ('👥 список пользователей', '📊 изменить баланс', '📝 изменить взнос',
+                    '📋 список долгов', '✏️ редактировать долг', '🔙 назад'):
+            return text
+    return None
+
+
+ROUTER_MIX = (
+    '👀 Мой баланс', '💰 Общий баланс', '🔙 Назад', 'вношу 3000 за 07.2023',
+    'беру 500 до 15.07', 'возвращаю 500 за 15.07', 'установить взнос 3000',
+    'баланс 123456789 5000', 'дата 1 30.12', 'привет',
+)
+
+
+def bench_router(args):
+    import main as bot
+
+    admin_id = min(bot.ADMINS)
+    messages = [(ROUTER_MIX[i % len(ROUTER_MIX)], admin_id if i % 2 else admin_id + 1)
+                for i in range(args.messages)]
+
+    started = time.perf_counter()
+    for message, user_id in messages:
+        legacy_resolve(message, user_id, bot.is_admin)
+    legacy = (time.perf_counter() - started) / len(messages) * 1e9
+
+    started = time.perf_counter()
+    for message, user_id in messages:
+        bot.router.resolve(message, user_id)
+    routed = (time.perf_counter() - started) / len(messages) * 1e9
+
+    print(f"Регулярки + if/elif: {legacy:8.0f} нс/сообщение")
+    print(f"Router:              {routed:8.0f} нс/сообщение")
+    print(f"Ускорение: x{legacy / routed:.2f}")
+
+
+PARSER_SAMPLES = (
+    'вношу 3000 за 07.2023', 'установить взнос 3000', 'беру 500 до 15.07',
+    'возвращаю 500 за 15.07', 'баланс 123456789 5000', 'взнос 123456789 3000',
+    'закрыть 1', 'долг 1 1500', 'дата 1 30.12', '/balance 1 -20.5',
+)
+
+
+# Прежний разбор из обработчиков: split, index, float и map(int, ...)
+def legacy_parse(text):
+    parts = text.lower().split()
+    if parts[0] in ('вношу', 'возвращаю'):
+        amount = float(parts[1])
+        date = parts[parts.index('за') + 1]
+        return amount, tuple(map(int, date.split('.')))
+    if parts[0] == 'беру':
+        amount = float(parts[1])
+        date = parts[parts.index('до') + 1]
+        return amount, tuple(map(int, date.split('.')))
+    if parts[0] == 'установить':
+        return float(parts[2])
+    if parts[0] in ('баланс', 'взнос', '/balance'):
+        return int(parts[1]), float(parts[2])
+    if parts[0] == 'дата':
+        return int(parts[1]), tuple(map(int, parts[2].split('.')))
+    return int(parts[1]), parts[2:] and float(parts[2])
+
+
+def bench_parser(args):
+    from commands import parse
+
+    messages = [PARSER_SAMPLES[i % len(PARSER_SAMPLES)] for i in range(args.messages)]
+    started = time.perf_counter()
+    for text in messages:
+        legacy_parse(text)
+    legacy = len(messages) / (time.perf_counter() - started)
+
+    started = time.perf_counter()
+    for text in messages:
+        parse(text)
+    structured = len(messages) / (time.perf_counter() - started)
+
+    print(f"Прежний разбор:  {legacy:10.0f} сообщений/с")
+    print(f"commands.parse:  {structured:10.0f} сообщений/с")
+
+
+def bench_money(args):
+    from decimal import Decimal
+
+    from money import parse_money
+
+    rng = random.Random(args.seed)
+    texts = [f'{rng.randint(1, 100000)}.{rng.randint(0, 99):02d}' for _ in range(args.amounts)]
+    kopecks = [parse_money(text) for text in texts]
+    decimals = [Decimal(text) for text in texts]
+    floats = [float(text) for text in texts]
+
+    def measure(func, values):
+        started = time.perf_counter()
+        result = func(values)
+        return result, time.perf_counter() - started
+
+    total_int, int_sum = measure(sum, kopecks)
+    total_decimal, decimal_sum = measure(sum, decimals)
+    total_float, float_sum = measure(sum, floats)
+    _, int_format = measure(lambda values: [format_money(v) for v in values], kopecks)
+    _, decimal_format = measure(lambda values: [f'{v:.2f}' for v in values], decimals)
+    _, int_parse = measure(lambda values: [parse_money(v) for v in values], texts)
+    _, decimal_parse = measure(lambda values: [Decimal(v) for v in values], texts)
+
+    print(f"{'операция':<12}{'копейки, мс':>14}{'Decimal, мс':>14}")
+    for name, int_time, decimal_time in (('сумма', int_sum, decimal_sum),
+                                         ('вывод', int_format, decimal_format),
+                                         ('разбор', int_parse, decimal_parse)):
+        print(f"{name:<12}{int_time * 1000:>14.1f}{decimal_time * 1000:>14.1f}")
+    print(f"Итог в копейках: {format_money(total_int)}, Decimal: {total_decimal}, float: {total_float!r}")
+    assert format_money(total_int) == f'{total_decimal:.2f}'
+
+    # SUM по INTEGER-колонке в SQLite против суммы Decimal по строкам
+    path = temp_db_path()
+    try:
+        conn = sqlite3.connect(path, isolation_level=None)
+        conn.execute('CREATE TABLE amounts (kopecks INTEGER, text TEXT)')
+        conn.execute('BEGIN')
+        conn.executemany('INSERT INTO amounts VALUES (?, ?)', zip(kopecks, texts))
+        conn.execute('COMMIT')
+        started = time.perf_counter()
+        sql_total = conn.execute('SELECT SUM(kopecks) FROM amounts').fetchone()[0]
+        sql_time = time.perf_counter() - started
+        started = time.perf_counter()
+        decimal_total = sum(Decimal(text) for (text,) in conn.execute('SELECT text FROM amounts'))
+        decimal_time = time.perf_counter() - started
+        conn.close()
+    finally:
+        remove_db(path)
+    assert format_money(sql_total) == f'{decimal_total:.2f}'
+    print(f"SUM в SQLite: {sql_time * 1000:.1f} мс, Decimal по строкам: {decimal_time * 1000:.1f} мс")
+
+    # Накопление ошибки: много взносов по 0.10 на балансе REAL
+    balance_float, balance_int = 0.0, 0
+    for _ in range(args.amounts):
+        balance_float += 0.1
+        balance_int += 10
+    print(f"{args.amounts} × 0.10: float {balance_float!r}, копейки {format_money(balance_int)}")
+
+
+# Прежний list_users: все пользователи одним fetchall, баланс отдельным
+# запросом на новом соединении и одна строка, собранная через +=
+def legacy_list_users(path):
+    conn = sqlite3.connect(path)
+    users = conn.execute('SELECT user_id, username, first_name, last_name, join_date FROM users').fetchall()
+    conn.close()
+    message = "👥 Список пользователей:\n\n"
+    for user_id, username, first_name, last_name, join_date in users:
+        conn = sqlite3.connect(path)
+        balance = conn.execute('SELECT balance FROM savings WHERE user_id = ?', (user_id,)).fetchone()[0]
+        conn.close()
+        message += (
+            f"ID: {user_id}\n"
+            f"Имя: {first_name} {last_name}\n"
+            f"Юзернейм: @{username}\n"
+            f"Баланс: {format_money(balance)}\n"
+            f"Дата регистрации: {join_date}\n\n"
+        )
+    return message
+
+
+def bench_listing(args):
+    import main as bot
+
+    path = temp_db_path()
+    try:
+        seed_users(path, args.users)
+        db.manager = db.ConnectionManager(path)
+        repo = repository.SavingsRepository()
+        with db.manager.transaction() as conn:
+            conn.executemany(repository.INSERT_DEBT, (
+                (i % args.users, f'user{i % args.users}', 50000, '2024-07-15', repository.now())
+                for i in range(args.users)
+            ))
+            conn.execute("UPDATE debts SET status = 'returned' WHERE debt_id % 2 = 0")
+
+        started = time.perf_counter()
+        message = legacy_list_users(path)
+        legacy = time.perf_counter() - started
+        print(f"Прежний список: {legacy * 1000:.0f} мс, сообщение {len(message)} символов (лимит Telegram 4096)")
+
+        for name, fetch_page, format_page in (('пользователи', repo.users_page, bot.format_users_page),
+                                              ('долги', repo.active_debts_page, bot.format_debts_page)):
+            timings, pages, longest = [], 0, 0
+            cursor, has_next = None, True
+            while has_next:
+                started = time.perf_counter()
+                rows, _, has_next = fetch_page(cursor)
+                text = format_page(rows)
+                timings.append(time.perf_counter() - started)
+                pages += 1
+                longest = max(longest, len(text))
+                cursor = rows[-1][0]
+            first = timings[0]
+            timings.sort()
+            print(f"{name}: {pages} страниц, первая {first * 1e6:.0f} мкс, "
+                  f"медиана {timings[len(timings) // 2] * 1e6:.0f} мкс, худшая {timings[-1] * 1e6:.0f} мкс, "
+                  f"самая длинная {longest} символов")
+
+        # Для сравнения: последняя страница через OFFSET, который пробегает все предыдущие строки
+        conn = db.manager.connection()
+        started = time.perf_counter()
+        conn.execute('''
+        SELECT u.user_id, u.username, u.first_name, u.last_name, u.join_date, s.balance
+        FROM users u LEFT JOIN savings s ON s.user_id = u.user_id
+        ORDER BY u.user_id LIMIT ? OFFSET ?
+        ''', (repository.PAGE_SIZE, args.users - repository.PAGE_SIZE)).fetchall()
+        print(f"Последняя страница через OFFSET: {(time.perf_counter() - started) * 1e6:.0f} мкс")
+    finally:
+        db.manager.close_all()
+        remove_db(path)
+
+
+# Одно обращение пользователя: чаще чтение состояния, иногда взнос или долг
+def user_interaction(repo, rng, users):
+    # Активна небольшая часть участников: квадрат равномерного распределения
+    user_id = int(users * rng.random() ** 2)
+    roll = rng.random()
+    if roll < 0.1:
+        repo.add_contribution(user_id, 10000, '07.2023')
+    elif roll < 0.15:
+        try:
+            repo.borrow(user_id, 5000, '2024-07-15')
+        except repository.InsufficientFunds:
+            pass
+    else:
+        repo.get_savings(user_id)
+        repo.get_username(user_id)
+
+
+def run_interactions(cache_size, path, args):
+    db.manager = db.ConnectionManager(path)
+    repo = repository.SavingsRepository(user_cache_size=cache_size)
+    per_thread = args.operations // args.threads
+
+    def worker(seed):
+        rng = random.Random(seed)
+        for _ in range(per_thread):
+            user_interaction(repo, rng, args.users)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.threads) as pool:
+        list(pool.map(worker, range(args.threads)))
+    elapsed = time.perf_counter() - started
+
+    # Кэш должен совпадать с базой для каждого закэшированного пользователя
+    conn = db.manager.connection()
+    for user_id in range(args.users):
+        state = repo.user_cache.get(user_id)
+        if state is not None:
+            row = conn.execute(repository.SELECT_USER_STATE, (user_id,)).fetchone()
+            assert (state.username, state.balance, state.monthly_contribution) == row, (user_id, row)
+    db.manager.close_all()
+    return per_thread * args.threads / elapsed, repo.user_cache.stats()
+
+
+def bench_cache(args):
+    path = temp_db_path()
+    try:
+        seed_users(path, args.users)
+        uncached, _ = run_interactions(0, path, args)
+        cached, stats = run_interactions(args.cache_size, path, args)
+    finally:
+        remove_db(path)
+
+    print(f"Без кэша:         {uncached:10.0f} обращений/с")
+    print(f"LRU на {args.cache_size:>6}:    {cached:10.0f} обращений/с")
+    print(f"Попаданий {stats['hits']}, промахов {stats['misses']}, вытеснений {stats['evictions']}, "
+          f"доля попаданий {stats['hit_rate']:.1%}")
+
+
+# Прежний займ: проверка общего баланса и запись в разных транзакциях
+def legacy_borrow(manager, user_id, amount, due_date):
+    total = manager.connection().execute(repository.SELECT_TOTAL_BALANCE).fetchone()[0]
+    if amount > total:
+        return False
+    # Окно между проверкой и записью, в которое успевают соседние займы
+    time.sleep(0)
+    with manager.transaction() as conn:
+        conn.execute(repository.INSERT_DEBT, (user_id, None, amount, due_date, repository.now()))
+        conn.execute('UPDATE savings SET balance = balance - ? WHERE user_id = ?', (amount, user_id))
+    return True
+
+
+def seed_ledger(path, users, balance):
+    seed_users(path, users)
+    conn = sqlite3.connect(path, isolation_level=None)
+    conn.execute('UPDATE savings SET balance = ? WHERE user_id = 0', (balance,))
+    conn.execute(repository.INSERT_JOURNAL, (0, 'opening', balance, None, repository.now()))
+    conn.close()
+
+
+# Итог копилки и сумма активных долгов после стресса; инварианты проверяет
+# tests/test_ledger.py
+def ledger_totals(path):
+    conn = sqlite3.connect(path)
+    actual = conn.execute(repository.SELECT_SUM_BALANCE).fetchone()[0]
+    active = conn.execute("SELECT COALESCE(SUM(amount), 0) FROM debts WHERE status = 'active'").fetchone()[0]
+    conn.close()
+    return actual, active
+
+
+def bench_ledger(args):
+    path = temp_db_path()
+    try:
+        # Прежняя схема: считаем, на сколько разные потоки перебрали копилку
+        seed_ledger(path, args.users, args.pot)
+        manager = db.ConnectionManager(path)
+
+        def legacy_worker(seed):
+            rng = random.Random(seed)
+            return sum(5000 for _ in range(args.operations // args.threads)
+                       if legacy_borrow(manager, rng.randrange(args.users), 5000, '2024-07-15'))
+
+        with ThreadPoolExecutor(max_workers=args.threads) as pool:
+            borrowed = sum(pool.map(legacy_worker, range(args.threads)))
+        total = manager.connection().execute(repository.SELECT_TOTAL_BALANCE).fetchone()[0]
+        manager.close_all()
+        print(f"Прежний займ: выдано {format_money(borrowed)} из {format_money(args.pot)}, "
+              f"итог копилки {format_money(total)}")
+    finally:
+        remove_db(path)
+
+    path = temp_db_path()
+    try:
+        seed_ledger(path, args.users, args.pot)
+        # Несколько репозиториев со своими менеджерами соединений ведут себя как
+        # отдельные процессы: между ними блокировки только на уровне SQLite
+        repos = [repository.SavingsRepository(db.ConnectionManager(path)) for _ in range(args.managers)]
+        lock = threading.Lock()
+        totals = {'borrowed': 0, 'returned': 0, 'rejected': 0, 'operations': 0}
+
+        def worker(seed):
+            rng = random.Random(seed)
+            repo = repos[seed % len(repos)]
+            borrowed = returned = rejected = 0
+            for _ in range(args.operations // args.threads):
+                user_id = rng.randrange(args.users)
+                day = rng.randint(1, 3)
+                amount = rng.choice((1000, 5000, 10000))
+                try:
+                    if rng.random() < 0.6:
+                        repo.borrow(user_id, amount, f'2024-07-{day:02d}')
+                        borrowed += amount
+                    else:
+                        repo.repay(user_id, amount, f'{day:02d}.07')
+                        returned += amount
+                except repository.LedgerError:
+                    rejected += 1
+            with lock:
+                totals['borrowed'] += borrowed
+                totals['returned'] += returned
+                totals['rejected'] += rejected
+                totals['operations'] += args.operations // args.threads
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.threads) as pool:
+            list(pool.map(worker, range(args.threads)))
+        elapsed = time.perf_counter() - started
+        for repo in repos:
+            repo.manager.close_all()
+
+        balance, active = ledger_totals(path)
+    finally:
+        remove_db(path)
+
+    print(f"Проводки: {totals['operations']} операций за {elapsed:.1f} с, "
+          f"{totals['operations'] / elapsed:.0f} операций/с, отклонено {totals['rejected']}")
+    print(f"Итог копилки {format_money(balance)}, активных долгов на {format_money(active)}")
+
+
+def seed_journal(conn, entries, users):
+    # Журнал генерируется внутри SQLite: суммы со знаком, время растёт вместе с номером
+    conn.execute('BEGIN')
+    conn.execute('''
+    INSERT INTO journal (user_id, account, amount, created_at)
+    WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < :entries)
+    SELECT i % :users, 'cash', (i * 7919) % 20001 - 10000,
+           printf('2024-%02d-%02d %02d:00:00', 1 + i * 12 / (:entries + 1), 1 + i % 28, i % 24)
+    FROM n
+    ''', {'entries': entries, 'users': users})
+    conn.execute('''
+    UPDATE savings SET balance = (SELECT COALESCE(SUM(amount), 0) FROM journal j WHERE j.user_id = savings.user_id)
+    ''')
+    conn.execute('COMMIT')
+
+
+def bench_journal(args):
+    path = temp_db_path()
+    try:
+        seed_users(path, args.users)
+        db.manager = db.ConnectionManager(path)
+        repo = repository.SavingsRepository()
+        conn = db.manager.connection()
+
+        started = time.perf_counter()
+        seed_journal(conn, args.entries, args.users)
+        print(f"Журнал из {args.entries} записей создан за {time.perf_counter() - started:.1f} с")
+
+        started = time.perf_counter()
+        for upto in range(args.interval, args.entries + 1, args.interval):
+            repo.take_snapshot(upto)
+        snapshots = conn.execute('SELECT COUNT(*) FROM balance_snapshots').fetchone()[0]
+        print(f"{snapshots} снимков (каждые {args.interval} записей) за {time.perf_counter() - started:.1f} с")
+
+        # Полный прогон: балансы всех пользователей заново из журнала
+        started = time.perf_counter()
+        balances = dict(conn.execute('SELECT user_id, SUM(amount) FROM journal GROUP BY user_id'))
+        print(f"Прогон всего журнала: {time.perf_counter() - started:.1f} с, {len(balances)} балансов")
+
+        started = time.perf_counter()
+        problems = repo.verify_journal()
+        print(f"Сверка журнала, итога и снимков: {time.perf_counter() - started:.1f} с, расхождения {problems}")
+
+        # Баланс на момент: через снимок против суммы всех записей пользователя
+        rng = random.Random(1)
+        points = [(rng.randrange(args.users), rng.randint(1, args.entries)) for _ in range(args.queries)]
+        started = time.perf_counter()
+        for user_id, entry_id in points:
+            repo.balance_at(user_id, entry_id)
+        snapshot_time = (time.perf_counter() - started) / len(points)
+        started = time.perf_counter()
+        for user_id, entry_id in points:
+            conn.execute(repository.SELECT_JOURNAL_SUM, (user_id, 0, entry_id)).fetchone()
+        full_time = (time.perf_counter() - started) / len(points)
+        print(f"balance_at через снимок: {snapshot_time * 1e6:.0f} мкс, "
+              f"с начала журнала: {full_time * 1e6:.0f} мкс")
+    finally:
+        db.manager.close_all()
+        remove_db(path)
+
+
+def bench_reminders(args):
+    from datetime import date
+
+    from telegram.error import Forbidden, NetworkError, RetryAfter
+
+    from fake_bot_api import RecordingBot
+    from reminders import ReminderScheduler
+
+    path = temp_db_path()
+    try:
+        seed_users(path, args.users)
+        db.manager = db.ConnectionManager(path)
+        repo = repository.SavingsRepository()
+        today = date(2024, 7, 28)
+        with db.manager.transaction() as conn:
+            # Взнос назначен каждому второму, каждый третий из них уже заплатил за июль
+            conn.execute('UPDATE savings SET monthly_contribution = 300000 WHERE user_id % 2 = 0')
+            conn.executemany(repository.INSERT_CONTRIBUTION, (
+                (user_id, None, 300000, '07.2024', '2024-07-05 12:00:00')
+                for user_id in range(0, args.users, 6)
+            ))
+            # Долги: у каждого пятого просроченный, у каждого седьмого ещё нет
+            conn.executemany(repository.INSERT_DEBT, (
+                (user_id, None, 50000, '2024-07-15', '2024-06-01 12:00:00') for user_id in range(0, args.users, 5)
+            ))
+            conn.executemany(repository.INSERT_DEBT, (
+                (user_id, None, 50000, '2024-08-15', '2024-07-01 12:00:00') for user_id in range(0, args.users, 7)
+            ))
+        owing = {user_id for user_id in range(0, args.users, 2) if user_id % 6}
+        overdue = len(range(0, args.users, 5))
+
+        # Ошибки: 3 временных сбоя, один RetryAfter и один пользователь, заблокировавший бота
+        errors = {2: NetworkError('сбой'), 4: NetworkError('сбой'), 8: NetworkError('сбой'),
+                  10: RetryAfter(1), 14: Forbidden('blocked')}
+        bot = RecordingBot(errors)
+        scheduler = ReminderScheduler(bot, repo, rate=args.rate, today=lambda: today)
+        started = time.perf_counter()
+        first = asyncio.run(scheduler.run_once())
+        elapsed = time.perf_counter() - started
+
+        contribution_chats = [chat for chat, text, _ in bot.sent if text.startswith('🔔')]
+        assert len(contribution_chats) == len(set(contribution_chats)), 'повторное напоминание'
+        assert set(contribution_chats) == owing - {2, 4, 8, 14}, 'не те адресаты'
+        assert first['overdue'] == overdue - len({2, 4, 8, 14} & set(range(0, args.users, 5)))
+
+        # Скорость: ни в одном окне в одну секунду не больше rate сообщений
+        moments = sorted(moment for _, _, moment in bot.sent)
+        busiest = max(sum(1 for m in moments[i:i + args.rate + 1] if m - moments[i] < 0.99)
+                      for i in range(len(moments)))
+        assert busiest <= args.rate, busiest
+
+        # «Перезапуск»: новый планировщик досылает только сорвавшиеся временно
+        bot.sent.clear()
+        second = asyncio.run(ReminderScheduler(bot, repo, rate=args.rate, today=lambda: today).run_once())
+        resent = {chat for chat, _, _ in bot.sent}
+        assert resent == {2, 4, 8}, resent
+        third = asyncio.run(ReminderScheduler(bot, repo, rate=args.rate, today=lambda: today).run_once())
+        assert third == {'contribution': 0, 'overdue': 0}, third
+    finally:
+        db.manager.close_all()
+        remove_db(path)
+
+    total = first['contribution'] + first['overdue']
+    print(f"Первый проход: {first}, {total} сообщений за {elapsed:.1f} с, "
+          f"в любую секунду не больше {busiest} (лимит {args.rate})")
+    print(f"После перезапуска: {second} (только сорвавшиеся), затем {third}")
+
+
+def busiest_second(moments, limit):
+    # Больше всего отправок в каком-либо окне короче секунды
+    moments = sorted(moments)
+    return max((sum(1 for m in moments[i:i + limit + 2] if m - moments[i] < 0.99)
+                for i in range(len(moments))), default=0)
+
+
+def percentile(values, share):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * share))]
+
+
+async def outbox_spike(fake, args):
+    from telegram import Bot
+    from telegram.request import HTTPXRequest
+
+    from outbox import Outbox
+
+    rng = random.Random(args.seed)
+    bot = Bot('123:fake', base_url=fake.base_url, request=HTTPXRequest(connection_pool_size=16))
+    async with bot:
+        # Как раньше: обработчик ждёт ответа Telegram на каждый reply_text
+        started = time.perf_counter()
+        for i in range(50):
+            await bot.send_message(chat_id=0, text=f'прямая отправка {i}')
+        direct = (time.perf_counter() - started) / 50
+        fake.sent.clear()
+        fake.sent_at.clear()
+
+        outbox = Outbox(bot, rate=args.rate)
+        for chat_id in range(1, args.floods + 1):
+            fake.flood(chat_id, retry_after=1)
+        # Всплеск: тексты приходят в случайные моменты в пределах spread секунд
+        arrivals = sorted((rng.uniform(0, args.spread), rng.randrange(1, args.chats + 1))
+                          for _ in range(args.texts))
+        enqueued = {}
+        enqueue_cost = 0.0
+        started = time.monotonic()
+        for i, (moment, chat_id) in enumerate(arrivals):
+            delay = started + moment - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            before = time.perf_counter()
+            outbox.send(chat_id, f'ответ {i}')
+            enqueue_cost += time.perf_counter() - before
+            enqueued.setdefault(chat_id, []).append((i, time.monotonic()))
+        drained = await outbox.join(timeout=600)
+        elapsed = time.monotonic() - started
+        await outbox.stop()
+    assert drained, outbox.stats()
+    return direct, enqueue_cost / args.texts, elapsed, enqueued, outbox.stats()
+
+
+def bench_outbox(args):
+    from fake_bot_api import FakeBotAPI
+
+    from outbox import OUTBOX_CHAT_BURST, OUTBOX_CHAT_RATE
+
+    fake = FakeBotAPI(latency=args.latency).start()
+    try:
+        direct, enqueue, elapsed, enqueued, stats = asyncio.run(outbox_spike(fake, args))
+    finally:
+        fake.stop()
+
+    assert stats['delivered'] == args.texts and stats['dropped'] == 0, stats
+    # Каждый чат получил свои тексты целиком и по порядку
+    received, per_chat_moments, latencies = {}, {}, []
+    for (chat_id, text), moment in zip(fake.sent, fake.sent_at):
+        parts = text.split('\n\n')
+        received.setdefault(chat_id, []).extend(parts)
+        per_chat_moments.setdefault(chat_id, []).append(moment)
+        queue = enqueued[chat_id]
+        offset = len(received[chat_id]) - len(parts)
+        latencies.extend(moment - queued_at for _, queued_at in queue[offset:offset + len(parts)])
+    for chat_id, texts in enqueued.items():
+        assert received[chat_id] == [f'ответ {i}' for i, _ in texts], f'порядок в чате {chat_id}'
+
+    # Лимиты: общий — rate в секунду, в чат — запас плюс chat_rate в секунду
+    busiest = busiest_second(fake.sent_at, args.rate)
+    assert busiest <= args.rate + 1, busiest
+    chat_limit = OUTBOX_CHAT_BURST + int(OUTBOX_CHAT_RATE)
+    busiest_chat = max(busiest_second(moments, chat_limit) for moments in per_chat_moments.values())
+    assert busiest_chat <= chat_limit, busiest_chat
+    # После 429 чат молчит не меньше retry_after
+    for chat_id, flooded_at in fake.flooded:
+        assert min(per_chat_moments[chat_id]) >= flooded_at + 0.99, f'чат {chat_id} не выждал retry_after'
+
+    print(f"Обработчик ждёт ответа Telegram: {direct * 1e3:8.2f} мс на reply_text")
+    print(f"Постановка в очередь:            {enqueue * 1e6:8.2f} мкс на ответ")
+    print(f"{args.texts} ответов в {len(enqueued)} чатов за {elapsed:.1f} с: "
+          f"{stats['sent']} вызовов sendMessage, склеено {stats['coalesced']}, "
+          f"повторов после 429 {stats['retried']}")
+    print(f"Задержка доставки: p50 {percentile(latencies, 0.5):.2f} с, p95 {percentile(latencies, 0.95):.2f} с, "
+          f"max {max(latencies):.2f} с")
+    print(f"Не больше {busiest} отправок в секунду (лимит {args.rate}), "
+          f"в один чат — не больше {busiest_chat} (лимит {chat_limit})")
+
+
+def seed_bulk(path, users, debts, contributions):
+    # Данные с кириллицей, пустыми строками и NULL — всё, что должно пережить выгрузку
+    conn = sqlite3.connect(path, isolation_level=None)
+    migrations.migrate(conn)
+    conn.execute('BEGIN')
+    conn.execute('''
+    INSERT INTO users (user_id, username, first_name, last_name, join_date)
+    WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < :users)
+    SELECT 1000000000 + i, 'user' || i, 'Имя ' || i, CASE i % 3 WHEN 0 THEN NULL WHEN 1 THEN '' ELSE 'Фамилия, "в кавычках"' END,
+           printf('2023-%02d-01 12:00:00', 1 + i % 12)
+    FROM n
+    ''', {'users': users})
+    conn.execute('''
+    INSERT INTO savings (user_id, username, balance, monthly_contribution)
+    SELECT user_id, username, (user_id * 7919) % 1000000 - 100000, (user_id % 4) * 100000 FROM users
+    ''')
+    conn.execute('''
+    INSERT INTO debts (user_id, username, amount, due_date, status, creation_date)
+    WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < :debts)
+    SELECT 1000000000 + 1 + i % :users, 'user' || (1 + i % :users), 100 + i % 50000,
+           printf('2024-%02d-%02d', 1 + i % 12, 1 + i % 28), CASE WHEN i % 4 THEN 'returned' ELSE 'active' END,
+           printf('2024-%02d-%02d 10:00:00', 1 + i % 12, 1 + i % 28)
+    FROM n
+    ''', {'debts': debts, 'users': users})
+    conn.execute('''
+    INSERT INTO contributions (user_id, username, amount, month_year, contribution_date)
+    WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < :contributions)
+    SELECT 1000000000 + 1 + i % :users, 'user' || (1 + i % :users), 100 + (i * 7919) % 500000,
+           printf('%02d.%d', 1 + i % 12, 2020 + i % 5), printf('2024-%02d-%02d %02d:00:00', 1 + i % 12, 1 + i % 28, i % 24)
+    FROM n
+    ''', {'contributions': contributions, 'users': users})
+    conn.execute('COMMIT')
+    conn.close()
+
+
+def same_rows(source, target, table, order='rowid'):
+    query = f'SELECT * FROM {table} ORDER BY {order}'
+    return all(a == b for a, b in zip_longest(source.execute(query), target.execute(query)))
+
+
+# Прежний путь загрузки: те же executemany, но индексы обновляются на каждой строке
+def legacy_import(conn, directory):
+    import bulk
+
+    with open(bulk.table_path(directory, 'contributions', 'csv'), encoding='utf-8', newline='') as f:
+        names, chunks = bulk.read_csv(f, bulk.table_columns(conn, 'contributions'))
+        insert = f'INSERT INTO contributions ({", ".join(names)}) VALUES ({", ".join("?" * len(names))})'
+        conn.execute('BEGIN')
+        for rows in chunks:
+            conn.executemany(insert, rows)
+        conn.execute('COMMIT')
+
+
+def bench_bulk(args):
+    import shutil
+
+    import bulk
+
+    source_path = temp_db_path()
+    source = db.ConnectionManager(source_path)
+    directory = tempfile.mkdtemp()
+    targets = []
+    try:
+        started = time.perf_counter()
+        seed_bulk(source_path, args.users, args.debts, args.contributions)
+        print(f"Исходная база: {args.users} пользователей, {args.debts} долгов, "
+              f"{args.contributions} взносов за {time.perf_counter() - started:.1f} с")
+
+        for fmt in ('csv', 'columnar'):
+            started = time.perf_counter()
+            bulk.export_tables(source, directory, fmt=fmt)
+            elapsed = time.perf_counter() - started
+            size = sum(os.path.getsize(bulk.table_path(directory, table, fmt)) for table in bulk.TABLES)
+            print(f"Выгрузка {fmt:8}: {elapsed:5.1f} с, {size / 2 ** 20:6.1f} МБ")
+
+        for fmt in ('csv', 'columnar'):
+            path = temp_db_path()
+            targets.append(path)
+            db.manager = db.ConnectionManager(path)
+            repo = repository.SavingsRepository()
+            repo.init_schema()
+            started = time.perf_counter()
+            counts = bulk.import_tables(db.manager, directory, fmt=fmt)
+            elapsed = time.perf_counter() - started
+            target = db.manager.connection()
+            for table in bulk.TABLES:
+                assert same_rows(source.connection(), target, table), f'{fmt}: {table} отличается'
+            assert same_rows(source.connection(), target, 'contribution_rollups', 'period, user_id'), \
+                f'{fmt}: месячные итоги отличаются'
+            problems = repo.verify_journal()
+            assert not any(problems.values()), problems
+            print(f"Загрузка {fmt:8}: {elapsed:5.1f} с, {sum(counts.values()) / elapsed:9.0f} строк/с, "
+                  f"данные и месячные итоги совпадают, журнал сходится")
+            db.manager.close_all()
+
+        path = temp_db_path()
+        targets.append(path)
+        conn = sqlite3.connect(path, isolation_level=None)
+        migrations.migrate(conn)
+        started = time.perf_counter()
+        legacy_import(conn, directory)
+        print(f"Взносы с индексами на каждой строке (csv): {time.perf_counter() - started:5.1f} с")
+        conn.close()
+    finally:
+        source.close_all()
+        shutil.rmtree(directory, ignore_errors=True)
+        for path in [source_path] + targets:
+            remove_db(path)
+
+
+# Прежний отчёт по месяцам: скан взносов и разбор строк 'ММ.ГГГГ'
+def legacy_monthly_totals(conn, limit):
+    totals = []
+    for month_year, amount, payers in conn.execute(
+            'SELECT month_year, SUM(amount), COUNT(DISTINCT user_id) FROM contributions GROUP BY month_year'):
+        month, year = month_year.split('.')
+        totals.append((int(year) * 100 + int(month), amount, payers))
+    totals.sort(reverse=True)
+    return totals[:limit]
+
+
+def bench_rollups(args):
+    path = temp_db_path()
+    try:
+        started = time.perf_counter()
+        seed_bulk(path, args.users, 0, args.contributions)
+        print(f"{args.contributions} взносов с итогами по триггерам за {time.perf_counter() - started:.1f} с")
+        db.manager = db.ConnectionManager(path)
+        repo = repository.SavingsRepository()
+        conn = db.manager.connection()
+
+        rollups = conn.execute('SELECT period, user_id, amount, contributions FROM contribution_rollups '
+                               'ORDER BY period, user_id').fetchall()
+        expected = conn.execute('SELECT period, user_id, SUM(amount), COUNT(*) FROM contributions '
+                                'GROUP BY period, user_id ORDER BY period, user_id').fetchall()
+        assert rollups == expected, 'итоги разошлись со взносами'
+        print(f"Итоги сходятся со взносами: {len(rollups)} строк пользователь×месяц")
+
+        def measure(func, *func_args):
+            started = time.perf_counter()
+            for _ in range(args.queries):
+                result = func(*func_args)
+            return result, (time.perf_counter() - started) / args.queries
+
+        legacy, legacy_time = measure(legacy_monthly_totals, conn, 12)
+        fast, fast_time = measure(repo.monthly_totals, 12)
+        assert legacy == fast, (legacy, fast)
+        print(f"Копилка по месяцам:    скан {legacy_time * 1e3:8.2f} мс, итоги {fast_time * 1e3:8.3f} мс")
+
+        period = fast[0][0]
+        month_year = f'{period % 100:02d}.{period // 100}'
+        legacy, legacy_time = measure(lambda: [row[0] for row in conn.execute(
+            'SELECT DISTINCT user_id FROM contributions WHERE month_year = ? ORDER BY user_id', (month_year,))])
+        fast, fast_time = measure(lambda: [row[0] for row in repo.period_payers(period, limit=args.users)])
+        assert legacy == fast
+        print(f"Кто внёс за {month_year}:    скан {legacy_time * 1e3:8.2f} мс, итоги {fast_time * 1e3:8.3f} мс")
+
+        user_id = conn.execute('SELECT MIN(user_id) FROM users').fetchone()[0]
+        legacy, legacy_time = measure(lambda: sorted(
+            ((int(y) * 100 + int(m), amount, count) for (m, y), amount, count in (
+                (month_year.split('.'), amount, count) for month_year, amount, count in conn.execute(
+                    'SELECT month_year, SUM(amount), COUNT(*) FROM contributions WHERE user_id = ? '
+                    'GROUP BY month_year', (user_id,)))), reverse=True)[:12])
+        fast, fast_time = measure(repo.user_monthly_totals, user_id, 12)
+        assert legacy == fast
+        print(f"Взносы пользователя:   скан {legacy_time * 1e3:8.2f} мс, итоги {fast_time * 1e3:8.3f} мс")
+    finally:
+        db.manager.close_all()
+        remove_db(path)
+
+
+# Прежний поиск долгов по сроку: все активные долги пачками по debt_id,
+# срок 'ДД.ММ' разбирается в Python относительно даты займа
+def legacy_debts_due(conn, start, end, batch=100):
+    found = []
+    cursor = 0
+    while True:
+        rows = conn.execute('SELECT debt_id, user_id, amount, due_date, creation_date FROM debts '
+                            "WHERE status = 'active' AND debt_id > ? ORDER BY debt_id LIMIT ?",
+                            (cursor, batch)).fetchall()
+        if not rows:
+            return found
+        cursor = rows[-1][0]
+        for debt_id, _, _, due_date, creation_date in rows:
+            due = migrations.legacy_due_date(due_date, creation_date)
+            if due is not None and start <= due < end:
+                found.append(debt_id)
+
+
+# Все страницы диапазона через индекс сроков
+def debts_due_ids(query, *query_args, batch=100):
+    found = []
+    cursor = None
+    while True:
+        rows = query(*query_args, cursor, batch)
+        if not rows:
+            return found
+        cursor = rows[-1][3], rows[-1][0]
+        found.extend(row[0] for row in rows)
+
+
+def bench_debts(args):
+    path = temp_db_path()
+    today = '2024-07-01'
+    week_end = '2024-07-09'
+    try:
+        conn = sqlite3.connect(path, isolation_level=None)
+        migrations.migrate(conn, target=migrations.MIGRATIONS.index(migrations.convert_due_dates))
+        started = time.perf_counter()
+        conn.execute('''
+        INSERT INTO debts (user_id, username, amount, due_date, status, creation_date)
+        WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < :debts)
+        SELECT i % :users, NULL, 50000, printf('%02d.%02d', 1 + i / 4 % 28, 1 + i / 112 % 12),
+               CASE WHEN i % 4 THEN 'returned' ELSE 'active' END,
+               date('2023-07-01', '+' || (i / 4 * 7919 % 366) || ' days') || ' 12:00:00'
+        FROM n
+        ''', {'debts': args.debts, 'users': args.users})
+        print(f"Засеяно {args.debts} долгов со сроком 'ДД.ММ' за {time.perf_counter() - started:.1f} с")
+
+        def measure(func, *func_args):
+            started = time.perf_counter()
+            for _ in range(args.queries):
+                result = func(*func_args)
+            return result, (time.perf_counter() - started) / args.queries
+
+        legacy_overdue, legacy_overdue_time = measure(legacy_debts_due, conn, '', today)
+        legacy_upcoming, legacy_upcoming_time = measure(legacy_debts_due, conn, today, week_end)
+
+        started = time.perf_counter()
+        migrations.migrate(conn)
+        print(f"Миграция сроков в 'ГГГГ-ММ-ДД' за {time.perf_counter() - started:.1f} с")
+        conn.close()
+
+        db.manager = db.ConnectionManager(path)
+        repo = repository.SavingsRepository()
+        overdue, overdue_time = measure(debts_due_ids, repo.overdue_debts, today)
+        upcoming, upcoming_time = measure(debts_due_ids, repo.upcoming_debts, today, 7)
+        assert sorted(overdue) == sorted(legacy_overdue), 'просроченные разошлись'
+        assert sorted(upcoming) == sorted(legacy_upcoming), 'близкие к сроку разошлись'
+        _, page_time = measure(repo.overdue_debts, today, None, 100)
+
+        print(f"Просроченные ({len(overdue)}):   скан {legacy_overdue_time * 1e3:8.1f} мс, "
+              f"индекс {overdue_time * 1e3:8.1f} мс")
+        print(f"Срок в 7 дней ({len(upcoming)}):   скан {legacy_upcoming_time * 1e3:8.1f} мс, "
+              f"индекс {upcoming_time * 1e3:8.1f} мс")
+        print(f"Первая страница просроченных: {page_time * 1e3:.3f} мс")
+    finally:
+        db.manager.close_all()
+        remove_db(path)
+
+
+# Обновление как в statistics: один запрос к базе через db.run_in_db
+async def run_updates(repo, updates, users, with_db):
+    @instrument
+    async def handler(update, context):
+        if with_db:
+            return await db.run_in_db(repo.user_monthly_totals, update, 12)
+
+    started = time.perf_counter()
+    for i in range(updates):
+        await handler(i % users, None)
+    return (time.perf_counter() - started) / updates
+
+
+def bench_metrics(args):
+    path = temp_db_path()
+    seed_users(path, args.users)
+    enabled = metrics.enabled
+    best = {}
+    try:
+        # Раунды чередуются, в зачёт идёт лучший: так меньше шума соседних процессов
+        for _ in range(args.rounds):
+            for on in (False, True):
+                metrics.enabled = on
+                metrics.histograms.clear()
+                metrics.counters.clear()
+                # Трассировка запросов включается при открытии соединения
+                db.manager = db.ConnectionManager(path)
+                repo = repository.SavingsRepository()
+                for with_db in (False, True):
+                    elapsed = asyncio.run(run_updates(repo, args.updates, args.users, with_db))
+                    key = (on, with_db)
+                    best[key] = min(best.get(key, elapsed), elapsed)
+                db.manager.close_all()
+        series = len(metrics.histograms) + len(metrics.counters)
+        started = time.perf_counter()
+        for _ in range(100):
+            text = metrics.render()
+        render_time = (time.perf_counter() - started) / 100
+    finally:
+        metrics.enabled = enabled
+        remove_db(path)
+
+    for with_db, title in ((False, 'Пустой обработчик'), (True, 'Обработчик с запросом')):
+        off, on = best[(False, with_db)], best[(True, with_db)]
+        print(f"{title:22s} без метрик {off * 1e6:8.1f} мкс, с метриками {on * 1e6:8.1f} мкс, "
+              f"цена {(on - off) * 1e6:+6.1f} мкс на обновление")
+    print(f"Вывод /metrics: {series} метрик, {len(text)} байт за {render_time * 1e3:.2f} мс")
+
+
+# Смесь трафика по умолчанию: вид обновления -> вес
+TRAFFIC_MIX = {
+    'button': 40,
+    'contribute': 20,
+    'borrow': 10,
+    'return': 10,
+    'admin_text': 6,
+    'admin_command': 4,
+    'admin_button': 5,
+    'admin_page': 5,
+}
+USER_BUTTONS = ('👀 Мой баланс', '💰 Общий баланс', '💸 Мои взносы', '🔔 Мои долги', '📈 Статистика',
+                '🎯 Внести в копилку', '🍪 Взять в долг', '💪 Вернуть долг', '🔙 Назад')
+ADMIN_BUTTONS = ('🔐 Админка', '👥 Список пользователей', '📋 Список долгов', '📊 Изменить баланс',
+                 '✏️ Редактировать долг')
+
+
+def parse_mix(text):
+    mix = dict(TRAFFIC_MIX)
+    for item in filter(None, (text or '').split(',')):
+        kind, _, weight = item.partition('=')
+        if kind not in TRAFFIC_MIX:
+            raise SystemExit(f"Неизвестный вид трафика {kind!r}; есть: {', '.join(TRAFFIC_MIX)}")
+        mix[kind] = float(weight)
+    return mix
+
+
+# Синтетический трафик по зерну: одинаковое зерно — те же обновления в том
+# же порядке. Возвраты и правки админа ссылаются на займы, сделанные раньше
+def synthetic_traffic(rng, updates, users, admin_id, mix):
+    from fake_bot_api import make_callback_update, make_update
+
+    kinds, weights = zip(*mix.items())
+    borrows = []
+    traffic = []
+    for update_id in range(1, updates + 1):
+        kind = rng.choices(kinds, weights)[0]
+        user_id = rng.randint(1, users)
+        if kind == 'button':
+            text = rng.choice(USER_BUTTONS)
+        elif kind == 'contribute':
+            text = f'вношу {rng.randint(1, 50) * 100} за {rng.randint(1, 12):02d}.{rng.choice((2023, 2024))}'
+        elif kind == 'borrow':
+            amount, due = rng.randint(1, 20) * 10, f'{rng.randint(1, 28):02d}.{rng.randint(1, 12):02d}'
+            borrows.append((user_id, amount, due))
+            text = f'беру {amount} до {due}'
+        elif kind == 'return':
+            if borrows:
+                user_id, amount, due = borrows[rng.randrange(len(borrows))]
+                amount = rng.choice((amount, amount // 2 or amount))
+            else:
+                amount, due = 10, '01.01'
+            text = f'возвращаю {amount} за {due}'
+        elif kind == 'admin_text':
+            user_id = admin_id
+            debt_id = rng.randint(1, max(len(borrows), 1))
+            text = rng.choice((
+                f'баланс {rng.randint(1, users)} {rng.randint(0, 100) * 100}',
+                f'взнос {rng.randint(1, users)} {rng.randint(1, 30) * 100}',
+                f'долг {debt_id} {rng.randint(1, 20) * 10}',
+                f'дата {debt_id} {rng.randint(1, 28):02d}.{rng.randint(1, 12):02d}',
+                f'закрыть {debt_id}',
+            ))
+        elif kind == 'admin_command':
+            user_id = admin_id
+            debt_id = rng.randint(1, max(len(borrows), 1))
+            text = rng.choice((
+                f'/balance {rng.randint(1, users)} {rng.randint(0, 100) * 100}',
+                f'/vznos {rng.randint(1, users)} {rng.randint(1, 30) * 100}',
+                f'/dolg {debt_id} {rng.randint(1, 20) * 10}',
+                f'/data {debt_id} {rng.randint(1, 28):02d}.{rng.randint(1, 12):02d}',
+                f'/zakrit {debt_id}',
+            ))
+        elif kind == 'admin_button':
+            user_id, text = admin_id, rng.choice(ADMIN_BUTTONS)
+        else:
+            data = f"{rng.choice(('users', 'debts'))}:{rng.choice(('prev', 'next'))}:{rng.randint(0, users)}"
+            traffic.append((kind, make_callback_update(update_id, admin_id, data)))
+            continue
+        traffic.append((kind, make_update(update_id, user_id, text)))
+    return traffic
+
+
+# Разбор обновления как в Application.process_update: первый подходящий
+# обработчик группы, но без сети, сохранения состояния и обработчика ошибок.
+# Аренды копилок групп возвращаются в конце, как в LeasingUpdateProcessor
+async def dispatch(application, update):
+    from telegram.ext import CallbackContext
+
+    from main import leased_groups
+
+    async with leased_groups():
+        for handler in application.handlers[0]:
+            check = handler.check_update(update)
+            if check is None or check is False:
+                continue
+            context = CallbackContext.from_update(update, application)
+            await handler.handle_update(update, application, check, context)
+            return True
+    return False
+
+
+async def replay(application, updates, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+    results = []
+
+    async def process(kind, update):
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                handled = await dispatch(application, update)
+                error = None if handled else 'unhandled'
+            except Exception as e:
+                error = type(e).__name__
+            results.append((kind, time.perf_counter() - started, error))
+
+    started = time.perf_counter()
+    await asyncio.gather(*(process(kind, update) for kind, update in updates))
+    elapsed = time.perf_counter() - started
+    await application.bot_data['outbox'].stop()
+    return results, elapsed
+
+
+def latency_summary(latencies):
+    return {
+        'p50': round(percentile(latencies, 0.50) * 1e3, 3),
+        'p95': round(percentile(latencies, 0.95) * 1e3, 3),
+        'p99': round(percentile(latencies, 0.99) * 1e3, 3),
+        'max': round(max(latencies) * 1e3, 3),
+    }
+
+
+def revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+# Сравнивать можно только прогоны одной и той же нагрузки
+TRAFFIC_PARAMETERS = ('seed', 'users', 'updates', 'concurrency', 'mix')
+
+
+# Хуже базового прогона больше чем на tolerance: пропускная способность
+# ниже или задержки выше
+def regressions(report, baseline, tolerance):
+    different = [key for key in TRAFFIC_PARAMETERS if report[key] != baseline.get(key)]
+    if different:
+        raise SystemExit(f"Базовый отчёт снят с другими параметрами: {', '.join(different)}")
+    found = []
+    if report['throughput'] < baseline['throughput'] * (1 - tolerance):
+        found.append(f"throughput {baseline['throughput']} -> {report['throughput']}")
+    for key in ('p50', 'p95', 'p99'):
+        was, now = baseline['latency_ms'][key], report['latency_ms'][key]
+        if now > was * (1 + tolerance):
+            found.append(f"{key} {was} -> {now} мс")
+    return found
+
+
+def bench_traffic(args):
+    import telegram
+    from telegram import Update
+
+    import main as bot
+    from fake_bot_api import RecordingBot
+
+    mix = parse_mix(args.mix)
+    path = temp_db_path()
+    db.manager = db.ConnectionManager(path)
+    bot.repo = repository.SavingsRepository()
+    fake = RecordingBot()
+    try:
+        # Сообщения обработчиков (ошибки разбора и т.п.) — в stderr, в stdout только JSON
+        with contextlib.redirect_stdout(sys.stderr):
+            seed_load_users(bot, args.users)
+            admin_id = min(bot.ADMINS)
+            bot.repo.add_user(admin_id, 'admin', 'Админ', None)
+            rng = random.Random(args.seed)
+            traffic = [(kind, Update.de_json(update, fake)) for kind, update in
+                       synthetic_traffic(rng, args.warmup + args.updates, args.users, admin_id, mix)]
+
+            application = bot.build_application('123:fake', concurrent_updates=args.concurrency,
+                                                reminders=False, send_rate=0, chat_rate=0, throttling=False)
+            application.bot_data['outbox'].bot = fake
+            asyncio.run(replay(application, traffic[:args.warmup], args.concurrency))
+            fake.sent.clear()
+            fake.edited.clear()
+            results, elapsed = asyncio.run(replay(application, traffic[args.warmup:], args.concurrency))
+    finally:
+        db.manager.close_all()
+        remove_db(path)
+
+    kinds = {}
+    for kind, latency, error in results:
+        kinds.setdefault(kind, []).append((latency, error))
+    report = {
+        'benchmark': 'traffic',
+        'revision': revision(),
+        'python': sys.version.split()[0],
+        'python_telegram_bot': telegram.__version__,
+        'sqlite': sqlite3.sqlite_version,
+        'seed': args.seed,
+        'users': args.users,
+        'updates': args.updates,
+        'concurrency': args.concurrency,
+        'mix': mix,
+        'elapsed_s': round(elapsed, 3),
+        'throughput': round(len(results) / elapsed, 1),
+        'latency_ms': latency_summary([latency for _, latency, _ in results]),
+        'errors': sum(1 for _, _, error in results if error),
+        'replies': len(fake.sent),
+        'edits': len(fake.edited),
+        'kinds': {
+            kind: {'count': len(items), 'errors': sum(1 for _, error in items if error),
+                   **latency_summary([latency for latency, _ in items])}
+            for kind, items in sorted(kinds.items())
+        },
+    }
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            found = regressions(report, json.load(f), args.tolerance)
+        for line in found:
+            print(f"Регрессия: {line}", file=sys.stderr)
+        if found:
+            raise SystemExit(1)
+
+
+# Шумная группа пишет без остановки в несколько потоков, тихая делает
+# args.writes взносов подряд; меряется задержка записи тихой группы
+def measure_quiet_group(busy, quiet, args):
+    stop = threading.Event()
+
+    def flood(seed):
+        rng = random.Random(seed)
+        count = 0
+        while not stop.is_set():
+            busy.add_contribution(rng.randrange(args.users), 100, '07.2023')
+            count += 1
+        return count
+
+    latencies = []
+    with ThreadPoolExecutor(max_workers=args.threads) as pool:
+        flooding = [pool.submit(flood, seed) for seed in range(args.threads)]
+        started = time.perf_counter()
+        for i in range(args.writes):
+            began = time.perf_counter()
+            quiet.add_contribution(args.users + i % args.users, 100, '07.2023')
+            latencies.append(time.perf_counter() - began)
+        elapsed = time.perf_counter() - started
+        stop.set()
+        flooded = sum(future.result() for future in flooding)
+    return latencies, flooded / elapsed
+
+
+def bench_groups(args):
+    from groups import GroupRouter
+
+    # Прежняя схема: обе группы — пользователи одной общей базы
+    path = temp_db_path()
+    try:
+        seed_users(path, args.users * 2)
+        shared = repository.SavingsRepository(db.ConnectionManager(path))
+        latencies, flood_rate = measure_quiet_group(shared, shared, args)
+        shared.manager.close_all()
+    finally:
+        remove_db(path)
+    print(f"Общая база:    тихая группа p50 {percentile(latencies, 0.5) * 1e3:6.2f} мс, "
+          f"p95 {percentile(latencies, 0.95) * 1e3:6.2f} мс; шумная {flood_rate:6.0f} записей/с")
+
+    directory = tempfile.mkdtemp()
+    router = GroupRouter(directory)
+    try:
+        busy, quiet = router.open(-1001), router.open(-1002)
+        for user_id in range(args.users * 2):
+            (busy if user_id < args.users else quiet).add_user(user_id, f'user{user_id}', 'Тест', None)
+        latencies, flood_rate = measure_quiet_group(busy, quiet, args)
+    finally:
+        router.close_all()
+        for group_id in (-1001, -1002):
+            remove_db(router.path(group_id))
+        os.rmdir(directory)
+    print(f"Файл на группу: тихая группа p50 {percentile(latencies, 0.5) * 1e3:6.2f} мс, "
+          f"p95 {percentile(latencies, 0.95) * 1e3:6.2f} мс; шумная {flood_rate:6.0f} записей/с")
+
+    # Много групп по очереди: открытыми остаются только последние, число
+    # файловых дескрипторов процесса не растёт с числом групп
+    directory = tempfile.mkdtemp()
+    router = GroupRouter(directory, limit=args.open)
+    fds = lambda: len(os.listdir('/proc/self/fd'))
+    before = fds()
+    try:
+        for group_id in range(1, args.groups + 1):
+            router.open(-group_id).add_user(1, 'user1', 'Тест', None)
+            router.get(-1)
+        during = fds()
+        stats = router.stats()
+    finally:
+        router.close_all()
+        for file in os.listdir(directory):
+            os.remove(os.path.join(directory, file))
+        os.rmdir(directory)
+    print(f"{args.groups} групп при лимите {args.open}: дескрипторов +{during - before}, "
+          f"открыто {stats['open']}, вытеснено {stats['evictions']}")
+
+
+def bench_roles(args):
+    from roles import RoleStore, watch
+
+    path = temp_db_path()
+    try:
+        seed_users(path, args.users)
+        # Два воркера: у каждого свой менеджер соединений и свой снимок ролей
+        writer = RoleStore(repository.SavingsRepository(db.ConnectionManager(path))).reload()
+        reader = RoleStore(repository.SavingsRepository(db.ConnectionManager(path)))
+        for user_id in range(args.admins):
+            writer.grant(user_id)
+        reader.reload()
+
+        rng = random.Random(1)
+        user_ids = [rng.randrange(args.users) for _ in range(100_000)]
+        legacy = list(range(args.admins))
+        started = time.perf_counter()
+        listed = sum(1 for user_id in user_ids if user_id in legacy)
+        legacy_time = (time.perf_counter() - started) / len(user_ids)
+        started = time.perf_counter()
+        found = sum(1 for user_id in user_ids if reader.has(user_id))
+        snapshot_time = (time.perf_counter() - started) / len(user_ids)
+        assert listed == found, (listed, found)
+        print(f"Проверка права при {args.admins} администраторах: список {legacy_time * 1e9:6.0f} нс, "
+              f"снимок {snapshot_time * 1e9:4.0f} нс")
+
+        started = time.perf_counter()
+        for _ in range(1000):
+            reader.refresh()
+        print(f"Сверка версии без изменений: {(time.perf_counter() - started) * 1e3:.1f} мкс")
+
+        # Роль выдаёт соседний воркер; сколько проходит, пока её увидит этот
+        async def propagation():
+            watcher = asyncio.create_task(watch(reader.refresh, args.interval))
+            delays = []
+            for i in range(args.grants):
+                await asyncio.sleep(rng.random() * args.interval)
+                user_id = args.users + i
+                await db.run_in_db(writer.grant, user_id)
+                granted = time.perf_counter()
+                while not reader.has(user_id):
+                    await asyncio.sleep(0.001)
+                delays.append(time.perf_counter() - granted)
+            watcher.cancel()
+            return delays
+
+        delays = asyncio.run(propagation())
+        print(f"Роль видна соседнему воркеру через: p50 {percentile(delays, 0.5) * 1e3:.0f} мс, "
+              f"худшее {max(delays) * 1e3:.0f} мс (сверка раз в {args.interval * 1e3:.0f} мс)")
+        writer.repo.manager.close_all()
+        reader.repo.manager.close_all()
+    finally:
+        remove_db(path)
+
+
+# Всё, что меняет движение денег: повтор обновлений не должен это сдвинуть
+def ledger_state(path):
+    conn = sqlite3.connect(path)
+    state = {
+        'total': conn.execute(repository.SELECT_TOTAL_BALANCE).fetchone()[0],
+        'balances': conn.execute(repository.SELECT_SUM_BALANCE).fetchone()[0],
+        'contributions': conn.execute('SELECT COUNT(*) FROM contributions').fetchone()[0],
+        'debts': conn.execute('SELECT COUNT(*), COALESCE(SUM(amount), 0) FROM debts').fetchone(),
+        'journal': conn.execute('SELECT COUNT(*) FROM journal').fetchone()[0],
+        'processed': conn.execute('SELECT COUNT(*) FROM processed_updates').fetchone()[0],
+    }
+    conn.close()
+    return state
+
+
+# Стоимость повтора: одна и та же пачка обновлений с деньгами прогоняется
+# тем же процессом (отсекает окно в памяти) и после «перезапуска»
+# (отсекает processed_updates); что деньги не сдвинулись, проверяет
+# tests/test_replay.py
+def bench_replay(args):
+    from telegram import Update
+
+    import main as bot
+    from fake_bot_api import RecordingBot
+
+    mix = dict.fromkeys(TRAFFIC_MIX, 0)
+    mix.update({'contribute': 50, 'borrow': 25, 'return': 25})
+    fake = RecordingBot()
+
+    def build():
+        application = bot.build_application('123:fake', concurrent_updates=args.concurrency,
+                                            reminders=False, send_rate=0, chat_rate=0, throttling=False)
+        application.bot_data['outbox'].bot = fake
+        return application
+
+    def run(application, traffic):
+        results, elapsed = asyncio.run(replay(application, traffic, args.concurrency))
+        errors = [error for _, _, error in results if error]
+        if errors:
+            raise RuntimeError(f"Обработчики упали: {errors[:5]}")
+        return elapsed / len(traffic)
+
+    path = temp_db_path()
+    db.manager = db.ConnectionManager(path)
+    bot.repo = repository.SavingsRepository()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            seed_load_users(bot, args.users)
+            rng = random.Random(args.seed)
+            traffic = [(kind, Update.de_json(update, fake)) for kind, update in
+                       synthetic_traffic(rng, args.updates, args.users, min(bot.ADMINS), mix)]
+
+            application = build()
+            first = run(application, traffic)
+            state = ledger_state(path)
+            replies = len(fake.sent)
+            memory = run(application, traffic)
+            # Новый процесс: окно в памяти пустое, повторы видит только база
+            stored = run(build(), traffic)
+    finally:
+        db.manager.close_all()
+        remove_db(path)
+
+    print(f"{args.updates} обновлений, из них с движением денег {state['processed']}; "
+          f"ответов на первый прогон {replies}, на повторы {len(fake.sent) - replies}")
+    print(f"Первый прогон:           {first * 1e6:7.0f} мкс на обновление")
+    print(f"Повтор, окно в памяти:   {memory * 1e6:7.0f} мкс на обновление")
+    print(f"Повтор после перезапуска: {stored * 1e6:6.0f} мкс на обновление")
+
+
+# Читающие кнопки, которыми флудят: каждая без защиты — запрос к базе
+FLOOD_BUTTONS = ('💰 Общий баланс', '👀 Мой баланс', '💸 Мои взносы', '🔔 Мои долги', '📈 Статистика')
+# Сколько раз в секунду флудеры шлют очередную порцию нажатий
+FLOOD_WAVES = 10
+
+
+# args.flooders пользователей жмут читающие кнопки args.presses раз за
+# args.seconds, остальные нажимают по разу посреди флуда. Прогон без защиты
+# и с ней: сколько запусков обработчиков и запросов SQL дошло до базы
+def bench_throttle(args):
+    from telegram import Update
+
+    import main as bot
+    from fake_bot_api import RecordingBot, make_update
+
+    waves = max(int(args.seconds * FLOOD_WAVES), 1)
+    per_wave = max(args.presses // waves, 1)
+    quiet = list(range(args.flooders + 1, args.users + 1))
+    for throttling in (False, True):
+        path = temp_db_path()
+        db.manager = db.ConnectionManager(path)
+        bot.repo = repository.SavingsRepository()
+        fake = RecordingBot()
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                seed_load_users(bot, args.users)
+                application = bot.build_application('123:fake', concurrent_updates=args.concurrency,
+                                                    reminders=False, send_rate=0, chat_rate=0,
+                                                    throttling=throttling)
+                application.bot_data['outbox'].bot = fake
+                rng = random.Random(args.seed)
+                pressed = {wave: [] for wave in range(waves)}
+                for user_id in quiet:
+                    pressed[rng.randrange(waves)].append(user_id)
+
+                metrics.histograms.clear()
+                metrics.counters.clear()
+                statements = metrics.statements()
+                update_id = 0
+                started = time.perf_counter()
+                for wave in range(waves):
+                    batch = []
+                    for user_id in list(range(1, args.flooders + 1)) * per_wave + pressed[wave]:
+                        update_id += 1
+                        batch.append(('press', Update.de_json(make_update(update_id, user_id, rng.choice(FLOOD_BUTTONS)), fake)))
+                    asyncio.run(replay(application, batch, args.concurrency))
+                    time.sleep(max(0.0, started + (wave + 1) / FLOOD_WAVES - time.perf_counter()))
+                elapsed = time.perf_counter() - started
+                statements = metrics.statements() - statements
+        finally:
+            db.manager.close_all()
+            remove_db(path)
+
+        runs = sum(histogram.count for (name, _), histogram in metrics.histograms.items()
+                   if name == 'bot_handler_seconds')
+        rejected = sum(value for (name, _), value in metrics.counters.items() if name == 'bot_throttled_total')
+        hits = sum(value for (name, _), value in metrics.counters.items() if name == 'bot_response_cache_hits_total')
+        answered = {chat_id for chat_id, _, _ in fake.sent}
+        served = sum(1 for user_id in quiet if user_id in answered)
+        title = 'С защитой' if throttling else 'Без защиты'
+        print(f"{title:10s}: {update_id} нажатий за {elapsed:.1f} с, обработчиков {runs}, запросов SQL "
+              f"{statements}; отброшено {rejected}, из кэша {hits}; остальным ответили {served} из {len(quiet)}")
+        assert served == len(quiet), (served, len(quiet))
+        if throttling:
+            throttle = application.bot_data['throttle']
+            # Флудер проходит не больше запаса и пополнения жетонов за время прогона
+            bound = args.flooders * (throttle.burst + throttle.rate * elapsed + 1) + len(quiet)
+            assert runs <= bound, (runs, bound)
+            print(f"Граница запусков обработчиков: {bound:.0f}, в памяти {throttle.stats()}")
+
+
+# Долги и взносы за последние три года относительно сегодняшнего дня:
+# часть старше горизонта архивации, часть моложе
+def seed_history(path, users, debts, contributions):
+    conn = sqlite3.connect(path, isolation_level=None)
+    migrations.migrate(conn)
+    conn.execute('BEGIN')
+    conn.execute('''
+    INSERT INTO users (user_id, username, first_name, last_name, join_date)
+    WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < :users)
+    SELECT i, 'user' || i, 'Имя ' || i, NULL, '2023-01-01 12:00:00' FROM n
+    ''', {'users': users})
+    conn.execute('INSERT INTO savings (user_id, username, balance, monthly_contribution) '
+                 'SELECT user_id, username, 0, (user_id % 4) * 100000 FROM users')
+    conn.execute('''
+    INSERT INTO debts (user_id, username, amount, due_date, status, creation_date)
+    WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < :debts)
+    SELECT 1 + i % :users, 'user' || (1 + i % :users), 100 + i % 50000,
+           date('now', '-' || (1095 - i * 1095 / :debts) || ' days', '+30 days'),
+           CASE WHEN i % 10 THEN 'returned' ELSE 'active' END,
+           datetime('now', '-' || (1095 - i * 1095 / :debts) || ' days')
+    FROM n
+    ''', {'debts': debts, 'users': users})
+    conn.execute('''
+    INSERT INTO contributions (user_id, username, amount, month_year, contribution_date)
+    WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < :contributions)
+    SELECT 1 + i % :users, 'user' || (1 + i % :users), 100 + (i * 7919) % 500000,
+           strftime('%m.%Y', 'now', '-' || (1095 - i * 1095 / :contributions) || ' days'),
+           datetime('now', '-' || (1095 - i * 1095 / :contributions) || ' days')
+    FROM n
+    ''', {'contributions': contributions, 'users': users})
+    conn.execute('COMMIT')
+    conn.close()
+
+
+# Всё, что читают обработчики и напоминания: после архивации не должно измениться
+def history_state(conn):
+    return {
+        'rollups': conn.execute('SELECT * FROM contribution_rollups ORDER BY period, user_id').fetchall(),
+        'contributions': conn.execute('SELECT COUNT(*), SUM(amount) FROM contributions_history').fetchone(),
+        'debts': conn.execute('SELECT COUNT(*), SUM(amount) FROM debts_history').fetchone(),
+        'active': conn.execute("SELECT COUNT(*), SUM(amount) FROM debts WHERE status = 'active'").fetchone(),
+    }
+
+
+def bench_archive(args):
+    import archive
+
+    path = temp_db_path()
+    try:
+        started = time.perf_counter()
+        seed_history(path, args.users, args.debts, args.contributions)
+        print(f"Засеяно {args.debts} долгов и {args.contributions} взносов за три года "
+              f"за {time.perf_counter() - started:.1f} с")
+        db.manager = db.ConnectionManager(path)
+        repo = repository.SavingsRepository()
+        conn = db.manager.connection()
+
+        # Старая база без auto_vacuum: разовый перевод (archive --convert-vacuum), дальше — как у новой
+        started = time.perf_counter()
+        archive.enable_incremental_vacuum(db.manager)
+        print(f"Перевод на auto_vacuum = INCREMENTAL (разовый VACUUM) за {time.perf_counter() - started:.1f} с")
+
+        rng = random.Random(1)
+        user_ids = [rng.randint(1, args.users) for _ in range(args.queries)]
+        period = datetime.now().strftime('%m.%Y')
+        queries = (
+            ('Мои долги', lambda user_id: repo.active_debts(user_id)),
+            ('Список долгов', lambda user_id: repo.active_debts_page(user_id * args.debts // args.users)),
+            ('Мои взносы', lambda user_id: repo.recent_contributions(user_id, 10)),
+            ('Статистика', lambda user_id: repo.user_monthly_totals(user_id, 12)),
+            ('Напоминания о взносах', lambda user_id: repo.contribution_reminders(period, user_id)),
+        )
+
+        def measure():
+            timings, results = {}, {}
+            for title, query in queries:
+                started = time.perf_counter()
+                results[title] = [query(user_id) for user_id in user_ids]
+                timings[title] = (time.perf_counter() - started) / len(user_ids)
+            return timings, results
+
+        state = history_state(conn)
+        space = archive.space(db.manager)
+        before, expected = measure()
+
+        started = time.perf_counter()
+        counts = archive.archive(db.manager, archive.horizon(args.days))
+        archived = time.perf_counter() - started
+        sparseness = {table: archive.index_sparseness(db.manager, table) for table in counts}
+        started = time.perf_counter()
+        rebuilt = archive.reindex(db.manager)
+        reindexed = time.perf_counter() - started
+        moved = archive.space(db.manager)
+        started = time.perf_counter()
+        freed = archive.incremental_vacuum(db.manager)
+        vacuumed = time.perf_counter() - started
+        after, actual = measure()
+
+        assert history_state(conn) == state, 'история разошлась после архивации'
+        assert actual == expected, 'ответы обработчиков изменились'
+        print(f"В архив старше {args.days} дней: долгов {counts['debts']}, взносов {counts['contributions']} "
+              f"за {archived:.1f} с; итоги, история и ответы не изменились")
+        shares = ', '.join(f"{table} {share:.0%}" for table, share in sparseness.items() if share is not None)
+        print(f"Пусто в индексах после переноса: {shares or 'нет dbstat'}; "
+              f"REINDEX {', '.join(rebuilt) or 'не понадобился'} за {reindexed:.1f} с")
+        print(f"Рабочие таблицы с индексами: {space['hot'] / 2**20:.1f} МБ -> {moved['hot'] / 2**20:.1f} МБ")
+        print(f"incremental_vacuum: {freed} страниц за {vacuumed:.2f} с; файл {space['file'] / 2**20:.1f} МБ -> "
+              f"{os.path.getsize(path) / 2**20:.1f} МБ (архив в том же файле)")
+        for title, _ in queries:
+            print(f"{title:22s} до {before[title] * 1e6:8.1f} мкс, после {after[title] * 1e6:8.1f} мкс")
+    finally:
+        db.manager.close_all()
+        remove_db(path)
+
+
+def bench_load(args):
+    sequential = run_load(args.updates, args.users, False, args.latency)
+    concurrent = run_load(args.updates, args.users, True, args.latency)
+    print(f"Последовательная обработка: {sequential:8.0f} обновлений/с")
+    print(f"Конкурентная обработка:     {concurrent:8.0f} обновлений/с")
+    print(f"Ускорение: x{concurrent / sequential:.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Микробенчмарки бота-копилки')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    pool = subparsers.add_parser('pool', help='connect на каждый вызов против долгоживущих соединений')
+    pool.add_argument('--messages', type=int, default=5000)
+    pool.add_argument('--users', type=int, default=100)
+    pool.set_defaults(func=bench_pool)
+
+    indexes = subparsers.add_parser('indexes', help='задержка запросов до и после индексов')
+    indexes.add_argument('--contributions', type=int, default=1_000_000)
+    indexes.add_argument('--debts', type=int, default=200_000)
+    indexes.add_argument('--users', type=int, default=1000)
+    indexes.add_argument('--queries', type=int, default=200)
+    indexes.set_defaults(func=bench_indexes)
+
+    load = subparsers.add_parser('load', help='нагрузочный тест через локальную подмену Bot API')
+    load.add_argument('--updates', type=int, default=2000)
+    load.add_argument('--users', type=int, default=50)
+    load.add_argument('--latency', type=float, default=0.05, help='задержка ответа sendMessage, с')
+    load.set_defaults(func=bench_load)
+
+    hook = subparsers.add_parser('webhook', help='POST записанных обновлений в локальный webhook')
+    hook.add_argument('--updates', type=int, default=2000)
+    hook.add_argument('--updates-file', help='JSON Lines с записанными Update')
+    hook.add_argument('--users', type=int, default=50)
+    hook.add_argument('--clients', type=int, default=8)
+    hook.add_argument('--latency', type=float, default=0.05, help='задержка ответа sendMessage, с')
+    hook.set_defaults(func=bench_webhook)
+
+    routing = subparsers.add_parser('router', help='стоимость маршрутизации одного сообщения')
+    routing.add_argument('--messages', type=int, default=200_000)
+    routing.set_defaults(func=bench_router)
+
+    parsing = subparsers.add_parser('parser', help='пропускная способность разбора команд')
+    parsing.add_argument('--messages', type=int, default=200_000)
+    parsing.set_defaults(func=bench_parser)
+
+    amounts = subparsers.add_parser('money', help='копейки против Decimal: сумма, вывод и разбор')
+    amounts.add_argument('--amounts', type=int, default=1_000_000)
+    amounts.add_argument('--seed', type=int, default=1)
+    amounts.set_defaults(func=bench_money)
+
+    listing = subparsers.add_parser('listing', help='постраничные списки админки против полного списка')
+    listing.add_argument('--users', type=int, default=50_000)
+    listing.set_defaults(func=bench_listing)
+
+    caching = subparsers.add_parser('cache', help='кэш состояния пользователей: попадания и пропускная способность')
+    caching.add_argument('--users', type=int, default=50_000)
+    caching.add_argument('--operations', type=int, default=100_000)
+    caching.add_argument('--threads', type=int, default=4)
+    caching.add_argument('--cache-size', type=int, default=repository.USER_CACHE_SIZE)
+    caching.set_defaults(func=bench_cache)
+
+    ledger = subparsers.add_parser('ledger', help='стресс займов и возвратов с проверкой инвариантов')
+    ledger.add_argument('--users', type=int, default=100)
+    ledger.add_argument('--operations', type=int, default=20_000)
+    ledger.add_argument('--threads', type=int, default=16)
+    ledger.add_argument('--managers', type=int, default=2)
+    ledger.add_argument('--pot', type=int, default=10_000_000)
+    ledger.set_defaults(func=bench_ledger)
+
+    journal = subparsers.add_parser('journal', help='прогон и сверка большого журнала, баланс на момент')
+    journal.add_argument('--entries', type=int, default=10_000_000)
+    journal.add_argument('--users', type=int, default=1000)
+    journal.add_argument('--interval', type=int, default=100_000)
+    journal.add_argument('--queries', type=int, default=200)
+    journal.set_defaults(func=bench_journal)
+
+    reminding = subparsers.add_parser('reminders', help='рассылка напоминаний через фейковый Bot')
+    reminding.add_argument('--users', type=int, default=600)
+    reminding.add_argument('--rate', type=int, default=25)
+    reminding.set_defaults(func=bench_reminders)
+
+    sending = subparsers.add_parser('outbox', help='очередь отправки: всплеск ответов через локальную подмену Bot API')
+    sending.add_argument('--chats', type=int, default=100)
+    sending.add_argument('--texts', type=int, default=1000)
+    sending.add_argument('--spread', type=float, default=2.0, help='за сколько секунд приходят все тексты')
+    sending.add_argument('--latency', type=float, default=0.05, help='задержка ответа sendMessage, с')
+    sending.add_argument('--rate', type=int, default=30)
+    sending.add_argument('--floods', type=int, default=5, help='сколько чатов получат 429')
+    sending.add_argument('--seed', type=int, default=1)
+    sending.set_defaults(func=bench_outbox)
+
+    transfer = subparsers.add_parser('bulk', help='выгрузка и загрузка таблиц: CSV и колоночный формат')
+    transfer.add_argument('--users', type=int, default=10_000)
+    transfer.add_argument('--debts', type=int, default=100_000)
+    transfer.add_argument('--contributions', type=int, default=1_000_000)
+    transfer.set_defaults(func=bench_bulk)
+
+    rollups = subparsers.add_parser('rollups', help='месячные итоги взносов против скана contributions')
+    rollups.add_argument('--users', type=int, default=10_000)
+    rollups.add_argument('--contributions', type=int, default=1_000_000)
+    rollups.add_argument('--queries', type=int, default=20)
+    rollups.set_defaults(func=bench_rollups)
+
+    due = subparsers.add_parser('debts', help='просроченные и близкие к сроку долги: скан против индекса сроков')
+    due.add_argument('--users', type=int, default=10_000)
+    due.add_argument('--debts', type=int, default=1_000_000)
+    due.add_argument('--queries', type=int, default=3)
+    due.set_defaults(func=bench_debts)
+
+    measuring = subparsers.add_parser('metrics', help='цена сбора метрик на одно обновление')
+    measuring.add_argument('--users', type=int, default=1000)
+    measuring.add_argument('--updates', type=int, default=5000)
+    measuring.add_argument('--rounds', type=int, default=3)
+    measuring.set_defaults(func=bench_metrics)
+
+    traffic = subparsers.add_parser('traffic', help='синтетический трафик через обработчики, JSON с p50/p95/p99')
+    traffic.add_argument('--users', type=int, default=1000)
+    traffic.add_argument('--updates', type=int, default=10_000)
+    traffic.add_argument('--warmup', type=int, default=500)
+    traffic.add_argument('--concurrency', type=int, default=1)
+    traffic.add_argument('--seed', type=int, default=1)
+    traffic.add_argument('--mix', help='веса видов трафика, например button=60,borrow=5')
+    traffic.add_argument('--output', help='записать отчёт в файл вместо stdout')
+    traffic.add_argument('--baseline', help='отчёт прошлой версии: выход с кодом 1 при регрессии')
+    traffic.add_argument('--tolerance', type=float, default=0.2)
+    traffic.set_defaults(func=bench_traffic)
+
+    sharding = subparsers.add_parser('groups', help='запись тихой группы под нагрузкой соседней: общая база и файл на группу')
+    sharding.add_argument('--users', type=int, default=100)
+    sharding.add_argument('--writes', type=int, default=500)
+    sharding.add_argument('--threads', type=int, default=4)
+    sharding.add_argument('--groups', type=int, default=300)
+    sharding.add_argument('--open', type=int, default=64)
+    sharding.set_defaults(func=bench_groups)
+
+    granting = subparsers.add_parser('roles', help='проверка прав по снимку ролей и доставка выданной роли')
+    granting.add_argument('--users', type=int, default=10_000)
+    granting.add_argument('--admins', type=int, default=50)
+    granting.add_argument('--grants', type=int, default=20)
+    granting.add_argument('--interval', type=float, default=0.2)
+    granting.set_defaults(func=bench_roles)
+
+    replaying = subparsers.add_parser('replay', help='повторная доставка пачки обновлений: деньги двигаются один раз')
+    replaying.add_argument('--users', type=int, default=200)
+    replaying.add_argument('--updates', type=int, default=5000)
+    replaying.add_argument('--concurrency', type=int, default=8)
+    replaying.add_argument('--seed', type=int, default=1)
+    replaying.set_defaults(func=bench_replay)
+
+
+    flooding = subparsers.add_parser('throttle', help='флуд читающими кнопками: запросы к базе без защиты и с ней')
+    flooding.add_argument('--users', type=int, default=200)
+    flooding.add_argument('--flooders', type=int, default=20)
+    flooding.add_argument('--presses', type=int, default=300, help='нажатий каждого флудера')
+    flooding.add_argument('--seconds', type=float, default=3)
+    flooding.add_argument('--concurrency', type=int, default=8)
+    flooding.add_argument('--seed', type=int, default=1)
+    flooding.set_defaults(func=bench_throttle)
+
+    archiving = subparsers.add_parser('archive', help='архивация старых долгов и взносов: место и задержка запросов')
+    archiving.add_argument('--users', type=int, default=10_000)
+    archiving.add_argument('--debts', type=int, default=300_000)
+    archiving.add_argument('--contributions', type=int, default=1_000_000)
+    archiving.add_argument('--days', type=int, default=365)
+    archiving.add_argument('--queries', type=int, default=500)
+    archiving.set_defaults(func=bench_archive)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,270 @@
+import array
+import csv
+import json
+import os
+import sys
+
+import migrations
+from repository import INSERT_JOURNAL, now
+
+
+# Таблицы в порядке загрузки: сначала те, на которые ссылаются остальные;
+# архив взносов раньше contributions, чтобы итоги пересчитались по обоим
+TABLES = ('users', 'savings', 'debts', 'debts_archive', 'contributions_archive', 'contributions')
+# Сколько строк читается из курсора и пишется за раз
+CHUNK_ROWS = 20000
+# NULL в CSV, как в COPY у PostgreSQL: пустая строка остаётся пустой строкой
+CSV_NULL = r'\N'
+
+# Колоночный формат: заголовок — магическая строка и строка JSON со схемой,
+# дальше блоки по CHUNK_ROWS строк. Блок — число строк (int64, 0 — конец
+# файла), затем по каждому столбцу байт-признак наличия NULL с маской и
+# значения. Целые хранятся как минимум блока и смещения от него в самом
+# узком подходящем типе array; текст — словарём различных строк и номерами
+# в нём, если повторов много, иначе длинами строк и строками подряд в UTF-8
+COLUMNAR_MAGIC = b'KOPILKA-COLUMNS 1\n'
+# Беззнаковые типы array по возрастанию размера
+UNSIGNED_TYPECODES = 'BHIQ'
+EXTENSIONS = {'csv': '.csv', 'columnar': '.kcol'}
+
+
+def table_columns(conn, table):
+    # (имя, целое ли) по объявленному типу столбца
+    return [(name, 'INT' in (declared or '').upper())
+            for _, name, declared, *_ in conn.execute(f'PRAGMA table_info({table})')]
+
+
+def read_chunks(conn, table, names):
+    cursor = conn.execute(f'SELECT {", ".join(names)} FROM {table} ORDER BY rowid')
+    while True:
+        rows = cursor.fetchmany(CHUNK_ROWS)
+        if not rows:
+            return
+        yield rows
+
+
+def write_csv(f, columns, chunks):
+    writer = csv.writer(f, lineterminator='\n')
+    writer.writerow([name for name, _ in columns])
+    count = 0
+    for rows in chunks:
+        writer.writerows([CSV_NULL if value is None else value for value in row] for row in rows)
+        count += len(rows)
+    return count
+
+
+def read_csv(f, columns):
+    reader = csv.reader(f)
+    names = next(reader, None)
+    if names is None:
+        return [], iter(())
+    check_names(names, columns)
+
+    def chunks():
+        rows = []
+        for row in reader:
+            if CSV_NULL in row:
+                row = [None if value == CSV_NULL else value for value in row]
+            rows.append(row)
+            if len(rows) == CHUNK_ROWS:
+                yield rows
+                rows = []
+        if rows:
+            yield rows
+    return names, chunks()
+
+
+def write_ints(f, values):
+    base = min(values)
+    span = max(values) - base
+    typecode = next(code for code in UNSIGNED_TYPECODES if span < 256 ** array.array(code).itemsize)
+    f.write(typecode.encode())
+    f.write(array.array('q', [base]).tobytes())
+    f.write(array.array(typecode, [value - base for value in values]).tobytes())
+
+
+def write_plain_texts(f, values):
+    write_ints(f, list(map(len, values)))
+    blob = ''.join(values).encode()
+    f.write(array.array('q', [len(blob)]).tobytes())
+    f.write(blob)
+
+
+def write_columnar(f, table, columns, chunks):
+    header = {'table': table, 'columns': columns, 'byteorder': sys.byteorder}
+    f.write(COLUMNAR_MAGIC)
+    f.write(json.dumps(header).encode() + b'\n')
+    count = 0
+    for rows in chunks:
+        f.write(array.array('q', [len(rows)]).tobytes())
+        for (_, is_int), values in zip(columns, zip(*rows)):
+            if None in values:
+                f.write(b'\x01')
+                f.write(bytes(value is None for value in values))
+            else:
+                f.write(b'\x00')
+            if is_int:
+                write_ints(f, [value or 0 for value in values])
+                continue
+            values = ['' if value is None else str(value) for value in values]
+            distinct = dict.fromkeys(values)
+            if len(distinct) * 2 <= len(values):
+                # Словарь: каждая различная строка один раз, дальше только номера
+                numbers = {value: number for number, value in enumerate(distinct)}
+                f.write(b'd')
+                f.write(array.array('q', [len(distinct)]).tobytes())
+                write_plain_texts(f, list(distinct))
+                write_ints(f, [numbers[value] for value in values])
+            else:
+                f.write(b'p')
+                write_plain_texts(f, values)
+        count += len(rows)
+    f.write(array.array('q', [0]).tobytes())
+    return count
+
+
+def read_columnar(f, columns):
+    if f.readline() != COLUMNAR_MAGIC:
+        raise ValueError("Файл не в колоночном формате копилки")
+    header = json.loads(f.readline())
+    stored = [(name, is_int) for name, is_int in header['columns']]
+    check_names([name for name, _ in stored], columns)
+    swap = header['byteorder'] != sys.byteorder
+
+    def read_array(typecode, count):
+        values = array.array(typecode)
+        data = f.read(count * values.itemsize)
+        if len(data) != count * values.itemsize:
+            raise ValueError("Файл обрезан")
+        values.frombytes(data)
+        if swap:
+            values.byteswap()
+        return values
+
+    def read_ints(count):
+        typecode = f.read(1).decode()
+        base = read_array('q', 1)[0]
+        values = read_array(typecode, count).tolist()
+        return [value + base for value in values] if base else values
+
+    def read_plain_texts(count):
+        lengths = read_ints(count)
+        text = f.read(read_array('q', 1)[0]).decode()
+        values, offset = [], 0
+        for length in lengths:
+            values.append(text[offset:offset + length])
+            offset += length
+        return values
+
+    def chunks():
+        while True:
+            count = read_array('q', 1)[0]
+            if not count:
+                return
+            data = []
+            for _, is_int in stored:
+                nulls = f.read(count) if f.read(1) == b'\x01' else None
+                if is_int:
+                    values = read_ints(count)
+                elif f.read(1) == b'd':
+                    distinct = read_plain_texts(read_array('q', 1)[0])
+                    values = list(map(distinct.__getitem__, read_ints(count)))
+                else:
+                    values = read_plain_texts(count)
+                if nulls is not None:
+                    values = [None if null else value for value, null in zip(values, nulls)]
+                data.append(values)
+            yield list(zip(*data))
+    return [name for name, _ in stored], chunks()
+
+
+def check_names(names, columns):
+    unknown = set(names) - {name for name, _ in columns}
+    if unknown:
+        raise ValueError(f"Неизвестные столбцы: {', '.join(sorted(unknown))}")
+
+
+def table_path(directory, table, fmt):
+    return os.path.join(directory, table + EXTENSIONS[fmt])
+
+
+# Выгрузка одним читающим снимком: все таблицы согласованы между собой,
+# а бот тем временем продолжает писать (WAL)
+def export_tables(manager, directory, tables=TABLES, fmt='csv'):
+    os.makedirs(directory, exist_ok=True)
+    counts = {}
+    with manager.transaction(immediate=False) as conn:
+        for table in (table for table in TABLES if table in tables):
+            columns = table_columns(conn, table)
+            chunks = read_chunks(conn, table, [name for name, _ in columns])
+            if fmt == 'csv':
+                with open(table_path(directory, table, fmt), 'w', encoding='utf-8', newline='') as f:
+                    counts[table] = write_csv(f, columns, chunks)
+            else:
+                with open(table_path(directory, table, fmt), 'wb') as f:
+                    counts[table] = write_columnar(f, table, columns, chunks)
+    return counts
+
+
+# Загрузка каждой таблицы одной транзакцией: индексы таблицы удаляются и
+# строятся заново после вставки — один проход сортировки вместо обновления
+# индекса на каждой строке. Ошибка в любой строке откатывает всю таблицу
+def import_tables(manager, directory, tables=TABLES, fmt='csv'):
+    counts = {}
+    for table in (table for table in TABLES if table in tables):
+        path = table_path(directory, table, fmt)
+        if not os.path.exists(path):
+            continue
+        if fmt == 'csv':
+            with open(path, encoding='utf-8', newline='') as f, manager.transaction() as conn:
+                names, chunks = read_csv(f, table_columns(conn, table))
+                counts[table] = import_rows(conn, table, names, chunks)
+        else:
+            with open(path, 'rb') as f, manager.transaction() as conn:
+                names, chunks = read_columnar(f, table_columns(conn, table))
+                counts[table] = import_rows(conn, table, names, chunks)
+    return counts
+
+
+def import_rows(conn, table, names, chunks):
+    if not names:
+        return 0
+    indexes = conn.execute(
+        "SELECT name, sql FROM sqlite_master WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL",
+        (table,)).fetchall()
+    for name, _ in indexes:
+        conn.execute(f'DROP INDEX {name}')
+    if table == 'contributions':
+        # Месячные итоги пересчитываются один раз после вставки, а не
+        # триггером на каждой строке
+        for name in migrations.ROLLUP_TRIGGERS:
+            conn.execute(f'DROP TRIGGER {name}')
+
+    insert = f'INSERT INTO {table} ({", ".join(names)}) VALUES ({", ".join("?" * len(names))})'
+    count = 0
+    for rows in chunks:
+        conn.executemany(insert, rows)
+        if table == 'savings':
+            open_balances(conn, names, rows)
+        count += len(rows)
+
+    for _, sql in indexes:
+        conn.execute(sql)
+    if table in migrations.ROLLUP_SOURCES:
+        migrations.rebuild_rollups(conn)
+    if table == 'contributions':
+        migrations.create_rollup_triggers(conn)
+    return count
+
+
+# Загруженный баланс попадает в журнал записью 'opening', как при миграции
+# журнала, иначе сверка журнала с балансами разойдётся
+def open_balances(conn, names, rows):
+    if 'balance' not in names or 'user_id' not in names:
+        return
+    user_index, balance_index = names.index('user_id'), names.index('balance')
+    created_at = now()
+    conn.executemany(INSERT_JOURNAL, (
+        (row[user_index], 'opening', int(row[balance_index]), None, created_at)
+        for row in rows if row[balance_index] not in (None, '', '0', 0)
+    ))
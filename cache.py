@@ -0,0 +1,106 @@
+import threading
+from collections import OrderedDict
+
+
+class LRUCache:
+    # Ограниченный кэш с вытеснением давно не использованных ключей.
+    # generation растёт при каждой записи и сбросе: значение, прочитанное из
+    # базы до записи, не должно затереть в кэше более новое
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._data.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self.generation += 1
+            self._store(key, value)
+
+    # Заполнение после промаха: только если с начала чтения ничего не записали
+    def fill(self, key, value, generation):
+        with self._lock:
+            if generation == self.generation:
+                self._store(key, value)
+
+    def invalidate(self, key):
+        with self._lock:
+            self.generation += 1
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            requests = self.hits + self.misses
+            return {
+                'size': len(self._data),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / requests if requests else 0.0,
+            }
+
+    def __len__(self):
+        return len(self._data)
+
+    def _store(self, key, value):
+        if self.maxsize <= 0:
+            return
+        self._data[key] = value
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+
+class RecentIds:
+    # Недавние id, которые растут по порядку (update_id Telegram), битами в
+    # кольце: помнит только последние size номеров до самого большого из
+    # добавленных. 100 000 номеров — 12,5 КБ. Работает на цикле событий,
+    # поэтому без блокировки
+    __slots__ = ('size', 'bits', 'high')
+
+    def __init__(self, size):
+        self.size = size
+        self.bits = bytearray((size + 7) // 8)
+        self.high = None
+
+    # False — не добавлялся или уже выпал из окна: тогда решает база
+    def seen(self, key):
+        if self.high is None or key > self.high or key <= self.high - self.size:
+            return False
+        index = key % self.size
+        return bool(self.bits[index >> 3] & (1 << (index & 7)))
+
+    def add(self, key):
+        if self.high is None or key > self.high:
+            if self.high is None or key - self.high >= self.size:
+                self.bits[:] = bytes(len(self.bits))
+            else:
+                # Позиции номеров, через которые окно сдвинулось, освобождаются
+                for skipped in range(self.high + 1, key):
+                    index = skipped % self.size
+                    self.bits[index >> 3] &= ~(1 << (index & 7)) & 0xFF
+            self.high = key
+        elif key <= self.high - self.size:
+            return
+        index = key % self.size
+        self.bits[index >> 3] |= 1 << (index & 7)
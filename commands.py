@@ -0,0 +1,222 @@
+import re
+from datetime import date
+
+from money import KOPECKS_PER_RUBLE, parse_money
+
+
+DAY_MONTH_RE = re.compile(r'(\d{1,2})\.(\d{1,2})', re.ASCII)
+MONTH_YEAR_RE = re.compile(r'(\d{1,2})\.(\d{4})', re.ASCII)
+
+
+class ParseError(ValueError):
+    pass
+
+
+class Command:
+    # Разобранная текстовая команда; неиспользуемые поля остаются None,
+    # amount — в копейках
+    __slots__ = ('action', 'amount', 'period', 'due_date', 'target_id', 'debt_id')
+
+    def __init__(self, action, amount=None, period=None, due_date=None, target_id=None, debt_id=None):
+        self.action = action
+        self.amount = amount
+        # (месяц, год) для взносов
+        self.period = period
+        # (день, месяц) для долгов
+        self.due_date = due_date
+        self.target_id = target_id
+        self.debt_id = debt_id
+
+    def __repr__(self):
+        fields = ', '.join(f'{name}={getattr(self, name)!r}' for name in self.__slots__
+                           if getattr(self, name) is not None)
+        return f'Command({fields})'
+
+
+def parse_amount(token, allow_zero=False, allow_negative=False):
+    if token is None:
+        raise ParseError("Некорректная сумма")
+    # Целая сумма — самый частый случай, обходится без регулярного выражения
+    if token.isascii() and token.isdigit() and len(token) <= 12:
+        amount = int(token) * KOPECKS_PER_RUBLE
+    else:
+        try:
+            amount = parse_money(token)
+        except ValueError:
+            raise ParseError("Некорректная сумма") from None
+    if amount < 0 and not allow_negative:
+        raise ParseError("Сумма не может быть отрицательной")
+    if amount == 0 and not allow_zero:
+        raise ParseError("Сумма должна быть больше нуля")
+    return amount
+
+
+def parse_day_month(token):
+    match = DAY_MONTH_RE.fullmatch(token or '')
+    if not match:
+        raise ParseError("Формат даты должен быть ДД.ММ (например 30.12)")
+    day, month = int(match.group(1)), int(match.group(2))
+    if not (1 <= day <= 31 and 1 <= month <= 12):
+        raise ParseError("Некорректная дата")
+    return day, month
+
+
+def parse_month_year(token):
+    match = MONTH_YEAR_RE.fullmatch(token or '')
+    if not match:
+        raise ParseError("Формат периода должен быть ММ.ГГГГ (например 07.2023)")
+    month, year = int(match.group(1)), int(match.group(2))
+    if not (1 <= month <= 12 and year >= 2020):
+        raise ParseError("Некорректная дата")
+    return month, year
+
+
+def parse_id(token, what):
+    if token is None or not (token.isascii() and token.isdigit() and len(token) <= 19):
+        raise ParseError(f"Некорректный ID {what}")
+    return int(token)
+
+
+def format_day_month(due_date):
+    day, month = due_date
+    return f'{day:02d}.{month:02d}'
+
+
+# Срок возврата хранится датой 'ГГГГ-ММ-ДД'. Год — ближайший, в котором
+# такой день есть в календаре и который не раньше reference (дня займа);
+# 29.02 уходит на ближайший високосный год, 31.02 не бывает никогда
+def infer_due_date(due_date, reference):
+    day, month = due_date
+    for year in range(reference.year, reference.year + 5):
+        try:
+            due = date(year, month, day)
+        except ValueError:
+            continue
+        if due >= reference:
+            return due
+    raise ParseError("Некорректная дата")
+
+
+def format_due_date(due_date):
+    if not due_date:
+        return 'не указана'
+    return f'{due_date[8:10]}.{due_date[5:7]}.{due_date[:4]}'
+
+
+# 'ГГГГ-ММ-ДД' -> 'ДД.ММ', как срок пишут в команде возврата
+def due_day_month(due_date):
+    return f'{due_date[8:10]}.{due_date[5:7]}'
+
+
+def format_month_year(period):
+    month, year = period
+    return f'{month:02d}.{year}'
+
+
+# Период месячных итогов хранится целым ГГГГММ
+def format_period(period):
+    return f'{period % 100:02d}.{period // 100}'
+
+
+def after(tokens, keyword):
+    # Слово, следующее за ключевым ('за', 'до'), или None
+    for i in range(1, len(tokens) - 1):
+        if tokens[i] == keyword:
+            return tokens[i + 1]
+    return None
+
+
+def arg(tokens, index):
+    return tokens[index] if index < len(tokens) else None
+
+
+def parse_contribute(tokens):
+    return Command('contribute', amount=parse_amount(arg(tokens, 1)),
+                   period=parse_month_year(after(tokens, 'за')))
+
+
+def parse_set_monthly(tokens):
+    if arg(tokens, 1) != 'взнос':
+        raise ParseError("Неизвестная команда")
+    return Command('set_monthly', amount=parse_amount(arg(tokens, 2), allow_zero=True))
+
+
+def parse_borrow(tokens):
+    return Command('borrow', amount=parse_amount(arg(tokens, 1)),
+                   due_date=parse_day_month(after(tokens, 'до')))
+
+
+def parse_return(tokens):
+    return Command('return', amount=parse_amount(arg(tokens, 1)),
+                   due_date=parse_day_month(after(tokens, 'за')))
+
+
+def parse_set_balance(tokens):
+    return Command('set_balance', target_id=parse_id(arg(tokens, 1), 'пользователя'),
+                   amount=parse_amount(arg(tokens, 2), allow_zero=True, allow_negative=True))
+
+
+def parse_set_contribution(tokens):
+    return Command('set_contribution', target_id=parse_id(arg(tokens, 1), 'пользователя'),
+                   amount=parse_amount(arg(tokens, 2), allow_zero=True))
+
+
+def parse_debt_edit(tokens):
+    if len(tokens) < 2:
+        raise ParseError("Недостаточно аргументов")
+    debt_id = parse_id(tokens[1], 'долга')
+    action = tokens[0]
+    if action == 'закрыть':
+        return Command('close_debt', debt_id=debt_id)
+    if action == 'долг':
+        if len(tokens) < 3:
+            raise ParseError("Не указана сумма")
+        return Command('set_debt_amount', debt_id=debt_id, amount=parse_amount(tokens[2], allow_zero=True))
+    if len(tokens) < 3:
+        raise ParseError("Не указана дата")
+    return Command('set_debt_date', debt_id=debt_id, due_date=parse_day_month(tokens[2]))
+
+
+def parse_role(tokens):
+    action = 'grant_role' if tokens[0] == 'назначить' else 'revoke_role'
+    return Command(action, target_id=parse_id(arg(tokens, 1), 'пользователя'))
+
+
+PARSERS = {
+    'вношу': parse_contribute,
+    'установить': parse_set_monthly,
+    'беру': parse_borrow,
+    'возвращаю': parse_return,
+    'баланс': parse_set_balance,
+    '/balance': parse_set_balance,
+    'взнос': parse_set_contribution,
+    '/vznos': parse_set_contribution,
+    'закрыть': parse_debt_edit,
+    'долг': parse_debt_edit,
+    'дата': parse_debt_edit,
+    'назначить': parse_role,
+    'снять': parse_role,
+}
+
+# Команды /zakrit, /dolg, /data, /grant и /revoke отличаются от текстовых только названием
+COMMAND_ALIASES = {
+    '/zakrit': 'закрыть',
+    '/dolg': 'долг',
+    '/data': 'дата',
+    '/grant': 'назначить',
+    '/revoke': 'снять',
+}
+
+
+# Один проход: нижний регистр и разбиение на слова, дальше только работа с токенами
+def parse(text):
+    tokens = text.lower().split()
+    if not tokens:
+        raise ParseError("Пустая команда")
+    word = tokens[0].split('@', 1)[0]
+    word = COMMAND_ALIASES.get(word, word)
+    tokens[0] = word
+    parser = PARSERS.get(word)
+    if parser is None:
+        raise ParseError("Неизвестная команда")
+    return parser(tokens)
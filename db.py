@@ -0,0 +1,150 @@
+import asyncio
+import contextvars
+import os
+import random
+import sqlite3
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+
+from metrics import metrics
+
+
+DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'savings_bot.db')
+
+DB_WORKERS = int(os.environ.get('DB_WORKERS', 4))
+
+# Настройки применяются один раз при открытии соединения
+PRAGMAS = (
+    # Действует только для новой базы, пока в ней нет таблиц; старую
+    # переводит maintenance.py archive --convert-vacuum
+    'PRAGMA auto_vacuum = INCREMENTAL',
+    'PRAGMA journal_mode = WAL',
+    'PRAGMA synchronous = NORMAL',
+    'PRAGMA cache_size = -8000',
+    'PRAGMA busy_timeout = 5000',
+)
+
+# Повторы транзакции, которую SQLite отклонил как занятую (SQLITE_BUSY):
+# busy_timeout ждёт только внутри одного запроса, а BEGIN IMMEDIATE при
+# конкуренции процессов может отказать сразу
+BUSY_RETRIES = int(os.environ.get('DB_BUSY_RETRIES', 5))
+BUSY_BACKOFF = 0.05
+SQLITE_BUSY = 5
+SQLITE_LOCKED = 6
+
+
+class ConnectionManager:
+    # Одно долгоживущее соединение на каждый рабочий поток диспетчера
+    def __init__(self, path=DB_PATH):
+        self.path = path
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._connections = []
+
+    def connection(self):
+        if self._pid != os.getpid():
+            # После fork (воркеры gunicorn) соединения родителя использовать нельзя
+            self._reset()
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # isolation_level=None: транзакции открываются явно через transaction()
+            conn = sqlite3.connect(self.path, check_same_thread=False,
+                                   isolation_level=None, cached_statements=256)
+            for pragma in PRAGMAS:
+                conn.execute(pragma)
+            if metrics.enabled:
+                # Счёт запросов SQL: всего и на обрабатываемое обновление
+                conn.set_trace_callback(metrics.statement)
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    # True, если с прошлой проверки в этом потоке базу изменило другое
+    # соединение: другой поток или другой процесс, например соседний воркер
+    def changed_externally(self):
+        version = self.connection().execute('PRAGMA data_version').fetchone()[0]
+        changed = version != getattr(self._local, 'data_version', None)
+        self._local.data_version = version
+        return changed
+
+    # Пишущие транзакции открываются сразу как BEGIN IMMEDIATE: отложенная
+    # транзакция, прочитав данные, не может повысить блокировку, пока пишет
+    # другой поток, и падает с «database is locked» без ожидания.
+    # Внутри процесса писатели дополнительно выстраиваются в очередь на
+    # замке, чтобы не засыпать в busy_timeout.
+    @contextmanager
+    def transaction(self, immediate=True):
+        conn = self.connection()
+        if immediate:
+            self._write_lock.acquire()
+        try:
+            conn.execute('BEGIN IMMEDIATE' if immediate else 'BEGIN')
+            try:
+                yield conn
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+            conn.execute('COMMIT')
+        finally:
+            if immediate:
+                self._write_lock.release()
+
+    def close_all(self):
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+        self._local = threading.local()
+
+
+manager = ConnectionManager()
+
+
+def get_connection():
+    return manager.connection()
+
+
+def transaction(immediate=True):
+    return manager.transaction(immediate)
+
+
+def is_busy(error):
+    code = getattr(error, 'sqlite_errorcode', None)
+    if code is not None:
+        return code & 0xff in (SQLITE_BUSY, SQLITE_LOCKED)
+    return 'database is locked' in str(error) or 'database is busy' in str(error)
+
+
+# Вызывает func целиком заново, пока база занята: экспоненциальная пауза
+# со случайной добавкой, чтобы соперники не повторяли попытку одновременно
+def retry_on_busy(func, *args, retries=None, backoff=BUSY_BACKOFF, **kwargs):
+    retries = BUSY_RETRIES if retries is None else retries
+    for attempt in range(retries + 1):
+        try:
+            return func(*args, **kwargs)
+        except sqlite3.OperationalError as e:
+            if attempt == retries or not is_busy(e):
+                raise
+            time.sleep(backoff * 2 ** attempt * (0.5 + random.random()))
+
+
+# Запросы к SQLite выполняются в отдельном пуле потоков, чтобы не блокировать
+# цикл событий; у каждого потока пула своё долгоживущее соединение
+executor = ThreadPoolExecutor(max_workers=DB_WORKERS, thread_name_prefix='sqlite')
+
+
+# Вызов идёт в копии контекста, чтобы запросы в потоке пула засчитывались
+# обновлению, которое их сделало; время операции пишется в метрики
+async def run_in_db(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(executor, partial(context.run, metrics.timed, func, *args, **kwargs))
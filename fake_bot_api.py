@@ -0,0 +1,221 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl
+
+
+class ApiError(Exception):
+    def __init__(self, status, description, parameters=None):
+        super().__init__(description)
+        self.status = status
+        self.payload = {'ok': False, 'error_code': status, 'description': description}
+        if parameters:
+            self.payload['parameters'] = parameters
+
+
+# Локальная подмена Bot API для нагрузочных тестов: отдаёт заранее
+# подготовленные обновления через getUpdates, запоминает все sendMessage
+# с моментом получения и по заказу отвечает 429 Too Many Requests
+class FakeBotAPI:
+    def __init__(self, updates=(), latency=0.0):
+        self.latency = latency
+        self.sent = []
+        self.sent_at = []
+        # (chat_id, момент) каждого ответа 429
+        self.flooded = []
+        self._floods = {}
+        self._updates = list(updates)
+        self._lock = threading.Lock()
+        self._sent_changed = threading.Condition(self._lock)
+        self._message_id = 0
+        # chat_id -> id администраторов группы для getChatAdministrators
+        self.chat_admins = {}
+        ThreadingHTTPServer.request_queue_size = 256
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address
+        return f'http://{host}:{port}/bot'
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def add_updates(self, updates):
+        with self._lock:
+            self._updates.extend(updates)
+
+    # Следующие times отправок в чат получат 429 с retry_after
+    def flood(self, chat_id, retry_after=1, times=1):
+        with self._lock:
+            self._floods[chat_id] = (retry_after, times)
+
+    def wait_sent(self, count, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._sent_changed:
+            while len(self.sent) < count:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._sent_changed.wait(remaining)
+        return True
+
+    def call(self, method, params):
+        if method == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'Копилка', 'username': 'fake_kopilka_bot'}
+        if method == 'getUpdates':
+            offset = int(params.get('offset') or 0)
+            limit = int(params.get('limit') or 100)
+            with self._lock:
+                self._updates = [u for u in self._updates if u['update_id'] >= offset]
+                batch = self._updates[:limit]
+            if not batch:
+                # Имитация long polling без пустого цикла
+                time.sleep(0.05)
+            return batch
+        if method == 'getChatAdministrators':
+            return [chat_member(user_id) for user_id in self.chat_admins.get(int(params['chat_id']), ())]
+        if method == 'sendMessage':
+            if self.latency:
+                time.sleep(self.latency)
+            chat_id = int(params['chat_id'])
+            with self._sent_changed:
+                flood = self._floods.get(chat_id)
+                if flood is not None:
+                    retry_after, times = flood
+                    if times > 1:
+                        self._floods[chat_id] = (retry_after, times - 1)
+                    else:
+                        del self._floods[chat_id]
+                    self.flooded.append((chat_id, time.monotonic()))
+                    raise ApiError(429, f'Too Many Requests: retry after {retry_after}',
+                                   {'retry_after': retry_after})
+                self._message_id += 1
+                message_id = self._message_id
+                self.sent.append((chat_id, params.get('text')))
+                self.sent_at.append(time.monotonic())
+                self._sent_changed.notify_all()
+            return {
+                'message_id': message_id,
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'text': params.get('text'),
+            }
+        return True
+
+    def _make_handler(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # keep-alive, как у настоящего Bot API
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0)).decode()
+                if self.headers.get('Content-Type', '').startswith('application/json'):
+                    params = json.loads(body or '{}')
+                else:
+                    params = dict(parse_qsl(body))
+                method = self.path.rsplit('/', 1)[-1]
+                try:
+                    status, payload = 200, {'ok': True, 'result': api.call(method, params)}
+                except ApiError as e:
+                    status, payload = e.status, e.payload
+                payload = json.dumps(payload).encode()
+                try:
+                    self.send_response(status)
+                    self.send_header('Content-Type', 'application/json')
+                    self.send_header('Content-Length', str(len(payload)))
+                    self.end_headers()
+                    self.wfile.write(payload)
+                except (BrokenPipeError, ConnectionResetError):
+                    # Клиент уже закрыл соединение при остановке
+                    pass
+
+            do_GET = do_POST
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+# Подмена объекта Bot без сети: запоминает send_message и по заказу
+# отвечает ошибками Telegram для указанных чатов. Годится и как bot для
+# Update.de_json: есть username для CommandHandler и ответы на callback
+class RecordingBot:
+    username = 'fake_kopilka_bot'
+    defaults = None
+
+    def __init__(self, errors=None):
+        self.sent = []
+        self.edited = []
+        self.errors = dict(errors or {})
+        self.chat_admins = {}
+
+    async def send_message(self, chat_id, text, **kwargs):
+        error = self.errors.pop(chat_id, None)
+        if error is not None:
+            raise error
+        self.sent.append((chat_id, text, time.monotonic()))
+        return None
+
+    async def edit_message_text(self, text, chat_id=None, message_id=None, **kwargs):
+        self.edited.append((chat_id, text, time.monotonic()))
+        return True
+
+    async def answer_callback_query(self, callback_query_id, **kwargs):
+        return True
+
+    async def get_chat_administrators(self, chat_id, **kwargs):
+        from telegram import ChatMember
+
+        return [ChatMember.de_json(chat_member(user_id), self) for user_id in self.chat_admins.get(chat_id, ())]
+
+
+# Администратор группы в ответе getChatAdministrators
+def chat_member(user_id):
+    return {'status': 'administrator', 'user': {'id': user_id, 'is_bot': False, 'first_name': 'Тест'},
+            'can_be_edited': False, 'is_anonymous': False, 'can_manage_chat': True,
+            'can_delete_messages': True, 'can_manage_video_chats': True, 'can_restrict_members': True,
+            'can_promote_members': False, 'can_change_info': True, 'can_invite_users': True}
+
+
+def make_update(update_id, user_id, text, first_name='Тест'):
+    message = {
+        'message_id': update_id,
+        'date': int(time.time()),
+        'chat': {'id': user_id, 'type': 'private'},
+        'from': {'id': user_id, 'is_bot': False, 'first_name': first_name},
+        'text': text,
+    }
+    if text.startswith('/'):
+        command = text.split()[0]
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(command)}]
+    return {'update_id': update_id, 'message': message}
+
+
+# Нажатие инлайн-кнопки под сообщением бота
+def make_callback_update(update_id, user_id, data, first_name='Тест'):
+    user = {'id': user_id, 'is_bot': False, 'first_name': first_name}
+    message = {
+        'message_id': update_id,
+        'date': int(time.time()),
+        'chat': {'id': user_id, 'type': 'private'},
+        'from': {'id': 1, 'is_bot': True, 'first_name': 'Копилка'},
+        'text': '…',
+    }
+    return {
+        'update_id': update_id,
+        'callback_query': {'id': str(update_id), 'from': user, 'chat_instance': str(user_id),
+                           'message': message, 'data': data},
+    }
@@ -0,0 +1,177 @@
+import os
+import re
+import threading
+from collections import OrderedDict
+
+import db
+from repository import SavingsRepository
+from roles import NOBODY, RoleStore
+
+
+# Копилки групповых чатов лежат отдельными файлами в этом каталоге
+GROUPS_DIR = os.environ.get('GROUPS_DIR', os.path.join(os.path.dirname(db.DB_PATH), 'groups'))
+# Личные чаты с ботом работают с основной базой, как до появления групп
+DEFAULT_GROUP = 0
+GROUP_CHATS = ('group', 'supergroup')
+# Сколько копилок групп держать открытыми: у каждой свои соединения, то
+# есть файловые дескрипторы; давно не использованные закрываются
+GROUPS_OPEN = int(os.environ.get('GROUPS_OPEN', 64))
+
+GROUP_FILE = re.compile(r'^group(-?\d+)\.db$')
+
+
+def group_of(chat):
+    return chat.id if chat is not None and chat.type in GROUP_CHATS else DEFAULT_GROUP
+
+
+class GroupRouter:
+    # Копилки групп: у каждой группы свой файл SQLite со своей схемой,
+    # итогами и журналом. Запись в одной группе не блокирует другие, а
+    # общий баланс группы — та же однострочная totals, то есть O(1).
+    # Роли группы хранятся в её файле (roles), в памяти — снимок RoleStore.
+    # Открытыми остаются limit последних групп, остальные закрываются и
+    # откроются заново при следующем обращении. Копилку, которую держит
+    # обработчик (аренда от acquire или lease до release), вытеснение не
+    # трогает: её соединения закроются, только когда аренд не останется
+    def __init__(self, directory=GROUPS_DIR, limit=GROUPS_OPEN):
+        self.directory = directory
+        self.limit = limit
+        self.evictions = 0
+        self._groups = OrderedDict()
+        self._roles = {}
+        self._leases = {}
+        self._lock = threading.Lock()
+
+    def path(self, group_id):
+        return os.path.join(self.directory, f'group{group_id}.db')
+
+    # Уже открытая копилка или None — без обращения к базе и без аренды,
+    # поэтому годится только там, где вытеснение не идёт параллельно
+    def get(self, group_id):
+        with self._lock:
+            repo = self._groups.get(group_id)
+            if repo is not None:
+                self._groups.move_to_end(group_id)
+        return repo
+
+    # Аренда уже открытой копилки или None, если группа не открыта; без
+    # обращения к базе, годится для цикла событий
+    def lease(self, group_id):
+        with self._lock:
+            repo = self._groups.get(group_id)
+            if repo is not None:
+                self._groups.move_to_end(group_id)
+                self._leases[repo] = self._leases.get(repo, 0) + 1
+        return repo
+
+    # Аренда копилки группы; при первом обращении создаёт файл и применяет
+    # миграции. Выполняется в потоке базы (run_in_db)
+    def acquire(self, group_id):
+        with self._lock:
+            repo = self._groups.get(group_id)
+            if repo is None:
+                os.makedirs(self.directory, exist_ok=True)
+                repo = SavingsRepository(db.ConnectionManager(self.path(group_id)))
+                repo.init_schema()
+                self._roles[group_id] = RoleStore(repo).reload()
+                self._groups[group_id] = repo
+            else:
+                self._groups.move_to_end(group_id)
+            self._leases[repo] = self._leases.get(repo, 0) + 1
+            idle = self._evict()
+        self._close(idle)
+        return repo
+
+    # Вернуть аренды; копилки сверх limit, которые больше никто не держит,
+    # закрываются. Выполняется в потоке базы
+    def release(self, *repos):
+        with self._lock:
+            for repo in repos:
+                # После close_all аренд уже нет
+                left = self._leases.pop(repo, 0) - 1
+                if left > 0:
+                    self._leases[repo] = left
+            idle = self._evict()
+        self._close(idle)
+
+    # Открывает копилку без аренды — для однопоточных утилит
+    def open(self, group_id):
+        repo = self.acquire(group_id)
+        self.release(repo)
+        return repo
+
+    # Убирает давно не использованные группы сверх limit, пропуская
+    # арендованные; вызывается под _lock, закрывать возвращённые — после него
+    def _evict(self):
+        idle = []
+        for group_id in list(self._groups):
+            if len(self._groups) <= self.limit:
+                break
+            repo = self._groups[group_id]
+            if repo in self._leases:
+                continue
+            del self._groups[group_id]
+            self._roles.pop(group_id, None)
+            idle.append(repo)
+            self.evictions += 1
+        return idle
+
+    def _close(self, repos):
+        for repo in repos:
+            repo.manager.close_all()
+
+    # Роли уже открытой группы; None, если группа не открыта
+    def roles(self, group_id):
+        return self._roles.get(group_id)
+
+    def admins(self, group_id):
+        store = self._roles.get(group_id)
+        return store.members() if store is not None else NOBODY
+
+    # Администраторами копилки без администраторов становятся user_ids
+    def claim(self, group_id, user_ids):
+        repo = self.acquire(group_id)
+        try:
+            return self._roles[group_id].claim(user_ids)
+        finally:
+            self.release(repo)
+
+    # Сверить снимки ролей с базой: одной группы или всех открытых.
+    # Копилки на время сверки арендуются, чтобы их не закрыло вытеснение
+    def refresh_roles(self, group_id=None):
+        if group_id is not None:
+            repos = [self.acquire(group_id)]
+            stores = [self._roles[group_id]]
+        else:
+            with self._lock:
+                repos = list(self._groups.values())
+                stores = list(self._roles.values())
+                for repo in repos:
+                    self._leases[repo] = self._leases.get(repo, 0) + 1
+        try:
+            for store in stores:
+                store.refresh()
+        finally:
+            self.release(*repos)
+
+    # Все группы, у которых есть файл, в том числе ещё не открытые
+    def group_ids(self):
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(int(match.group(1)) for match in map(GROUP_FILE.match, os.listdir(self.directory)) if match)
+
+    def stats(self):
+        return {'open': len(self._groups), 'leased': len(self._leases), 'limit': self.limit,
+                'evictions': self.evictions}
+
+    # Остановка: закрывает все копилки, в том числе арендованные
+    def close_all(self):
+        with self._lock:
+            for repo in self._groups.values():
+                repo.manager.close_all()
+            self._groups.clear()
+            self._roles.clear()
+            self._leases.clear()
+
+
+groups = GroupRouter()
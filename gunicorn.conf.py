@@ -0,0 +1,19 @@
+import asyncio
+import os
+
+
+# gunicorn -c gunicorn.conf.py webhook:app
+bind = os.environ.get('WEBHOOK_LISTEN', '0.0.0.0:8000')
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+
+
+# Миграции и регистрация webhook выполняются один раз в мастер-процессе,
+# до запуска воркеров; воркеры открывают свои соединения к SQLite сами
+def on_starting(server):
+    import db
+    import main as bot
+
+    bot.init_db()
+    if bot.WEBHOOK_URL:
+        asyncio.run(bot.register_webhook(os.environ['BOT_TOKEN'], bot.WEBHOOK_URL))
+    db.manager.close_all()
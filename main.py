@@ -2,153 +2,263 @@ import os
 from dotenv import load_dotenv
 load_dotenv()
 
+import asyncio
+import contextlib
+import contextvars
 import sqlite3
-from datetime import datetime
-from telegram import Update, ReplyKeyboardMarkup, KeyboardButton
-from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, CallbackContext
+import time
+from datetime import date
+from functools import partial
+from commands import (ParseError, format_day_month, format_due_date, format_month_year, format_period,
+                      infer_due_date, parse as parse_command)
+from db import run_in_db
+from groups import DEFAULT_GROUP, group_of, groups
+from reminders import ReminderScheduler
+from metrics import METRICS_LISTEN, instrument, metrics, serve as serve_metrics
+from cache import RecentIds
+from money import format_money
+from outbox import OUTBOX_CHAT_RATE, OUTBOX_RATE, Outbox
+from repository import (DebtNotFound, DuplicateUpdate, InsufficientFunds, ReturnExceedsDebt, SavingsRepository,
+                        UnknownUser)
+from roles import ADMIN, ROLES_REFRESH, RoleStore, watch as watch_roles
+from router import Router
+from throttle import THROTTLE, Throttle, captured_replies, throttled
+from telegram import (ChatMember, Update, ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardButton,
+                      InlineKeyboardMarkup)
+from telegram.error import TelegramError
+from telegram.ext import (Application, CallbackQueryHandler, ChatMemberHandler, CommandHandler, MessageHandler,
+                          SimpleUpdateProcessor, filters, ContextTypes)
 
 
-ADMINS = [1079919031]
+# Владельцы бота: администраторы во всех копилках, выдают и снимают роли.
+# Остальные администраторы хранятся в таблице roles
+ADMINS = frozenset(int(user_id) for user_id in os.environ.get('ADMINS', '1079919031').split(','))
 
 
-DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'savings_bot.db')
+# Сколько обновлений обрабатывается одновременно; на каждое нужен свободный
+# слот в пуле HTTP-соединений, иначе запросы копятся в очереди пула
+CONCURRENT_UPDATES = int(os.environ.get('CONCURRENT_UPDATES', 16))
 
 
-def is_admin(user_id):
-    return user_id in ADMINS
+# Режим получения обновлений: polling или webhook
+BOT_MODE = os.environ.get('BOT_MODE', 'polling')
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL')
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET', '')
+WEBHOOK_LISTEN = os.environ.get('WEBHOOK_LISTEN', '0.0.0.0:8000')
+
+# Адрес Bot API; переопределяется для локальной подмены в тестах
+BOT_API_URL = os.environ.get('BOT_API_URL')
+
+# За сколько последних месяцев показывать статистику
+STATS_MONTHS = 12
+
+# Фоновая рассылка напоминаний о взносах и просроченных долгах
+REMINDERS = os.environ.get('REMINDERS', '1') == '1'
+
+# Сколько последних update_id помнить в памяти, чтобы отбрасывать повторы
+# без обращения к базе; старше окна повтор отсекает processed_updates
+UPDATE_WINDOW = int(os.environ.get('UPDATE_WINDOW', 100000))
+
+# Копилка группы без администраторов спрашивает их у Telegram не чаще раза
+# в столько секунд, а не на каждое обновление
+ADMIN_LOOKUP_INTERVAL = 60
+
+
+repo = SavingsRepository()
+# Роли основной базы; роли групп — в groups
+roles = RoleStore(repo)
+
+
+# Владельцы бота (ADMINS) — администраторы везде, в каждой копилке есть ещё
+# свои из roles. Проверка идёт по снимку в памяти, без обращения к базе
+def is_admin(user_id, group_id=DEFAULT_GROUP):
+    if user_id in ADMINS:
+        return True
+    if group_id == DEFAULT_GROUP:
+        return roles.has(user_id)
+    return user_id in groups.admins(group_id)
+
+
+def is_group_admin(update):
+    return is_admin(update.effective_user.id, group_of(update.effective_chat))
+
+
+# Выдавать и снимать роли могут владельцы бота, а в группе — и её администраторы
+def can_manage_roles(update):
+    group_id = group_of(update.effective_chat)
+    return update.effective_user.id in ADMINS or (group_id != DEFAULT_GROUP and is_group_admin(update))
+
+
+def role_store(group_id):
+    return roles if group_id == DEFAULT_GROUP else groups.roles(group_id)
+
+
+# Копилки групп, арендованные текущим обновлением (группа -> копилка):
+# пока обновление не обработано, вытеснение их не закроет
+group_leases = contextvars.ContextVar('group_leases')
+
+
+# Область одного обновления: аренды, взятые group_repo, возвращаются в конце
+@contextlib.asynccontextmanager
+async def leased_groups():
+    leases = {}
+    token = group_leases.set(leases)
+    try:
+        yield
+    finally:
+        group_leases.reset(token)
+        if leases:
+            await run_in_db(groups.release, *leases.values())
+
+
+# Каждое обновление обрабатывается в своей области аренды копилок групп
+class LeasingUpdateProcessor(SimpleUpdateProcessor):
+    async def do_process_update(self, update, coroutine):
+        async with leased_groups():
+            await coroutine
+
+
+# Копилка чата, из которого пришло обновление: личный чат — основная база,
+# групповой — файл группы, который открывается при первом обращении и
+# арендуется до конца обновления. register=False — не заводить копилку
+# участника: обычная переписка в группе не делает его участником копилки
+async def group_repo(update, register=True):
+    group_id = group_of(update.effective_chat)
+    if group_id == DEFAULT_GROUP:
+        return repo
+    leases = group_leases.get()
+    group = leases.get(group_id)
+    if group is None:
+        group = groups.lease(group_id) or await run_in_db(groups.acquire, group_id)
+        leases[group_id] = group
+    if not groups.admins(group_id):
+        # Группу мог занять соседний процесс, пока у нас она уже была открыта
+        await run_in_db(groups.refresh_roles, group_id)
+        if not groups.admins(group_id):
+            await seed_admins(update, group_id)
+    user = update.effective_user
+    if register and user is not None and group.user_cache.get(user.id) is None:
+        # Участник группы мог ни разу не нажать /start именно в ней: его
+        # копилка в файле группы заводится при первом обращении
+        if await run_in_db(group.get_user_state, user.id) is None:
+            await add_user(group, user.id, user.username, user.first_name, user.last_name)
+    return group
+
+
+# Когда группа последний раз спрашивала администраторов у Telegram
+admin_lookups = {}
+
+
+# Администраторы копилки группы — её администраторы в Telegram (кроме
+# ботов) на момент первого обращения; дальше роли меняют «назначить» и «снять»
+async def seed_admins(update, group_id):
+    started = time.monotonic()
+    if started - admin_lookups.get(group_id, -ADMIN_LOOKUP_INTERVAL) < ADMIN_LOOKUP_INTERVAL:
+        return
+    admin_lookups[group_id] = started
+    try:
+        members = await update.get_bot().get_chat_administrators(update.effective_chat.id)
+    except TelegramError as e:
+        print(f"Ошибка получения администраторов группы {group_id}: {e}")
+        return
+    user_ids = [member.user.id for member in members if not member.user.is_bot]
+    if user_ids:
+        await run_in_db(groups.claim, group_id, user_ids)
 
 
 def init_db():
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-    cursor = conn.cursor()
-    
-    # Таблица пользователей
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS users (
-        user_id INTEGER PRIMARY KEY,
-        username TEXT,
-        first_name TEXT,
-        last_name TEXT,
-        join_date TEXT
-    )''')
-    
-    # Таблица копилок (накоплений)
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS savings (
-        user_id INTEGER PRIMARY KEY,
-        username TEXT,
-        balance REAL DEFAULT 0,
-        monthly_contribution REAL DEFAULT 0,
-        FOREIGN KEY (user_id) REFERENCES users(user_id)
-    )''')
-    
-    # Таблица долгов
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS debts (
-        debt_id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER,
-        username TEXT,
-        amount REAL,
-        due_date TEXT,
-        status TEXT DEFAULT 'active',
-        creation_date TEXT,
-        FOREIGN KEY (user_id) REFERENCES users(user_id)
-    )''')
-    
-    # Таблица взносов
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS contributions (
-        contribution_id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER,
-        username TEXT,
-        amount REAL,
-        month_year TEXT,
-        contribution_date TEXT,
-        FOREIGN KEY (user_id) REFERENCES users(user_id)
-    )''')
-    
-    conn.commit()
-    conn.close()
+    repo.init_schema()
+    roles.reload()
+
+
+# Ответы уходят через очередь отправки: обработчик не ждёт Telegram
+# и освобождается сразу после работы с базой
+def reply(update, context, text, **kwargs):
+    replies = captured_replies.get()
+    if replies is not None:
+        replies.append((text, kwargs))
+    context.bot_data['outbox'].send(update.effective_chat.id, text, **kwargs)
+
+# Движение денег не больше одного раза на обновление: Telegram доставляет
+# обновление повторно, если обработчик не успел или процесс перезапустился.
+# Уже виденное этим процессом отсекается окном в памяти, остальное —
+# таблицей processed_updates в той же транзакции, что и деньги
+async def move_money(update, context, func, *args):
+    processed = context.bot_data['processed']
+    if processed.seen(update.update_id):
+        metrics.inc('bot_duplicate_updates_total', (('source', 'memory'),))
+        raise DuplicateUpdate(update.update_id)
+    try:
+        result = await run_in_db(func, *args, update.update_id)
+    except DuplicateUpdate:
+        metrics.inc('bot_duplicate_updates_total', (('source', 'db'),))
+        processed.add(update.update_id)
+        raise
+    processed.add(update.update_id)
+    return result
 
 # Добавление пользователя после нажатия /start
-def add_user(user_id, username, first_name, last_name):
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-    cursor = conn.cursor()
-    
-    # Проверяем, есть ли уже пользователь
-    cursor.execute('SELECT 1 FROM users WHERE user_id = ?', (user_id,))
-    if not cursor.fetchone():
-        cursor.execute('''
-        INSERT INTO users (user_id, username, first_name, last_name, join_date)
-        VALUES (?, ?, ?, ?, ?)
-        ''', (user_id, username, first_name, last_name, datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
-        
-        cursor.execute('''
-        INSERT INTO savings (user_id, username, balance, monthly_contribution)
-        VALUES (?, ?, 0, 0)
-        ''', (user_id, username))
-        
-        conn.commit()
-    
-    conn.close()
+async def add_user(repo, user_id, username, first_name, last_name):
+    await run_in_db(repo.add_user, user_id, username, first_name, last_name)
     
     
 # Команда /start
-def start(update: Update, context: CallbackContext):
+@throttled()
+@instrument
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    add_user(user.id, user.username, user.first_name, user.last_name)
+    repo = await group_repo(update)
+    await add_user(repo, user.id, user.username, user.first_name, user.last_name)
     
     keyboard = [
         [KeyboardButton("👀 Мой баланс"), KeyboardButton("💰 Общий баланс")],
         [KeyboardButton("🎯 Внести в копилку"), KeyboardButton("💸 Мои взносы")],
         [KeyboardButton("🍪 Взять в долг"), KeyboardButton("🔔 Мои долги")],
-        [KeyboardButton("💪 Вернуть долг"), KeyboardButton(" 🔐 Админка")]
+        [KeyboardButton("💪 Вернуть долг"), KeyboardButton(" 🔐 Админка")],
+        [KeyboardButton("📈 Статистика")]
     ]
     reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
     
-    update.message.reply_text(
+    reply(
+        update, context,
         f"👋 Привет, {user.first_name}! Я модератор копилки ЧЕЛОВ.\n"
         "📲 Используй кнопки ниже для взаимодействия:",
         reply_markup=reply_markup
     )
 
 # Функции для работы с балансом
-def get_user_balance(user_id):
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-    cursor = conn.cursor()
-    cursor.execute('SELECT balance FROM savings WHERE user_id = ?', (user_id,))
-    balance = cursor.fetchone()[0]
-    conn.close()
-    return balance
-
-def get_total_balance():
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-    cursor = conn.cursor()
-    cursor.execute('SELECT SUM(balance) FROM savings')
-    total = cursor.fetchone()[0] or 0
-    conn.close()
-    return total
-
-def my_balance(update: Update, context: CallbackContext):
+async def get_total_balance(repo):
+    return await run_in_db(repo.get_total_balance)
+
+@throttled(cache=True)
+@instrument
+async def my_balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    repo = await group_repo(update)
     user_id = update.effective_user.id
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-    cursor = conn.cursor()
-    cursor.execute('SELECT balance, monthly_contribution FROM savings WHERE user_id = ?', (user_id,))
-    balance, monthly_contribution = cursor.fetchone()
-    conn.close()
-    
-    update.message.reply_text(
-        f"Ваш текущий баланс: {balance:.2f}\n"
-        f"Ежемесячный взнос: {monthly_contribution:.2f}"
+    try:
+        balance, monthly_contribution = await run_in_db(repo.get_savings, user_id)
+    except UnknownUser:
+        reply(update, context, "Сначала нажмите /start")
+        return
+    
+    reply(
+        update, context,
+        f"Ваш текущий баланс: {format_money(balance)}\n"
+        f"Ежемесячный взнос: {format_money(monthly_contribution)}"
     )
 
-def total_balance(update: Update, context: CallbackContext):
-    total = get_total_balance()
-    update.message.reply_text(f"Общий баланс всех пользователей: {total:.2f}")
+@throttled(cache=True)
+@instrument
+async def total_balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    total = await get_total_balance(await group_repo(update))
+    reply(update, context, f"Общий баланс всех пользователей: {format_money(total)}")
 
 # Функции для работы с копилкой
-def add_contribution(update: Update, context: CallbackContext):
-    update.message.reply_text(
+@throttled()
+@instrument
+async def add_contribution(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    reply(
+        update, context,
         "Чтобы внести деньги в копилку, отправьте сообщение в формате:\n"
         "'вношу [сумма] за [мм.гггг]'\n\n"
         "Например: 'вношу 3000 за 07.2023'\n"
@@ -157,26 +267,19 @@ def add_contribution(update: Update, context: CallbackContext):
         "Например: 'установить взнос 3000'"
     )
 
-def my_contributions(update: Update, context: CallbackContext):
+@throttled(cache=True)
+@instrument
+async def my_contributions(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    repo = await group_repo(update)
     user_id = update.effective_user.id
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-    SELECT amount, month_year, contribution_date FROM contributions 
-    WHERE user_id = ?
-    ORDER BY contribution_date DESC
-    LIMIT 10
-    ''', (user_id,))
-    
-    contributions = cursor.fetchall()
-    
-    cursor.execute('SELECT monthly_contribution FROM savings WHERE user_id = ?', (user_id,))
-    monthly_contribution = cursor.fetchone()[0]
-    
-    conn.close()
+    try:
+        monthly_contribution = await run_in_db(repo.get_monthly_contribution, user_id)
+    except UnknownUser:
+        reply(update, context, "Сначала нажмите /start")
+        return
+    contributions = await run_in_db(repo.recent_contributions, user_id, 10)
     
-    message = f"Ваш текущий ежемесячный взнос: {monthly_contribution:.2f}\n\n"
+    message = f"Ваш текущий ежемесячный взнос: {format_money(monthly_contribution)}\n\n"
     message += "Последние 10 взносов:\n"
     
     if not contributions:
@@ -184,339 +287,416 @@ def my_contributions(update: Update, context: CallbackContext):
     else:
         for amount, month_year, contribution_date in contributions:
             message += (
-                f"{amount:.2f} за {month_year} (внесено {contribution_date.split()[0]})\n"
+                f"{format_money(amount)} за {month_year} (внесено {contribution_date.split()[0]})\n"
             )
     
-    update.message.reply_text(message)
+    reply(update, context, message)
 
-def process_contribution(update: Update, user_id: int, text: str):
+@throttled()
+@instrument
+async def process_contribution(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    repo = await group_repo(update)
+    user_id = update.effective_user.id
     try:
-        conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-        cursor = conn.cursor()
-        
-         # Получаем username из таблицы users
-        cursor.execute('SELECT username FROM users WHERE user_id = ?', (user_id,))
-        user_data = cursor.fetchone()
-        username = user_data[0] if user_data else None
-        
-        if text.startswith('установить взнос'):
-            amount = float(text.split()[2])
-            conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-            cursor = conn.cursor()
-            cursor.execute('UPDATE savings SET monthly_contribution = ? WHERE user_id = ?', (amount, user_id))
-            conn.commit()
-            conn.close()
-            update.message.reply_text(f"Установлен ежемесячный взнос: {amount:.2f}")
-        elif 'за' in text:
-            parts = text.split()
-            amount = float(parts[1])
-            month_year_index = parts.index('за') + 1
-            month_year = parts[month_year_index]
-            
-            month, year = map(int, month_year.split('.'))
-            if not (1 <= month <= 12 and year >= 2020):
-                raise ValueError("Некорректная дата")
-            
-            conn = sqlite3.connect('savings_bot.db', check_same_thread=False)
-            cursor = conn.cursor()
-            
-            cursor.execute('''
-            INSERT INTO contributions (user_id, username, amount, month_year, contribution_date)
-            VALUES (?, ?, ?, ?, ?)
-            ''', (user_id, username, amount, month_year, datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
-            
-            cursor.execute('UPDATE savings SET balance = balance + ? WHERE user_id = ?', (amount, user_id))
-            
-            conn.commit()
-            conn.close()
-            
-            update.message.reply_text(
-                f"Вы внесли {amount:.2f} за {month_year}. Ваш текущий баланс: {get_user_balance(user_id):.2f}"
-            )
-    except (ValueError, IndexError) as e:
+        command = parse_command(update.message.text)
+    except ParseError as e:
         print(f"Ошибка: {e}")
-        update.message.reply_text(
+        reply(
+            update, context,
             "Некорректный формат сообщения. Примеры:\n"
             "'вношу 3000 за 07.2023'\n"
             "'установить взнос 3000'"
         )
+        return
+    
+    if command.action == 'set_monthly':
+        try:
+            await run_in_db(repo.set_monthly_contribution, user_id, command.amount)
+        except UnknownUser:
+            reply(update, context, "Сначала нажмите /start")
+            return
+        reply(update, context, f"Установлен ежемесячный взнос: {format_money(command.amount)}")
+        return
+    
+    month_year = format_month_year(command.period)
+    try:
+        balance = await move_money(update, context, repo.add_contribution, user_id, command.amount, month_year)
+    except DuplicateUpdate:
+        return
+    except UnknownUser:
+        reply(update, context, "Сначала нажмите /start")
+        return
+    
+    reply(
+        update, context,
+        f"Вы внесли {format_money(command.amount)} за {month_year}. Ваш текущий баланс: {format_money(balance)}"
+    )
+
+# Статистика по месяцам из месячных итогов: стоимость не зависит от
+# длины истории взносов
+@throttled(cache=True)
+@instrument
+async def statistics(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    repo = await group_repo(update)
+    user_id = update.effective_user.id
+    months = await run_in_db(repo.user_monthly_totals, user_id, STATS_MONTHS)
+    
+    parts = ["📈 Ваши взносы по месяцам:\n"]
+    if not months:
+        parts.append("У вас пока нет взносов.\n")
+    for period, amount, count in months:
+        line = f"{format_period(period)}: {format_money(amount)}"
+        if count > 1:
+            line += f" (взносов: {count})"
+        parts.append(line + "\n")
+    if months:
+        parts.append(f"Итого за {len(months)} мес.: {format_money(sum(amount for _, amount, _ in months))}\n")
+    
+    if is_group_admin(update):
+        totals = await run_in_db(repo.monthly_totals, STATS_MONTHS)
+        parts.append("\n💰 Копилка по месяцам:\n")
+        if not totals:
+            parts.append("Взносов пока нет.\n")
+        for period, amount, payers in totals:
+            parts.append(f"{format_period(period)}: {format_money(amount)}, внесли {payers} чел.\n")
+    
+    reply(update, context, ''.join(parts))
 
 # Функции для работы с долгами
-def borrow_money(update: Update, context: CallbackContext):
-    update.message.reply_text(
+@throttled()
+@instrument
+async def borrow_money(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    reply(
+        update, context,
         "Чтобы взять деньги в долг, отправьте сообщение в формате:\n"
         "'беру [сумма] до [дд.мм]'\n\n"
         "Например: 'беру 500 до 15.07'"
     )
 
-def return_debt(update: Update, context: CallbackContext):
-    update.message.reply_text(
+@throttled()
+@instrument
+async def return_debt(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    reply(
+        update, context,
         "Чтобы вернуть долг, отправьте сообщение в формате:\n"
         "'возвращаю [сумма] за [дд.мм]'\n\n"
         "Например: 'возвращаю 500 за 15.07'"
     )
 
-def my_debts(update: Update, context: CallbackContext):
+@throttled(cache=True)
+@instrument
+async def my_debts(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    repo = await group_repo(update)
     user_id = update.effective_user.id
-    conn = sqlite3.connect('savings_bot.db', check_same_thread=False)
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-    SELECT amount, due_date, creation_date FROM debts 
-    WHERE user_id = ? AND status = 'active'
-    ORDER BY due_date
-    ''', (user_id,))
-    
-    debts = cursor.fetchall()
-    conn.close()
+    debts = await run_in_db(repo.active_debts, user_id)
     
     if not debts:
-        update.message.reply_text("У вас нет активных долгов.")
+        reply(update, context, "У вас нет активных долгов.")
         return
     
     message = "Ваши активные долги:\n\n"
     for amount, due_date, creation_date in debts:
         message += (
-            f"Сумма: {amount:.2f}\n"
-            f"Дата возврата: {due_date}\n"
+            f"Сумма: {format_money(amount)}\n"
+            f"Дата возврата: {format_due_date(due_date)}\n"
             f"Дата взятия: {creation_date}\n\n"
         )
     
-    update.message.reply_text(message)
+    reply(update, context, message)
 
-def process_borrow(update: Update, user_id: int, text: str):
+@throttled()
+@instrument
+async def process_borrow(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    repo = await group_repo(update)
+    user_id = update.effective_user.id
     try:
-        parts = text.split()
-        amount = float(parts[1])
-        due_date_index = parts.index('до') + 1
-        due_date = parts[due_date_index]
-        
-        day, month = map(int, due_date.split('.'))
-        if not (1 <= day <= 31 and 1 <= month <= 12):
-            raise ValueError("Некорректная дата")
-        
-        total_balance = get_total_balance()
-        if amount > total_balance:
-            update.message.reply_text(
-                f"Недостаточно средств в общем балансе. Максимальная сумма для займа: {total_balance:.2f}"
-            )
-            return
-        
-        conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-        cursor = conn.cursor()
-        
-        # Получаем username из таблицы users
-        cursor.execute('SELECT username FROM users WHERE user_id = ?', (user_id,))
-        user_data = cursor.fetchone()
-        username = user_data[0] if user_data else None
-        
-        
-        cursor.execute('''
-        INSERT INTO debts (user_id, username, amount, due_date, creation_date)
-        VALUES (?, ?, ?, ?, ?)
-        ''', (user_id, username, amount, due_date, datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
-        
-        cursor.execute('UPDATE savings SET balance = balance - ? WHERE user_id = ?', (amount, user_id))
-        
-        conn.commit()
-        conn.close()
-        
-        update.message.reply_text(
-            f"Вы взяли в долг {amount:.2f} до {due_date}. Ваш текущий баланс: {get_user_balance(user_id):.2f}"
-        )
-    except (ValueError, IndexError) as e:
+        command = parse_command(update.message.text)
+        due_date = infer_due_date(command.due_date, date.today()).isoformat()
+    except ParseError as e:
         print(f"Ошибка: {e}")
-        update.message.reply_text("Некорректный формат сообщения. Пример: 'беру 500 до 15.07'")
-
-def process_return(update: Update, user_id: int, text: str):
+        reply(update, context, "Некорректный формат сообщения. Пример: 'беру 500 до 15.07'")
+        return
+    
     try:
-        parts = text.split()
-        amount = float(parts[1])
-        due_date_index = parts.index('за') + 1
-        due_date = parts[due_date_index]
-        
-        day, month = map(int, due_date.split('.'))
-        if not (1 <= day <= 31 and 1 <= month <= 12):
-            raise ValueError("Некорректная дата")
-        
-        conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-        SELECT debt_id, amount FROM debts 
-        WHERE user_id = ? AND due_date = ? AND status = 'active'
-        ''', (user_id, due_date))
-        
-        debt = cursor.fetchone()
-        
-        if not debt:
-            update.message.reply_text("Не найден активный долг с указанной датой возврата.")
-            conn.close()
-            return
-            
-        debt_id, debt_amount = debt
-        
-        if amount > debt_amount:
-            update.message.reply_text(f"Сумма возврата превышает сумму долга ({debt_amount:.2f})")
-            conn.close()
-            return
-        
-        if amount == debt_amount:
-            cursor.execute('UPDATE debts SET status = "returned" WHERE debt_id = ?', (debt_id,))
-        else:
-            cursor.execute('UPDATE debts SET amount = amount - ? WHERE debt_id = ?', (amount, debt_id))
-        
-        cursor.execute('UPDATE savings SET balance = balance + ? WHERE user_id = ?', (amount, user_id))
-        
-        conn.commit()
-        conn.close()
-        
-        update.message.reply_text(
-            f"Вы вернули {amount:.2f} за {due_date}. Ваш текущий баланс: {get_user_balance(user_id):.2f}"
+        balance = await move_money(update, context, repo.borrow, user_id, command.amount, due_date)
+    except DuplicateUpdate:
+        return
+    except InsufficientFunds as e:
+        reply(
+            update, context,
+            f"Недостаточно средств в общем балансе. Максимальная сумма для займа: {format_money(e.available)}"
         )
-    except (ValueError, IndexError) as e:
-        print(f"Ошибка: {e}")
-        update.message.reply_text("Некорректный формат сообщения. Пример: 'возвращаю 500 за 15.07'")
-
+        return
+    except UnknownUser:
+        reply(update, context, "Сначала нажмите /start")
+        return
+    
+    reply(
+        update, context,
+        f"Вы взяли в долг {format_money(command.amount)} до {format_due_date(due_date)}. Ваш текущий баланс: {format_money(balance)}"
+    )
 
-def admin_panel(update: Update, context: CallbackContext):
+@throttled()
+@instrument
+async def process_return(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    repo = await group_repo(update)
     user_id = update.effective_user.id
-    if not is_admin(user_id):
-        update.message.reply_text("🚫 У вас нет прав доступа к админ-панели")
+    try:
+        command = parse_command(update.message.text)
+    except ParseError as e:
+        print(f"Ошибка: {e}")
+        reply(update, context, "Некорректный формат сообщения. Пример: 'возвращаю 500 за 15.07'")
+        return
+    
+    amount = command.amount
+    due_date = format_day_month(command.due_date)
+    try:
+        balance = await move_money(update, context, repo.repay, user_id, amount, due_date)
+    except DuplicateUpdate:
+        return
+    except DebtNotFound:
+        reply(update, context, "Не найден активный долг с указанной датой возврата.")
+        return
+    except ReturnExceedsDebt as e:
+        reply(update, context, f"Сумма возврата превышает сумму долга ({format_money(e.debt_amount)})")
+        return
+    
+    reply(
+        update, context,
+        f"Вы вернули {format_money(amount)} за {due_date}. Ваш текущий баланс: {format_money(balance)}"
+    )
+
+@throttled()
+@instrument
+async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_group_admin(update):
+        reply(update, context, "🚫 У вас нет прав доступа к админ-панели")
         return
     
     keyboard = [
         [KeyboardButton("👥 Список пользователей")],
         [KeyboardButton("📊 Изменить баланс"), KeyboardButton("📝 Изменить взнос")],
         [KeyboardButton("📋 Список долгов"), KeyboardButton("✏️ Редактировать долг")],
+        [KeyboardButton("🛡 Администраторы")],
         [KeyboardButton("🔙 Назад")]
     ]
     reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
     
-    update.message.reply_text(
+    reply(
+        update, context,
         "👮‍♂️ Админ-панель:\n"
         "Выберите действие:",
         reply_markup=reply_markup
     )
 
-def list_users(update: Update, context: CallbackContext):
-    if not is_admin(update.effective_user.id):
-        return
-    
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-    cursor = conn.cursor()
-    cursor.execute('SELECT user_id, username, first_name, last_name, join_date FROM users')
-    users = cursor.fetchall()
-    conn.close()
-    
-    message = "👥 Список пользователей:\n\n"
-    for user_id, username, first_name, last_name, join_date in users:
-        balance = get_user_balance(user_id)
-        message += (
+def format_users_page(rows):
+    parts = ["👥 Список пользователей:\n\n"]
+    for user_id, username, first_name, last_name, join_date, balance in rows:
+        parts.append(
             f"ID: {user_id}\n"
             f"Имя: {first_name} {last_name}\n"
             f"Юзернейм: @{username}\n"
-            f"Баланс: {balance:.2f}\n"
+            f"Баланс: {format_money(balance)}\n"
             f"Дата регистрации: {join_date}\n\n"
         )
+    return ''.join(parts)
+
+@throttled(cache=True)
+@instrument
+async def list_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    repo = await group_repo(update)
+    if not is_group_admin(update):
+        return
     
-    update.message.reply_text(message)
+    text, reply_markup = await render_page(repo, 'users')
+    reply(update, context, text, reply_markup=reply_markup)
 
-def change_balance(update: Update, context: CallbackContext):
-    if not is_admin(update.effective_user.id):
+@throttled()
+@instrument
+async def change_balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_group_admin(update):
         return
     
-    update.message.reply_text(
+    reply(
+        update, context,
         "Чтобы изменить баланс пользователя, отправьте сообщение в формате:\n"
         "'баланс [ID пользователя] [новая сумма]'\n\n"
         "Например: 'баланс 123456789 5000'"
     )
 
-def process_balance_change(update: Update, context: CallbackContext):
-    if not is_admin(update.effective_user.id):
+@throttled()
+@instrument
+async def process_balance_change(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    repo = await group_repo(update)
+    if not is_group_admin(update):
         return
     
     try:
-        parts = update.message.text.split()
-        user_id = int(parts[1])
-        new_balance = float(parts[2])
-        
-        conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-        cursor = conn.cursor()
-        cursor.execute('UPDATE savings SET balance = ? WHERE user_id = ?', (new_balance, user_id))
-        conn.commit()
-        conn.close()
-        
-        update.message.reply_text(f"✅ Баланс пользователя {user_id} изменен на {new_balance:.2f}")
-    except (IndexError, ValueError) as e:
-        update.message.reply_text("❌ Ошибка формата. Пример: 'баланс 123456789 5000'")
-
-def change_contribution(update: Update, context: CallbackContext):
-    if not is_admin(update.effective_user.id):
-        return
-    
-    update.message.reply_text(
+        command = parse_command(update.message.text)
+    except ParseError:
+        reply(update, context, "❌ Ошибка формата. Пример: 'баланс 123456789 5000'")
+        return
+    
+    try:
+        await run_in_db(repo.set_balance, command.target_id, command.amount)
+    except UnknownUser:
+        reply(update, context, f"❌ Пользователь {command.target_id} не найден")
+        return
+    
+    reply(update, context, f"✅ Баланс пользователя {command.target_id} изменен на {format_money(command.amount)}")
+
+@throttled()
+@instrument
+async def change_contribution(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_group_admin(update):
+        return
+    
+    reply(
+        update, context,
         "Чтобы изменить ежемесячный взнос пользователя, отправьте сообщение в формате:\n"
         "'взнос [ID пользователя] [новая сумма]'\n\n"
         "Например: 'взнос 123456789 3000'"
     )
 
-def process_contribution_change(update: Update, context: CallbackContext):
-    if not is_admin(update.effective_user.id):
+@throttled()
+@instrument
+async def process_contribution_change(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    repo = await group_repo(update)
+    if not is_group_admin(update):
+        return
+    
+    try:
+        command = parse_command(update.message.text)
+    except ParseError:
+        reply(update, context, "❌ Ошибка формата. Пример: 'взнос 123456789 3000'")
+        return
+    
+    try:
+        await run_in_db(repo.set_monthly_contribution, command.target_id, command.amount)
+    except UnknownUser:
+        reply(update, context, f"❌ Пользователь {command.target_id} не найден")
+        return
+    
+    reply(update, context, f"✅ Взнос пользователя {command.target_id} изменен на {format_money(command.amount)}")
+
+@throttled()
+@instrument
+async def list_admins(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await group_repo(update)
+    if not is_group_admin(update):
+        return
+    
+    admins = sorted(role_store(group_of(update.effective_chat)).members())
+    parts = ["🛡 Администраторы копилки:\n"]
+    parts.append(''.join(f"ID: {user_id}\n" for user_id in admins) or "Пока только владельцы бота\n")
+    parts.append(
+        "\nЧтобы назначить или снять администратора, отправьте сообщение в формате:\n"
+        "'назначить [ID пользователя]' или 'снять [ID пользователя]'"
+    )
+    reply(update, context, ''.join(parts))
+
+@throttled()
+@instrument
+async def process_role_change(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await group_repo(update)
+    if not is_group_admin(update):
+        return
+    if not can_manage_roles(update):
+        reply(update, context, "🚫 Назначать администраторов могут только владельцы бота")
         return
     
     try:
-        parts = update.message.text.split()
-        user_id = int(parts[1])
-        new_contribution = float(parts[2])
-        
-        conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-        cursor = conn.cursor()
-        cursor.execute('UPDATE savings SET monthly_contribution = ? WHERE user_id = ?', (new_contribution, user_id))
-        conn.commit()
-        conn.close()
-        
-        update.message.reply_text(f"✅ Взнос пользователя {user_id} изменен на {new_contribution:.2f}")
-    except (IndexError, ValueError) as e:
-        update.message.reply_text("❌ Ошибка формата. Пример: 'взнос 123456789 3000'")
-
-def list_debts(update: Update, context: CallbackContext):
-    if not is_admin(update.effective_user.id):
-        return
-    
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-    cursor = conn.cursor()
-    cursor.execute('''
-    SELECT d.debt_id, d.user_id, u.first_name, u.last_name, d.amount, d.due_date, d.status 
-    FROM debts d
-    JOIN users u ON d.user_id = u.user_id
-    ORDER BY d.status, d.due_date
-    ''')
-    
-    debts = cursor.fetchall()
-    conn.close()
+        command = parse_command(update.message.text)
+    except ParseError:
+        reply(update, context, "❌ Ошибка формата. Пример: 'назначить 123456789'")
+        return
     
-    if not debts:
-        update.message.reply_text("Нет активных долгов.")
+    group_id = group_of(update.effective_chat)
+    store = role_store(group_id)
+    target_id = command.target_id
+    if command.action == 'grant_role':
+        if await run_in_db(store.grant, target_id, ADMIN, update.effective_user.id):
+            reply(update, context, f"✅ Пользователь {target_id} назначен администратором")
+        else:
+            reply(update, context, f"Пользователь {target_id} уже администратор")
         return
     
-    message = "📋 Список всех долгов:\n\n"
-    for debt_id, user_id, first_name, last_name, amount, due_date, status in debts:
-        message += (
+    # Последнего администратора группы снять нельзя: иначе копилку заново
+    # заняли бы администраторы группы в Telegram (getChatAdministrators при
+    # следующем обращении) или тот, кто снова добавит бота (my_chat_member)
+    if await run_in_db(store.revoke, target_id, ADMIN, group_id != DEFAULT_GROUP):
+        reply(update, context, f"✅ Пользователь {target_id} больше не администратор")
+    elif target_id in store.members():
+        reply(update, context, "❌ Нельзя снять последнего администратора группы")
+    elif target_id in ADMINS:
+        reply(update, context, f"❌ Пользователь {target_id} — владелец бота, его права задаются в ADMINS")
+    else:
+        reply(update, context, f"Пользователь {target_id} не администратор")
+
+def format_debts_page(rows):
+    parts = ["📋 Активные долги:\n\n"]
+    for debt_id, user_id, first_name, last_name, amount, due_date in rows:
+        parts.append(
             f"ID долга: {debt_id}\n"
             f"Пользователь: {first_name} {last_name} (ID: {user_id})\n"
-            f"Сумма: {amount:.2f}\n"
-            f"Дата возврата: {due_date}\n"
-            f"Статус: {'✅ Погашен' if status == 'returned' else '⚠️ Активен'}\n\n"
+            f"Сумма: {format_money(amount)}\n"
+            f"Дата возврата: {format_due_date(due_date)}\n\n"
         )
+    return ''.join(parts)
+
+@throttled(cache=True)
+@instrument
+async def list_debts(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    repo = await group_repo(update)
+    if not is_group_admin(update):
+        return
     
-    update.message.reply_text(message)
+    text, reply_markup = await render_page(repo, 'debts')
+    reply(update, context, text, reply_markup=reply_markup)
+
+# Постраничные списки админки: вид -> (запрос страницы, оформление, текст для пустого списка)
+PAGES = {
+    'users': ('users_page', format_users_page, "Пользователей пока нет."),
+    'debts': ('active_debts_page', format_debts_page, "Нет активных долгов."),
+}
+
+async def render_page(repo, kind, cursor=None, backward=False):
+    method, format_page, empty_text = PAGES[kind]
+    rows, has_prev, has_next = await run_in_db(getattr(repo, method), cursor, backward)
+    if not rows:
+        return empty_text, None
+    
+    # В callback_data хранится только курсор: id крайней строки страницы
+    buttons = []
+    if has_prev:
+        buttons.append(InlineKeyboardButton("⬅️ Назад", callback_data=f"{kind}:prev:{rows[0][0]}"))
+    if has_next:
+        buttons.append(InlineKeyboardButton("Вперёд ➡️", callback_data=f"{kind}:next:{rows[-1][0]}"))
+    return format_page(rows), InlineKeyboardMarkup([buttons]) if buttons else None
+
+# Нажатие «Назад»/«Вперёд» под списком: страница заменяет текст того же сообщения
+@throttled()
+@instrument
+async def handle_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    repo = await group_repo(update)
+    if not is_group_admin(update):
+        await query.answer()
+        return
+    
+    kind, direction, cursor = query.data.split(':')
+    text, reply_markup = await render_page(repo, kind, int(cursor), backward=direction == 'prev')
+    await query.edit_message_text(text, reply_markup=reply_markup)
+    await query.answer()
 
-def edit_debt(update: Update, context: CallbackContext):
-    if not is_admin(update.effective_user.id):
+@throttled()
+@instrument
+async def edit_debt(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_group_admin(update):
         return
     
-    update.message.reply_text(
+    reply(
+        update, context,
         "Редактирование долга:\n"
         "1. Чтобы закрыть долг, отправьте 'закрыть [ID долга]'\n"
         "2. Чтобы изменить сумму, отправьте 'долг [ID долга] [новая сумма]'\n"
@@ -527,132 +707,252 @@ def edit_debt(update: Update, context: CallbackContext):
         "'дата 1 30.12'"
     )
 
-def process_debt_edit(update: Update, context: CallbackContext):
-    if not is_admin(update.effective_user.id):
+@throttled()
+@instrument
+async def process_debt_edit(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    repo = await group_repo(update)
+    if not is_group_admin(update):
+        return
+    
+    try:
+        command = parse_command(update.message.text)
+    except ParseError as e:
+        reply(update, context, f"❌ Ошибка: {str(e)}\nПримеры:\n'закрыть 1'\n'долг 1 1500'\n'дата 1 30.12'")
         return
     
+    debt_id = command.debt_id
     try:
-        text = update.message.text.lower().strip()
-        parts = text.split()
-        if len(parts) < 2:
-            raise ValueError("Недостаточно аргументов")
+        # Проверка существования долга
+        if not await run_in_db(repo.debt_exists, debt_id):
+            reply(update, context, f"❌ Долг с ID {debt_id} не найден")
+            return
+
+        if command.action == 'close_debt':
+            await run_in_db(repo.close_debt, debt_id)
+            reply(update, context, f"✅ Долг {debt_id} помечен как погашенный")
             
-        action = parts[0]
-        debt_id = int(parts[1])
-        
-        conn = None
-        try:
-            conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-            cursor = conn.cursor()
+        elif command.action == 'set_debt_amount':
+            await run_in_db(repo.set_debt_amount, debt_id, command.amount)
+            reply(update, context, f"✅ Сумма долга {debt_id} изменена на {format_money(command.amount)}")
             
-            # Проверка существования долга
-            cursor.execute('SELECT 1 FROM debts WHERE debt_id = ?', (debt_id,))
-            if not cursor.fetchone():
-                update.message.reply_text(f"❌ Долг с ID {debt_id} не найден")
+        elif command.action == 'set_debt_date':
+            try:
+                new_date = infer_due_date(command.due_date, date.today()).isoformat()
+            except ParseError:
+                reply(update, context, "❌ Некорректная дата")
                 return
+            await run_in_db(repo.set_debt_due_date, debt_id, new_date)
+            reply(update, context, f"✅ Дата долга {debt_id} изменена на {format_due_date(new_date)}")
+            
+    except sqlite3.Error as e:
+        reply(update, context, f"❌ Ошибка базы данных: {str(e)}")
 
-            if action == 'закрыть':
-                cursor.execute('UPDATE debts SET status = "returned" WHERE debt_id = ?', (debt_id,))
-                conn.commit()
-                update.message.reply_text(f"✅ Долг {debt_id} помечен как погашенный")
-                
-            elif action == 'долг':
-                if len(parts) < 3:
-                    raise ValueError("Не указана сумма")
-                new_amount = float(parts[2])
-                cursor.execute('UPDATE debts SET amount = ? WHERE debt_id = ?', (new_amount, debt_id))
-                conn.commit()
-                update.message.reply_text(f"✅ Сумма долга {debt_id} изменена на {new_amount:.2f}")
-                
-            elif action == 'дата':
-                if len(parts) < 3:
-                    raise ValueError("Не указана дата")
-                new_date = parts[2]
-                try:
-                    day, month = map(int, new_date.split('.'))
-                    if not (1 <= day <= 31 and 1 <= month <= 12):
-                        raise ValueError("Некорректная дата")
-                except:
-                    raise ValueError("Формат даты должен быть ДД.ММ (например 30.12)")
-                
-                cursor.execute('UPDATE debts SET due_date = ? WHERE debt_id = ?', (new_date, debt_id))
-                conn.commit()
-                update.message.reply_text(f"✅ Дата долга {debt_id} изменена на {new_date}")
-                
-            else:
-                update.message.reply_text("❌ Неизвестная команда. Используйте: закрыть, долг или дата")
-                
-        except sqlite3.Error as e:
-            update.message.reply_text(f"❌ Ошибка базы данных: {str(e)}")
-        finally:
-            if conn:
-                conn.close()
-                
-    except (IndexError, ValueError) as e:
-        update.message.reply_text(f"❌ Ошибка: {str(e)}\nПримеры:\n'закрыть 1'\n'долг 1 1500'\n'дата 1 30.12'")
-
-def back_to_main(update: Update, context: CallbackContext):
+@throttled()
+@instrument
+async def back_to_main(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     keyboard = [
         [KeyboardButton("👀 Мой баланс"), KeyboardButton("💰 Общий баланс")],
         [KeyboardButton("🎯 Внести в копилку"), KeyboardButton("💸 Мои взносы")],
         [KeyboardButton("🍪 Взять в долг"), KeyboardButton("🔔 Мои долги")],
-        [KeyboardButton("💪 Вернуть долг"), KeyboardButton("🔐 Админка")]
+        [KeyboardButton("💪 Вернуть долг"), KeyboardButton("🔐 Админка")],
+        [KeyboardButton("📈 Статистика")]
     ]
     reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
     
-    update.message.reply_text(
+    reply(
+        update, context,
         f"Главное меню, {user.first_name}!",
         reply_markup=reply_markup
     )
 
 
-# Обработка текстовых сообщений
-def handle_text(update: Update, context: CallbackContext):
-    text = update.message.text.lower()
-    user_id = update.effective_user.id
+@throttled()
+@instrument
+async def unknown_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    reply(update, context, "❌ Неизвестная команда")
+
+# /stats: сводка метрик процесса для владельцев бота; полные гистограммы — на /metrics
+@throttled()
+@instrument
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in ADMINS:
+        return
     
-    if is_admin(user_id):
-        if text.startswith(('закрыть ', 'долг ', 'дата ')):
-            process_debt_edit(update, context)
-            return
-        
-        
-    if is_admin(user_id):
-        if text.startswith(('баланс')):
-            process_balance_change(update, context)
-            return
+    histograms = sorted(metrics.histograms.items())
+    parts = ["📊 Обработчики (число, p50 / p95, ошибки):\n"]
+    for (name, labels), histogram in histograms:
+        if name != 'bot_handler_seconds':
+            continue
+        errors = metrics.counters.get(('bot_handler_errors_total', labels), 0)
+        statements = metrics.histograms.get(('bot_update_statements', labels))
+        parts.append(
+            f"{labels[0][1]}: {histogram.count}, "
+            f"{histogram.quantile(0.5) * 1000:g} / {histogram.quantile(0.95) * 1000:g} мс, "
+            f"ошибок {errors}, SQL p95 {statements.quantile(0.95) if statements else 0:g}\n"
+        )
+    parts.append("\n🗄 Операции с базой (число, p95, медленных):\n")
+    for (name, labels), histogram in histograms:
+        if name != 'bot_db_seconds':
+            continue
+        slow = metrics.counters.get(('bot_db_slow_total', labels), 0)
+        parts.append(f"{labels[0][1]}: {histogram.count}, {histogram.quantile(0.95) * 1000:g} мс, {slow}\n")
+    parts.append(f"Запросов SQL всего: {metrics.statements()}\n")
+    for group, values in metrics.gauge_values().items():
+        parts.append(f"\n{group}: " + ', '.join(
+            f"{key} {value:.2f}" if isinstance(value, float) else f"{key} {value}" for key, value in values.items()))
+    if not metrics.enabled:
+        parts.append("\n\nСбор метрик выключен (METRICS=0)")
+    
+    reply(update, context, ''.join(parts))
+
+
+# Маршруты текстовых сообщений: кнопки и текстовые команды
+router = Router(is_admin)
+router.button("👀 Мой баланс", my_balance)
+router.button("💰 Общий баланс", total_balance)
+router.button("🎯 Внести в копилку", add_contribution)
+router.button("💸 Мои взносы", my_contributions)
+router.button("🍪 Взять в долг", borrow_money)
+router.button("💪 Вернуть долг", return_debt)
+router.button("🔔 Мои долги", my_debts)
+router.button("📈 Статистика", statistics)
+router.button("🔐 Админка", admin_panel)
+router.button("👥 Список пользователей", list_users)
+router.button("📊 Изменить баланс", change_balance)
+router.button("📝 Изменить взнос", change_contribution)
+router.button("📋 Список долгов", list_debts)
+router.button("✏️ Редактировать долг", edit_debt)
+router.button("🛡 Администраторы", list_admins)
+router.button("🔙 Назад", back_to_main)
+
+router.command("беру", process_borrow, requires="до")
+router.command("возвращаю", process_return, requires="за")
+router.command("вношу", process_contribution)
+router.command("установить взнос", process_contribution)
+router.command("баланс", process_balance_change, admin=True)
+router.command("взнос", process_contribution_change, admin=True)
+router.command("закрыть", process_debt_edit, admin=True)
+router.command("долг", process_debt_edit, admin=True)
+router.command("дата", process_debt_edit, admin=True)
+router.command("назначить", process_role_change, admin=True)
+router.command("снять", process_role_change, admin=True)
+router.fallback = unknown_command
+
+
+# Бота добавили в группу: копилку сразу занимают администраторы группы,
+# а если Telegram их не отдал — тот, кто добавил бота
+@instrument
+async def bot_added(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    group_id = group_of(update.effective_chat)
+    if group_id == DEFAULT_GROUP or update.my_chat_member.new_chat_member.status in (ChatMember.LEFT,
+                                                                                     ChatMember.BANNED):
+        return
+    await group_repo(update, register=False)
+    if not groups.admins(group_id):
+        await run_in_db(groups.claim, group_id, [update.my_chat_member.from_user.id])
+
+
+# Обработка текстовых сообщений
+async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    group_id = group_of(update.effective_chat)
+    if group_id != DEFAULT_GROUP:
+        # Права в группе проверяются по её администраторам: копилка должна
+        # быть открыта. Участника заводит обработчик распознанной команды
+        await group_repo(update, register=False)
+    # Переписка в группе — не команды боту: на неё бот не отвечает
+    await router.dispatch(update, context, group_id, fallback=group_id == DEFAULT_GROUP)
+            
+            
+async def start_reminders(application):
+    scheduler = ReminderScheduler(application.bot, repo, outbox=application.bot_data['outbox'])
+    application.bot_data['reminders'] = scheduler
+    scheduler.start()
+
+
+# Снимки ролей всех открытых копилок сверяются с базой раз в ROLES_REFRESH секунд
+def refresh_roles():
+    roles.refresh()
+    groups.refresh_roles()
+
+
+async def start_background(application, reminders=REMINDERS):
+    application.bot_data['roles'] = asyncio.create_task(watch_roles(refresh_roles, ROLES_REFRESH))
+    if reminders:
+        await start_reminders(application)
+
+
+# После остановки приёма обновлений: сверка ролей, напоминания, затем
+# доотправка очереди, пока HTTP-клиент бота ещё открыт
+async def stop_sending(application):
+    watcher = application.bot_data.pop('roles', None)
+    if watcher is not None:
+        watcher.cancel()
+    scheduler = application.bot_data.pop('reminders', None)
+    if scheduler is not None:
+        await scheduler.stop()
+    await application.bot_data['outbox'].stop()
+
+
+def build_application(token, concurrent_updates=CONCURRENT_UPDATES, base_url=BOT_API_URL, reminders=REMINDERS,
+                      send_rate=OUTBOX_RATE, chat_rate=OUTBOX_CHAT_RATE, throttling=THROTTLE):
+    workers = max(int(concurrent_updates), 1)
+    builder = (
+        Application.builder()
+        .token(token)
+        .concurrent_updates(LeasingUpdateProcessor(workers))
+        .connection_pool_size(workers)
+        .pool_timeout(30)
+        .post_init(partial(start_background, reminders=reminders))
+        .post_stop(stop_sending)
+    )
+    if base_url:
+        builder = builder.base_url(base_url)
+    application = builder.build()
+    outbox = application.bot_data['outbox'] = Outbox(application.bot, rate=send_rate, chat_rate=chat_rate)
+    application.bot_data['processed'] = RecentIds(UPDATE_WINDOW)
+    # Жетоны и кэш ответов перед обработчиками; None — без ограничений
+    throttle = application.bot_data['throttle'] = Throttle() if throttling else None
+    metrics.gauges('outbox', outbox.stats)
+    metrics.gauges('user_cache', repo.user_cache.stats)
+    metrics.gauges('groups', groups.stats)
+    if throttle is not None:
+        metrics.gauges('throttle', throttle.stats)
+    metrics.gauges('roles', lambda: {'admins': len(roles.members()), 'revision': roles.revision or 0})
     
+    # Основные команды
+    application.add_handler(CommandHandler("start", start))
+    application.add_handler(ChatMemberHandler(bot_added, ChatMemberHandler.MY_CHAT_MEMBER))
     
-    if is_admin(user_id):
-        if text.startswith(('взнос')):
-            process_contribution_change(update, context)
-            return
+    # Обработчики команд админ-панели
+    application.add_handler(CommandHandler("balance", process_balance_change))
+    application.add_handler(CommandHandler("vznos", process_contribution_change))
+    application.add_handler(CommandHandler("zakrit", process_debt_edit))
+    application.add_handler(CommandHandler("dolg", process_debt_edit))
+    application.add_handler(CommandHandler("data", process_debt_edit))
+    application.add_handler(CommandHandler("grant", process_role_change))
+    application.add_handler(CommandHandler("revoke", process_role_change))
+    application.add_handler(CommandHandler("stats", stats))
+    
+    # Листание списков админки
+    application.add_handler(CallbackQueryHandler(handle_page, pattern=r'^(users|debts):(prev|next):-?\d+$'))
     
+    # Обработчик текстовых сообщений
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text))
     
-    if text.startswith('беру') and 'до' in text:
-        process_borrow(update, user_id, text)
-    elif text.startswith('возвращаю') and 'за' in text:
-        process_return(update, user_id, text)
-    elif text.startswith('вношу') or text.startswith('установить взнос'):
-        process_contribution(update, user_id, text)
-    elif is_admin(user_id):
-        if text == '👥 список пользователей':
-            list_users(update, context)
-        elif text == '📊 изменить баланс':
-            change_balance(update, context)
-        elif text == '📝 изменить взнос':
-            change_contribution(update, context)
-        elif text == '📋 список долгов':
-            list_debts(update, context)
-        elif text == '✏️ редактировать долг':
-            edit_debt(update, context)
-        elif text == '🔙 назад':
-            back_to_main(update, context)
-    else:
-        update.message.reply_text("❌ Неизвестная команда")
-            
-            
+    return application
+
+
+async def register_webhook(token, url):
+    application = build_application(token)
+    async with application:
+        await application.bot.set_webhook(
+            url,
+            secret_token=WEBHOOK_SECRET or None,
+            allowed_updates=Update.ALL_TYPES,
+        )
+
+
 def main():
     init_db()
 
@@ -662,41 +962,23 @@ def main():
         print("Ошибка: не указан токен бота в переменных окружения")
         return
     
-    updater = Updater(TOKEN, use_context=True)
-    dispatcher = updater.dispatcher
-    
-    # Основные команды
-    dispatcher.add_handler(CommandHandler("start", start))
-    
-    # Обработчики кнопок
-    dispatcher.add_handler(MessageHandler(Filters.regex('^👀 Мой баланс$'), my_balance))
-    dispatcher.add_handler(MessageHandler(Filters.regex('^💰 Общий баланс$'), total_balance))
-    dispatcher.add_handler(MessageHandler(Filters.regex('^🎯 Внести в копилку$'), add_contribution))
-    dispatcher.add_handler(MessageHandler(Filters.regex('^💸 Мои взносы$'), my_contributions))
-    dispatcher.add_handler(MessageHandler(Filters.regex('^🍪 Взять в долг$'), borrow_money))
-    dispatcher.add_handler(MessageHandler(Filters.regex('^💪 Вернуть долг$'), return_debt))
-    dispatcher.add_handler(MessageHandler(Filters.regex('^🔔 Мои долги$'), my_debts))
-    dispatcher.add_handler(MessageHandler(Filters.regex('^🔐 Админка$'), admin_panel))
-    dispatcher.add_handler(MessageHandler(Filters.regex('^👥 Список пользователей$'), list_users))
-    dispatcher.add_handler(MessageHandler(Filters.regex('^📊 Изменить баланс$'), change_balance))
-    dispatcher.add_handler(MessageHandler(Filters.regex('^📝 Изменить взнос$'), change_contribution))
-    dispatcher.add_handler(MessageHandler(Filters.regex('^📋 Список долгов$'), list_debts))
-    dispatcher.add_handler(MessageHandler(Filters.regex('^✏️ Редактировать долг$'), edit_debt))
-    dispatcher.add_handler(MessageHandler(Filters.regex('^🔙 Назад$'), back_to_main))
-    
-    # Обработчики команд админ-панели
-    dispatcher.add_handler(CommandHandler("balance", process_balance_change))
-    dispatcher.add_handler(CommandHandler("vznos", process_contribution_change))
-    dispatcher.add_handler(CommandHandler("zakrit", process_debt_edit))
-    dispatcher.add_handler(CommandHandler("dolg", process_debt_edit))
-    dispatcher.add_handler(CommandHandler("data", process_debt_edit))
+    if METRICS_LISTEN:
+        serve_metrics(METRICS_LISTEN)
     
-    # Обработчик текстовых сообщений
-    dispatcher.add_handler(MessageHandler(Filters.text & ~Filters.command, handle_text))
+    if BOT_MODE == 'webhook':
+        # Для нескольких воркеров: gunicorn -c gunicorn.conf.py webhook:app
+        import webhook
+        if not WEBHOOK_URL:
+            print("Ошибка: для режима webhook нужен WEBHOOK_URL")
+            return
+        asyncio.run(register_webhook(TOKEN, WEBHOOK_URL))
+        host, port = WEBHOOK_LISTEN.rsplit(':', 1)
+        webhook.create_app(lambda: build_application(TOKEN)).run(host=host, port=int(port))
+        return
     
-    updater.start_polling()
-    updater.idle()
+    application = build_application(TOKEN)
+    application.run_polling()
 
 
 if __name__ == '__main__':
-    main()           
+    main()
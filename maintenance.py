@@ -0,0 +1,217 @@
+import argparse
+import os
+import sqlite3
+import time
+
+import archive
+import bulk
+import db
+from groups import groups
+from money import format_money
+from repository import SavingsRepository
+from roles import ADMIN
+
+
+repo = SavingsRepository()
+
+
+# Сверка хранимого общего баланса с суммой по savings
+def check_total(args):
+    stored, actual = repo.check_total_balance()
+    drift = stored - actual
+    print(f"Хранимый итог:    {format_money(stored)}")
+    print(f"Пересчитанный:    {format_money(actual)}")
+    print(f"Расхождение:      {format_money(drift)}")
+    if drift == 0:
+        return 0
+    if args.fix:
+        print(f"Итог исправлен на {format_money(repo.repair_total_balance())}")
+        return 0
+    return 1
+
+
+# Сверка журнала с балансами, итогом и снимками
+def verify_journal(args):
+    started = time.perf_counter()
+    problems = repo.verify_journal()
+    print(f"Пользователей с расхождением: {problems['balances']}")
+    print(f"Несходящихся снимков:         {problems['snapshots']}")
+    print(f"Расхождение итога:            {format_money(problems['total'])}")
+    print(f"Проверено за {time.perf_counter() - started:.1f} с")
+    return 0 if not any(problems.values()) else 1
+
+
+def snapshot(args):
+    print(f"Балансы сняты до записи журнала {repo.take_snapshot()} включительно")
+    return 0
+
+
+def balance_at(args):
+    print(format_money(repo.balance_at(args.user_id, entry_id=args.entry, at=args.at)))
+    return 0
+
+
+def export_data(args):
+    started = time.perf_counter()
+    counts = bulk.export_tables(db.manager, args.directory, args.tables, args.format)
+    for table, count in counts.items():
+        print(f"{table}: {count} строк")
+    print(f"Выгружено в {args.directory} за {time.perf_counter() - started:.1f} с")
+    return 0
+
+
+def import_data(args):
+    started = time.perf_counter()
+    try:
+        counts = bulk.import_tables(db.manager, args.directory, args.tables, args.format)
+    except (sqlite3.IntegrityError, ValueError) as e:
+        # Таблица, на которой случилась ошибка, откатывается целиком
+        print(f"Ошибка загрузки: {e}")
+        return 1
+    for table, count in counts.items():
+        print(f"{table}: {count} строк")
+    print(f"Загружено из {args.directory} за {time.perf_counter() - started:.1f} с")
+    return 0
+
+
+def format_size(size):
+    return f"{size / 1024 / 1024:.1f} МБ"
+
+
+# Перенос возвращённых долгов и взносов старше горизонта в архивные
+# таблицы и возврат освободившегося места файлу. Бот может работать:
+# перенос идёт пачками по archive.ARCHIVE_BATCH строк. --reindex — только
+# в окно обслуживания: запись в базу ждёт, пока перестраиваются индексы
+def archive_data(args):
+    started = time.perf_counter()
+    before = archive.space(db.manager)
+    counts = archive.archive(db.manager, archive.horizon(args.days))
+    for table, count in counts.items():
+        print(f"{table}: в архив {count} строк")
+    if args.reindex:
+        for table in archive.reindex(db.manager, [table for table, count in counts.items() if count]):
+            print(f"{table}: индексы перестроены")
+    if args.convert_vacuum and archive.enable_incremental_vacuum(db.manager):
+        print("База переведена на auto_vacuum = INCREMENTAL (разовый VACUUM)")
+    if args.vacuum:
+        if archive.is_incremental(db.manager):
+            archive.incremental_vacuum(db.manager)
+        else:
+            print("База без auto_vacuum = INCREMENTAL: место файлу не возвращено. "
+                  "Перевод — archive --convert-vacuum (разовый VACUUM, блокирует базу)")
+    after = archive.space(db.manager)
+    if before['hot'] is not None:
+        print(f"Рабочие таблицы с индексами: {format_size(before['hot'])} -> {format_size(after['hot'])}")
+    print(f"Файл: {format_size(before['file'])} -> {format_size(after['file'])}, "
+          f"свободных страниц {before['free']} -> {after['free']}")
+    print(f"Готово за {time.perf_counter() - started:.1f} с")
+    return 0
+
+
+# Копилки групп: итог и администраторы каждой
+def list_groups(args):
+    for group_id in groups.group_ids():
+        group = groups.open(group_id)
+        admins = ', '.join(map(str, sorted(groups.admins(group_id)))) or '—'
+        print(f"{group_id}: {format_money(group.get_total_balance())}, администраторы: {admins}")
+    groups.close_all()
+    return 0
+
+
+# Роли копилки; запущенный бот подхватывает изменения за ROLES_REFRESH секунд
+def list_roles(args):
+    revision, rows = repo.roles()
+    for user_id, role in sorted(rows):
+        print(f"{user_id}: {role}")
+    print(f"Версия ролей: {revision}")
+    return 0
+
+
+def grant(args):
+    if repo.grant_role(args.user_id, args.role):
+        print(f"{args.user_id}: роль {args.role} выдана")
+    else:
+        print(f"{args.user_id}: роль {args.role} уже есть")
+    return 0
+
+
+def revoke(args):
+    if repo.revoke_role(args.user_id, args.role):
+        print(f"{args.user_id}: роль {args.role} снята")
+        return 0
+    print(f"{args.user_id}: роли {args.role} нет")
+    return 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Обслуживание базы копилки')
+    parser.add_argument('--db', default=db.DB_PATH, help='путь к файлу базы')
+    parser.add_argument('--group', type=int, help='копилка группового чата вместо основной базы')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    total = subparsers.add_parser('check-total', help='проверить общий баланс на расхождение')
+    total.add_argument('--fix', action='store_true', help='записать пересчитанное значение')
+    total.set_defaults(func=check_total)
+
+    journal = subparsers.add_parser('verify-journal', help='сверить журнал с балансами и снимками')
+    journal.set_defaults(func=verify_journal)
+
+    snapshots = subparsers.add_parser('snapshot', help='снять балансы по текущую запись журнала')
+    snapshots.set_defaults(func=snapshot)
+
+    history = subparsers.add_parser('balance-at', help='баланс пользователя на момент записи журнала или времени')
+    history.add_argument('user_id', type=int)
+    history.add_argument('--entry', type=int, help='номер записи журнала')
+    history.add_argument('--at', help="время 'ГГГГ-ММ-ДД ЧЧ:ММ:СС'")
+    history.set_defaults(func=balance_at)
+
+    for name, func, help_text in (
+        ('export', export_data, 'выгрузить таблицы в каталог'),
+        ('import', import_data, 'загрузить таблицы из каталога'),
+    ):
+        transfer = subparsers.add_parser(name, help=help_text)
+        transfer.add_argument('directory')
+        transfer.add_argument('--format', choices=sorted(bulk.EXTENSIONS), default='csv')
+        transfer.add_argument('--tables', nargs='+', choices=bulk.TABLES, default=bulk.TABLES)
+        transfer.set_defaults(func=func)
+
+    archiving = subparsers.add_parser('archive', help='перенести возвращённые долги и старые взносы в архив')
+    archiving.add_argument('--days', type=int, default=archive.ARCHIVE_HORIZON_DAYS,
+                           help='сколько дней строки остаются в рабочих таблицах')
+    archiving.add_argument('--no-vacuum', dest='vacuum', action='store_false',
+                           help='не возвращать освободившееся место файлу')
+    archiving.add_argument('--convert-vacuum', action='store_true',
+                           help='перевести старую базу на auto_vacuum = INCREMENTAL (разовый VACUUM, блокирует базу)')
+    archiving.add_argument('--reindex', action='store_true',
+                           help='перестроить разреженные индексы рабочих таблиц (блокирует запись)')
+    archiving.set_defaults(func=archive_data)
+
+    listing = subparsers.add_parser('groups', help='копилки групповых чатов')
+    listing.set_defaults(func=list_groups)
+
+    listing = subparsers.add_parser('roles', help='роли копилки')
+    listing.set_defaults(func=list_roles)
+
+    for name, func, help_text in (
+        ('grant', grant, 'выдать роль'),
+        ('revoke', revoke, 'снять роль'),
+    ):
+        changing = subparsers.add_parser(name, help=help_text)
+        changing.add_argument('user_id', type=int)
+        changing.add_argument('--role', default=ADMIN)
+        changing.set_defaults(func=func)
+
+    args = parser.parse_args()
+    path = args.db
+    if args.group is not None:
+        path = groups.path(args.group)
+        if not os.path.exists(path):
+            print(f"Копилки группы {args.group} нет")
+            return 1
+    db.manager = db.ConnectionManager(path)
+    repo.init_schema()
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,236 @@
+import contextvars
+import functools
+import os
+import threading
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# Сбор метрик можно выключить целиком: METRICS=0
+METRICS = os.environ.get('METRICS', '1') == '1'
+# Адрес HTTP-эндпоинта /metrics в формате Prometheus; пусто — не поднимать
+METRICS_LISTEN = os.environ.get('METRICS_LISTEN', '')
+# Операция с базой дольше этого попадает в журнал медленных, мс
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', 100))
+# Сколько запросов SQL показывать в журнале медленных операций
+SLOW_QUERY_STATEMENTS = 5
+
+# Границы корзин гистограмм: секунды и штуки запросов
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34)
+
+HELP = {
+    'bot_handler_seconds': ('histogram', 'Время обработки обновления, с'),
+    'bot_handler_errors_total': ('counter', 'Необработанные исключения в обработчиках'),
+    'bot_update_statements': ('histogram', 'Запросов SQL на одно обновление'),
+    'bot_db_seconds': ('histogram', 'Время операции с базой, с'),
+    'bot_db_statements_total': ('counter', 'Выполнено запросов SQL'),
+    'bot_db_slow_total': ('counter', 'Операций с базой дольше SLOW_QUERY_MS'),
+    'bot_duplicate_updates_total': ('counter', 'Отброшено повторно доставленных обновлений с движением денег'),
+    'bot_throttled_total': ('counter', 'Отброшено обновлений сверх жетонов пользователя или команды'),
+    'bot_response_cache_hits_total': ('counter', 'Ответов читающих команд из кэша без обращения к базе'),
+}
+
+
+class Histogram:
+    # Счётчики по корзинам хранятся без накопления, накопленные — только при выводе
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    # Оценка квантиля сверху: граница корзины, в которую он попадает
+    def quantile(self, share):
+        rank = share * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+
+class UpdateStats:
+    # Счётчики одного обновления; передаются в потоки базы через contextvars
+    __slots__ = ('statements',)
+
+    def __init__(self):
+        self.statements = 0
+
+
+current_update = contextvars.ContextVar('current_update', default=None)
+
+
+class Metrics:
+    # Метрики процесса: гистограммы и счётчики по (имя, метки), плюс
+    # показатели, которые считываются в момент вывода (очередь, кэш)
+    def __init__(self, enabled=METRICS, slow_ms=SLOW_QUERY_MS):
+        self.enabled = enabled
+        self.slow_ms = slow_ms
+        self.histograms = {}
+        self.counters = {}
+        self._gauges = {}
+        # Счётчик запросов SQL — по ячейке на поток, без блокировки на каждый запрос
+        self._statement_cells = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def observe(self, name, labels, value, buckets=SECONDS_BUCKETS):
+        with self._lock:
+            histogram = self.histograms.get((name, labels))
+            if histogram is None:
+                histogram = self.histograms[(name, labels)] = Histogram(buckets)
+            histogram.observe(value)
+
+    def inc(self, name, labels=(), value=1):
+        with self._lock:
+            self.counters[(name, labels)] = self.counters.get((name, labels), 0) + value
+
+    # func() -> {имя показателя: число}; повторная регистрация заменяет прежнюю
+    def gauges(self, name, func):
+        self._gauges[name] = func
+
+    # Вызывается SQLite на каждый запрос соединения (set_trace_callback)
+    def statement(self, sql):
+        cell = getattr(self._local, 'cell', None)
+        if cell is None:
+            cell = self._local.cell = [0]
+            with self._lock:
+                self._statement_cells.append(cell)
+        cell[0] += 1
+        stats = current_update.get()
+        if stats is not None:
+            stats.statements += 1
+        executed = getattr(self._local, 'executed', None)
+        if executed is not None and len(executed) < SLOW_QUERY_STATEMENTS:
+            executed.append(sql)
+
+    def statements(self):
+        with self._lock:
+            return sum(cell[0] for cell in self._statement_cells)
+
+    # Операция с базой целиком: время, а для медленных — первые запросы
+    def timed(self, func, *args, **kwargs):
+        if not self.enabled:
+            return func(*args, **kwargs)
+        self._local.executed = executed = []
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - started
+            self._local.executed = None
+            name = getattr(func, '__name__', 'db')
+            self.observe('bot_db_seconds', (('operation', name),), elapsed)
+            if elapsed * 1000 >= self.slow_ms:
+                self.inc('bot_db_slow_total', (('operation', name),))
+                print(f"Медленная операция с базой {name}: {elapsed * 1000:.0f} мс; " + ' | '.join(executed))
+
+    def render(self):
+        with self._lock:
+            histograms = sorted(self.histograms.items())
+            counters = dict(self.counters)
+        counters[('bot_db_statements_total', ())] = self.statements()
+        lines = []
+        described = set()
+
+        def describe(name, kind=None, help_text=None):
+            if name in described:
+                return
+            described.add(name)
+            kind, help_text = HELP.get(name, (kind, help_text))
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+
+        for (name, labels), histogram in histograms:
+            describe(name)
+            cumulative = 0
+            for bound, count in zip(histogram.buckets + (float('inf'),), histogram.counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f'{name}_bucket{format_labels(labels + (("le", le),))} {cumulative}')
+            lines.append(f'{name}_sum{format_labels(labels)} {histogram.sum!r}')
+            lines.append(f'{name}_count{format_labels(labels)} {histogram.count}')
+        for (name, labels), value in sorted(counters.items()):
+            describe(name)
+            lines.append(f'{name}{format_labels(labels)} {value}')
+        for group, func in sorted(self._gauges.items()):
+            for key, value in func().items():
+                name = f'bot_{group}_{key}'
+                describe(name, 'gauge', f'{group}: {key}')
+                lines.append(f'{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def gauge_values(self):
+        return {group: func() for group, func in sorted(self._gauges.items())}
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{escape(value)}"' for key, value in labels) + '}'
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+metrics = Metrics()
+
+
+# Обёртка обработчика: время, необработанные ошибки и число запросов SQL
+# на обновление; метка — имя функции обработчика
+def instrument(handler):
+    labels = (('handler', handler.__name__),)
+
+    @functools.wraps(handler)
+    async def wrapper(update, context):
+        if not metrics.enabled:
+            return await handler(update, context)
+        stats = UpdateStats()
+        token = current_update.set(stats)
+        started = time.perf_counter()
+        try:
+            return await handler(update, context)
+        except Exception:
+            metrics.inc('bot_handler_errors_total', labels)
+            raise
+        finally:
+            metrics.observe('bot_handler_seconds', labels, time.perf_counter() - started)
+            metrics.observe('bot_update_statements', labels, stats.statements, COUNT_BUCKETS)
+            current_update.reset(token)
+    return wrapper
+
+
+# Отдельный HTTP-сервер для Prometheus в фоновом потоке
+def serve(listen):
+    host, port = listen.rsplit(':', 1)
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?', 1)[0] != '/metrics':
+                self.send_error(404)
+                return
+            payload = metrics.render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, int(port)), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
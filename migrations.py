@@ -0,0 +1,551 @@
+from calendar import monthrange
+from datetime import date
+
+
+SCHEMA = (
+    # Таблица пользователей
+    '''
+    CREATE TABLE IF NOT EXISTS users (
+        user_id INTEGER PRIMARY KEY,
+        username TEXT,
+        first_name TEXT,
+        last_name TEXT,
+        join_date TEXT
+    )''',
+    # Таблица копилок (накоплений)
+    '''
+    CREATE TABLE IF NOT EXISTS savings (
+        user_id INTEGER PRIMARY KEY,
+        username TEXT,
+        balance REAL DEFAULT 0,
+        monthly_contribution REAL DEFAULT 0,
+        FOREIGN KEY (user_id) REFERENCES users(user_id)
+    )''',
+    # Таблица долгов
+    '''
+    CREATE TABLE IF NOT EXISTS debts (
+        debt_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        username TEXT,
+        amount REAL,
+        due_date TEXT,
+        status TEXT DEFAULT 'active',
+        creation_date TEXT,
+        FOREIGN KEY (user_id) REFERENCES users(user_id)
+    )''',
+    # Таблица взносов
+    '''
+    CREATE TABLE IF NOT EXISTS contributions (
+        contribution_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        username TEXT,
+        amount REAL,
+        month_year TEXT,
+        contribution_date TEXT,
+        FOREIGN KEY (user_id) REFERENCES users(user_id)
+    )''',
+)
+
+
+# 1: исходные таблицы
+def create_tables(conn):
+    for statement in SCHEMA:
+        conn.execute(statement)
+
+
+# 2: покрывающие индексы для my_contributions, my_debts и process_return
+def add_lookup_indexes(conn):
+    conn.execute('''
+    CREATE INDEX IF NOT EXISTS idx_contributions_user_date
+    ON contributions (user_id, contribution_date DESC, amount, month_year)
+    ''')
+    conn.execute('''
+    CREATE INDEX IF NOT EXISTS idx_debts_user_status_due
+    ON debts (user_id, status, due_date, amount, creation_date)
+    ''')
+
+
+# 3: итог по копилке в однострочной таблице, поддерживается триггерами
+def add_totals(conn):
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS totals (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        balance REAL NOT NULL DEFAULT 0
+    )''')
+    conn.execute('INSERT OR REPLACE INTO totals (id, balance) SELECT 1, COALESCE(SUM(balance), 0) FROM savings')
+    create_total_triggers(conn)
+
+
+def create_total_triggers(conn):
+    conn.execute('''
+    CREATE TRIGGER IF NOT EXISTS savings_total_insert AFTER INSERT ON savings
+    BEGIN
+        UPDATE totals SET balance = balance + COALESCE(NEW.balance, 0) WHERE id = 1;
+    END''')
+    conn.execute('''
+    CREATE TRIGGER IF NOT EXISTS savings_total_update AFTER UPDATE OF balance ON savings
+    BEGIN
+        UPDATE totals SET balance = balance - COALESCE(OLD.balance, 0) + COALESCE(NEW.balance, 0) WHERE id = 1;
+    END''')
+    conn.execute('''
+    CREATE TRIGGER IF NOT EXISTS savings_total_delete AFTER DELETE ON savings
+    BEGIN
+        UPDATE totals SET balance = balance - COALESCE(OLD.balance, 0) WHERE id = 1;
+    END''')
+
+
+# Денежные колонки в копейках; остальные колонки переносятся как есть
+MONEY_SCHEMA = {
+    'savings': '''
+    CREATE TABLE savings_new (
+        user_id INTEGER PRIMARY KEY,
+        username TEXT,
+        balance INTEGER NOT NULL DEFAULT 0,
+        monthly_contribution INTEGER NOT NULL DEFAULT 0,
+        FOREIGN KEY (user_id) REFERENCES users(user_id)
+    )''',
+    'debts': '''
+    CREATE TABLE debts_new (
+        debt_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        username TEXT,
+        amount INTEGER NOT NULL,
+        due_date TEXT,
+        status TEXT DEFAULT 'active',
+        creation_date TEXT,
+        FOREIGN KEY (user_id) REFERENCES users(user_id)
+    )''',
+    'contributions': '''
+    CREATE TABLE contributions_new (
+        contribution_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        username TEXT,
+        amount INTEGER NOT NULL,
+        month_year TEXT,
+        contribution_date TEXT,
+        FOREIGN KEY (user_id) REFERENCES users(user_id)
+    )''',
+    'totals': '''
+    CREATE TABLE totals_new (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        balance INTEGER NOT NULL DEFAULT 0
+    )''',
+}
+MONEY_COLUMNS = {
+    'savings': ('balance', 'monthly_contribution'),
+    'debts': ('amount',),
+    'contributions': ('amount',),
+    'totals': ('balance',),
+}
+
+
+# Таблица пересоздаётся: у колонки с affinity REAL целое всё равно читается как float
+def rebuild_money_table(conn, table):
+    columns = [row[1] for row in conn.execute(f'PRAGMA table_info({table})')]
+    values = [
+        f'CAST(ROUND(COALESCE({column}, 0) * 100) AS INTEGER)' if column in MONEY_COLUMNS[table] else column
+        for column in columns
+    ]
+    sequence = conn.execute('SELECT seq FROM sqlite_sequence WHERE name = ?', (table,)).fetchone()
+    conn.execute(MONEY_SCHEMA[table])
+    conn.execute(f'INSERT INTO {table}_new ({", ".join(columns)}) SELECT {", ".join(values)} FROM {table}')
+    conn.execute(f'DROP TABLE {table}')
+    conn.execute(f'ALTER TABLE {table}_new RENAME TO {table}')
+    if sequence:
+        # Счётчик AUTOINCREMENT не должен откатиться назад и выдать уже использованный id
+        conn.execute('DELETE FROM sqlite_sequence WHERE name = ?', (table,))
+        conn.execute(f'INSERT INTO sqlite_sequence (name, seq) SELECT ?, MAX(?, COALESCE(MAX(rowid), 0)) FROM {table}',
+                     (table, sequence[0]))
+
+
+# 4: суммы в целых копейках вместо REAL
+def convert_money_to_kopecks(conn):
+    for table in MONEY_SCHEMA:
+        rebuild_money_table(conn, table)
+    # Вместе со старыми таблицами удалены их индексы и триггеры
+    add_lookup_indexes(conn)
+    create_total_triggers(conn)
+    # Итог пересчитывается заново: округление отдельных балансов могло его сдвинуть
+    conn.execute('UPDATE totals SET balance = (SELECT COALESCE(SUM(balance), 0) FROM savings) WHERE id = 1')
+
+
+# 5: постраничный список активных долгов идёт по (status, debt_id)
+def add_debt_status_index(conn):
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_debts_status ON debts (status)')
+
+
+# 6: счётчик изменений savings в totals.revision; по нему процесс узнаёт,
+# что базу менял кто-то другой, и сбрасывает свои кэши. Триггеры итога
+# заменены на общие, чтобы каждая запись обновляла totals один раз
+def add_revision(conn):
+    conn.execute('ALTER TABLE totals ADD COLUMN revision INTEGER NOT NULL DEFAULT 0')
+    for name in ('savings_total_insert', 'savings_total_update', 'savings_total_delete'):
+        conn.execute(f'DROP TRIGGER IF EXISTS {name}')
+    create_change_triggers(conn)
+
+
+def create_change_triggers(conn):
+    conn.execute('''
+    CREATE TRIGGER IF NOT EXISTS savings_change_insert AFTER INSERT ON savings
+    BEGIN
+        UPDATE totals SET balance = balance + COALESCE(NEW.balance, 0), revision = revision + 1 WHERE id = 1;
+    END''')
+    conn.execute('''
+    CREATE TRIGGER IF NOT EXISTS savings_change_update AFTER UPDATE ON savings
+    BEGIN
+        UPDATE totals
+        SET balance = balance - COALESCE(OLD.balance, 0) + COALESCE(NEW.balance, 0), revision = revision + 1
+        WHERE id = 1;
+    END''')
+    conn.execute('''
+    CREATE TRIGGER IF NOT EXISTS savings_change_delete AFTER DELETE ON savings
+    BEGIN
+        UPDATE totals SET balance = balance - COALESCE(OLD.balance, 0), revision = revision + 1 WHERE id = 1;
+    END''')
+
+
+# 7: журнал движений денег только на добавление и снимки балансов.
+# Запись журнала — проводка между счётом пользователя (amount) и
+# встречным счётом account (-amount): 'cash' для взносов, 'loan' для займов
+# и возвратов, 'adjustment' для правок админа, 'opening' для остатков на
+# момент миграции. Баланс на любой момент = снимок + записи после него
+def add_journal(conn):
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS journal (
+        entry_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        account TEXT NOT NULL,
+        amount INTEGER NOT NULL,
+        ref_id INTEGER,
+        created_at TEXT NOT NULL
+    )''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_journal_user_entry ON journal (user_id, entry_id, amount)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_journal_created ON journal (created_at)')
+    conn.execute('''
+    CREATE TRIGGER IF NOT EXISTS journal_no_update BEFORE UPDATE ON journal
+    BEGIN
+        SELECT RAISE(ABORT, 'journal is append-only');
+    END''')
+    conn.execute('''
+    CREATE TRIGGER IF NOT EXISTS journal_no_delete BEFORE DELETE ON journal
+    BEGIN
+        SELECT RAISE(ABORT, 'journal is append-only');
+    END''')
+    # Баланс пользователя по журналу на момент записи entry_id включительно
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS balance_snapshots (
+        user_id INTEGER NOT NULL,
+        entry_id INTEGER NOT NULL,
+        balance INTEGER NOT NULL,
+        PRIMARY KEY (user_id, entry_id)
+    ) WITHOUT ROWID''')
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS snapshot_runs (
+        entry_id INTEGER PRIMARY KEY,
+        created_at TEXT NOT NULL
+    )''')
+    conn.execute('''
+    INSERT INTO journal (user_id, account, amount, created_at)
+    SELECT user_id, 'opening', balance, datetime('now', 'localtime') FROM savings
+    WHERE balance != 0
+    ORDER BY user_id''')
+
+
+# 8: напоминания. reminder_log — какие напоминания уже отправлены (kind,
+# период, id пользователя или долга), чтобы после перезапуска не слать их
+# снова; индексы под поиск должников по взносам
+def add_reminders(conn):
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS reminder_log (
+        kind TEXT NOT NULL,
+        period TEXT NOT NULL,
+        ref_id INTEGER NOT NULL,
+        sent_at TEXT NOT NULL,
+        PRIMARY KEY (kind, period, ref_id)
+    ) WITHOUT ROWID''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_contributions_user_period ON contributions (user_id, month_year)')
+    conn.execute('''
+    CREATE INDEX IF NOT EXISTS idx_savings_monthly ON savings (user_id, monthly_contribution)
+    WHERE monthly_contribution > 0
+    ''')
+
+
+# 9: месячные итоги взносов. period — вычисляемый столбец ГГГГММ из
+# 'ММ.ГГГГ' (NULL для строк другого вида): его не нужно заполнять при
+# вставке, а PRAGMA table_info его не показывает, поэтому выгрузка и
+# загрузка таблиц его не касаются. При пересборке contributions столбец
+# нужно объявить заново. contribution_rollups — сумма и число взносов
+# пользователя за месяц, триггеры держат её в согласии с contributions
+PERIOD_COLUMN = '''period INTEGER GENERATED ALWAYS AS (
+        CASE WHEN month_year GLOB '[0-9]*.[0-9][0-9][0-9][0-9]'
+             THEN CAST(substr(month_year, instr(month_year, '.') + 1) AS INTEGER) * 100
+                  + CAST(substr(month_year, 1, instr(month_year, '.') - 1) AS INTEGER)
+        END
+    ) VIRTUAL'''
+
+
+def add_contribution_rollups(conn):
+    conn.execute(f'ALTER TABLE contributions ADD COLUMN {PERIOD_COLUMN}')
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS contribution_rollups (
+        period INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        amount INTEGER NOT NULL,
+        contributions INTEGER NOT NULL,
+        PRIMARY KEY (period, user_id)
+    ) WITHOUT ROWID''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_rollups_user ON contribution_rollups (user_id, period, amount)')
+    rebuild_rollups(conn)
+    create_rollup_triggers(conn)
+
+
+# Пересчёт итогов целиком; нужен и после массовой загрузки, которая
+# снимает триггеры на время вставки. Группировка по (user_id, month_year)
+# идёт по порядку idx_contributions_user_period без сортировки всей
+# таблицы; period в группе одинаков, так как вычисляется из month_year,
+# а '7.2023' и '07.2023' сливаются в одну строку через ON CONFLICT
+def rebuild_rollups(conn):
+    conn.execute('DELETE FROM contribution_rollups')
+    for table in ROLLUP_SOURCES:
+        if not table_exists(conn, table):
+            continue
+        conn.execute(f'''
+        INSERT INTO contribution_rollups (period, user_id, amount, contributions)
+        SELECT period, user_id, SUM(amount), COUNT(*) FROM {table}
+        WHERE user_id IS NOT NULL
+        GROUP BY user_id, month_year
+        HAVING period IS NOT NULL
+        ON CONFLICT (period, user_id) DO UPDATE
+        SET amount = amount + excluded.amount, contributions = contributions + excluded.contributions''')
+
+
+def table_exists(conn, table):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone() is not None
+
+
+ROLLUP_ADD = '''
+        INSERT INTO contribution_rollups (period, user_id, amount, contributions)
+        SELECT NEW.period, NEW.user_id, NEW.amount, 1
+        WHERE NEW.period IS NOT NULL AND NEW.user_id IS NOT NULL
+        ON CONFLICT (period, user_id) DO UPDATE
+        SET amount = amount + excluded.amount, contributions = contributions + 1;'''
+ROLLUP_REMOVE = '''
+        UPDATE contribution_rollups SET amount = amount - OLD.amount, contributions = contributions - 1
+        WHERE period = OLD.period AND user_id = OLD.user_id;
+        DELETE FROM contribution_rollups
+        WHERE period = OLD.period AND user_id = OLD.user_id AND contributions = 0;'''
+
+
+ROLLUP_TRIGGERS = ('contributions_rollup_insert', 'contributions_rollup_update', 'contributions_rollup_delete')
+# Итоги считаются по взносам вместе с архивными (миграция 14)
+ROLLUP_SOURCES = ('contributions', 'contributions_archive')
+# Пока в archive_in_progress есть строка, удаление взноса — перенос в архив
+# и итогов не меняет (миграция 15)
+ROLLUP_DELETE_GUARD = 'WHEN NOT EXISTS (SELECT 1 FROM archive_in_progress)'
+
+
+def create_rollup_triggers(conn):
+    guard = ROLLUP_DELETE_GUARD if table_exists(conn, 'archive_in_progress') else ''
+    conn.execute(f'''
+    CREATE TRIGGER IF NOT EXISTS contributions_rollup_insert AFTER INSERT ON contributions
+    BEGIN{ROLLUP_ADD}
+    END''')
+    conn.execute(f'''
+    CREATE TRIGGER IF NOT EXISTS contributions_rollup_update
+    AFTER UPDATE OF user_id, amount, month_year ON contributions
+    BEGIN{ROLLUP_REMOVE}{ROLLUP_ADD}
+    END''')
+    conn.execute(f'''
+    CREATE TRIGGER IF NOT EXISTS contributions_rollup_delete AFTER DELETE ON contributions
+    {guard}
+    BEGIN{ROLLUP_REMOVE}
+    END''')
+
+
+# 10: администраторы копилки группового чата (groups.py). В основной базе
+# таблица пуста: там администраторы — ADMINS
+def add_group_admins(conn):
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS group_admins (
+        user_id INTEGER PRIMARY KEY,
+        granted_at TEXT NOT NULL
+    )''')
+
+
+# Срок из 'ДД.ММ' в 'ГГГГ-ММ-ДД' так, как его понимали напоминания:
+# ближайшая дата не раньше дня займа. Несуществующий день (31.02)
+# сдвигается на конец месяца, нераспознанный срок становится NULL
+def legacy_due_date(due_date, creation_date):
+    try:
+        day, month = (int(part) for part in due_date.split('.'))
+        created = date.fromisoformat(creation_date[:10])
+    except (AttributeError, TypeError, ValueError):
+        return None
+    if day < 1 or not 1 <= month <= 12:
+        return None
+    for year in (created.year, created.year + 1):
+        due = date(year, month, min(day, monthrange(year, month)[1]))
+        if due >= created:
+            return due.isoformat()
+
+
+# 11: срок возврата — дата 'ГГГГ-ММ-ДД': она сравнивается как текст, и
+# поиск просроченных и близких к сроку долгов идёт диапазоном по частичному
+# индексу активных долгов вместо разбора каждой строки в Python. user_id и
+# amount в индексе, чтобы напоминания не читали саму таблицу
+def convert_due_dates(conn):
+    conn.create_function('legacy_due_date', 2, legacy_due_date, deterministic=True)
+    conn.execute('UPDATE debts SET due_date = legacy_due_date(due_date, creation_date)')
+    conn.execute('''
+    CREATE INDEX IF NOT EXISTS idx_debts_active_due
+    ON debts (due_date, debt_id, user_id, amount) WHERE status = 'active'
+    ''')
+
+
+# 12: роли вместо списка администраторов в коде. roles — кто какую роль
+# получил и от кого; roles_revision растёт триггерами при любом изменении
+# roles, по нему воркер узнаёт, что его снимок ролей устарел. Администраторы
+# групп (10) переезжают в roles с ролью 'admin'
+def add_roles(conn):
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS roles (
+        user_id INTEGER NOT NULL,
+        role TEXT NOT NULL,
+        granted_by INTEGER,
+        granted_at TEXT NOT NULL,
+        PRIMARY KEY (user_id, role)
+    ) WITHOUT ROWID''')
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS roles_revision (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        revision INTEGER NOT NULL
+    )''')
+    conn.execute('INSERT OR IGNORE INTO roles_revision (id, revision) VALUES (1, 0)')
+    conn.execute('''
+    INSERT OR IGNORE INTO roles (user_id, role, granted_by, granted_at)
+    SELECT user_id, 'admin', NULL, granted_at FROM group_admins
+    ''')
+    conn.execute('DROP TABLE group_admins')
+    for event in ('INSERT', 'UPDATE', 'DELETE'):
+        conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS roles_revision_{event.lower()} AFTER {event} ON roles
+        BEGIN
+            UPDATE roles_revision SET revision = revision + 1 WHERE id = 1;
+        END''')
+
+
+# 13: обработанные обновления Telegram с движением денег. update_id пишется
+# в той же транзакции, что и взнос или займ, поэтому повторная доставка
+# того же обновления ничего не меняет. Старые строки удаляются по времени
+# обработки (PROCESSED_UPDATES_TTL), отсюда индекс по processed_at
+def add_processed_updates(conn):
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS processed_updates (
+        update_id INTEGER PRIMARY KEY,
+        processed_at TEXT NOT NULL
+    )''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_processed_updates_at ON processed_updates (processed_at)')
+
+
+# 14: архив возвращённых долгов и старых взносов (archive.py). Строки
+# переносятся с теми же id — AUTOINCREMENT не выдаст их снова — и временем
+# переноса. Итоги contribution_rollups по-прежнему учитывают архивные
+# взносы; *_history читают обе таблицы для истории и выгрузок
+def add_archive(conn):
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS debts_archive (
+        debt_id INTEGER PRIMARY KEY,
+        user_id INTEGER,
+        username TEXT,
+        amount INTEGER NOT NULL,
+        due_date TEXT,
+        status TEXT,
+        creation_date TEXT,
+        archived_at TEXT NOT NULL
+    )''')
+    conn.execute(f'''
+    CREATE TABLE IF NOT EXISTS contributions_archive (
+        contribution_id INTEGER PRIMARY KEY,
+        user_id INTEGER,
+        username TEXT,
+        amount INTEGER NOT NULL,
+        month_year TEXT,
+        contribution_date TEXT,
+        archived_at TEXT NOT NULL,
+        {PERIOD_COLUMN}
+    )''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_debts_archive_user ON debts_archive (user_id, creation_date)')
+    conn.execute('''
+    CREATE INDEX IF NOT EXISTS idx_contributions_archive_user_date
+    ON contributions_archive (user_id, contribution_date DESC, amount, month_year)
+    ''')
+    conn.execute('''
+    CREATE INDEX IF NOT EXISTS idx_contributions_archive_user_period
+    ON contributions_archive (user_id, month_year)
+    ''')
+    conn.execute('''
+    CREATE VIEW IF NOT EXISTS debts_history AS
+    SELECT debt_id, user_id, username, amount, due_date, status, creation_date FROM debts
+    UNION ALL
+    SELECT debt_id, user_id, username, amount, due_date, status, creation_date FROM debts_archive
+    ''')
+    conn.execute('''
+    CREATE VIEW IF NOT EXISTS contributions_history AS
+    SELECT contribution_id, user_id, username, amount, month_year, contribution_date, period FROM contributions
+    UNION ALL
+    SELECT contribution_id, user_id, username, amount, month_year, contribution_date, period FROM contributions_archive
+    ''')
+
+
+# 15: флаг переноса в архив. archive.py ставит его строкой в той же
+# транзакции, где удаляет перенесённые взносы, и снимает до COMMIT: другие
+# соединения флага не видят, а триггер итогов не вычитает перенесённое
+def add_archive_guard(conn):
+    conn.execute('CREATE TABLE IF NOT EXISTS archive_in_progress (id INTEGER PRIMARY KEY CHECK (id = 1))')
+    conn.execute('DROP TRIGGER IF EXISTS contributions_rollup_delete')
+    create_rollup_triggers(conn)
+
+
+# Номер версии схемы = позиция миграции в списке, хранится в PRAGMA user_version.
+# Новые миграции только добавляются в конец.
+MIGRATIONS = (
+    create_tables,
+    add_lookup_indexes,
+    add_totals,
+    convert_money_to_kopecks,
+    add_debt_status_index,
+    add_revision,
+    add_journal,
+    add_reminders,
+    add_contribution_rollups,
+    add_group_admins,
+    convert_due_dates,
+    add_roles,
+    add_processed_updates,
+    add_archive,
+    add_archive_guard,
+)
+
+
+def get_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def migrate(conn, target=len(MIGRATIONS)):
+    version = get_version(conn)
+    while version < target:
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            # Другой процесс мог успеть применить миграцию, пока мы ждали блокировку
+            version = get_version(conn)
+            if version >= target:
+                conn.execute('COMMIT')
+                break
+            MIGRATIONS[version](conn)
+            version += 1
+            conn.execute(f'PRAGMA user_version = {version}')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+    return version
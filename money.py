@@ -0,0 +1,25 @@
+# Деньги везде хранятся целым числом копеек: сложение, вычитание и сравнение
+# точные, а рубли с копейками появляются только при разборе и выводе
+KOPECKS_PER_RUBLE = 100
+
+
+def is_digits(text, max_length):
+    return text.isascii() and text.isdigit() and len(text) <= max_length
+
+
+# '1500', '1500.5', '1500,50', '-20.5' -> копейки; без float на всём пути
+def parse_money(text):
+    negative = text.startswith('-')
+    rubles, separator, kopecks = (text[1:] if negative else text).replace(',', '.').partition('.')
+    if not is_digits(rubles, 12) or separator and not is_digits(kopecks, 2):
+        raise ValueError(f"Некорректная сумма: {text!r}")
+    value = int(rubles) * KOPECKS_PER_RUBLE
+    if kopecks:
+        value += int(kopecks) * (10 if len(kopecks) == 1 else 1)
+    return -value if negative else value
+
+
+def format_money(kopecks):
+    if kopecks < 0:
+        return '-%d.%02d' % divmod(-kopecks, KOPECKS_PER_RUBLE)
+    return '%d.%02d' % divmod(kopecks, KOPECKS_PER_RUBLE)
@@ -0,0 +1,284 @@
+import asyncio
+import os
+import time
+from collections import deque
+
+from telegram.error import Forbidden, NetworkError, RetryAfter
+
+
+# Общий лимит Telegram — около 30 сообщений в секунду на бота
+OUTBOX_RATE = float(os.environ.get('OUTBOX_RATE', 30))
+# В один чат — не чаще сообщения в секунду, с небольшим запасом на всплеск
+OUTBOX_CHAT_RATE = float(os.environ.get('OUTBOX_CHAT_RATE', 1))
+OUTBOX_CHAT_BURST = int(os.environ.get('OUTBOX_CHAT_BURST', 3))
+# Сколько отправок идёт одновременно
+OUTBOX_WORKERS = int(os.environ.get('OUTBOX_WORKERS', 8))
+# Сколько раз повторять отправку после RetryAfter и сетевых ошибок
+OUTBOX_RETRIES = 5
+# Сколько ждать доотправки очереди при остановке, в секундах
+OUTBOX_DRAIN_TIMEOUT = 10
+# Лимит длины одного сообщения Telegram
+MAX_MESSAGE_LENGTH = 4096
+# Как часто забывать чаты, которым давно ничего не отправляли
+SWEEP_INTERVAL = 60
+
+
+class TokenBucket:
+    # rate жетонов в секунду, не больше capacity про запас; rate 0 — без ограничения
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    # Через сколько секунд появится жетон; 0 — можно отправлять сейчас
+    def delay(self, now):
+        if not self.rate:
+            return 0
+        self._refill(now)
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        if self.rate:
+            self._refill(now)
+            self.tokens -= 1
+
+    def full(self, now):
+        if not self.rate:
+            return True
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+
+class Message:
+    # parts — сколько исходных текстов склеено в одно сообщение;
+    # future есть только у отправок, которые ждут результата (deliver)
+    __slots__ = ('text', 'kwargs', 'parts', 'attempts', 'future')
+
+    def __init__(self, text, kwargs, future=None):
+        self.text = text
+        self.kwargs = kwargs
+        self.parts = 1
+        self.attempts = 0
+        self.future = future
+
+    def can_merge(self, text, kwargs):
+        return (not kwargs and not self.kwargs and self.future is None
+                and len(self.text) + 2 + len(text) <= MAX_MESSAGE_LENGTH)
+
+
+class ChatQueue:
+    # scheduled — чат уже стоит в очереди готовых, ждёт жетона или его
+    # сообщение отправляется прямо сейчас; так в один чат идёт не больше
+    # одной отправки за раз и порядок сообщений сохраняется
+    __slots__ = ('chat_id', 'pending', 'bucket', 'resume_at', 'scheduled')
+
+    def __init__(self, chat_id, rate, burst):
+        self.chat_id = chat_id
+        self.pending = deque()
+        self.bucket = TokenBucket(rate, burst)
+        self.resume_at = 0
+        self.scheduled = False
+
+
+class Outbox:
+    # Очередь исходящих сообщений: обработчик кладёт ответ и сразу
+    # возвращается, а воркеры отправляют его с учётом общего лимита и лимита
+    # на чат. Ещё не отправленные тексты в один чат склеиваются в одно
+    # сообщение, RetryAfter откладывает чат на указанное время
+    def __init__(self, bot, rate=OUTBOX_RATE, chat_rate=OUTBOX_CHAT_RATE,
+                 chat_burst=OUTBOX_CHAT_BURST, workers=OUTBOX_WORKERS, retries=OUTBOX_RETRIES):
+        self.bot = bot
+        # Общий лимит без запаса: ровно rate отправок в секунду, без всплесков
+        self.bucket = TokenBucket(rate, 1)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.workers = workers
+        self.retries = retries
+        # Счётчики в исходных текстах; sent — число вызовов sendMessage
+        self.queued = 0
+        self.sent = 0
+        self.delivered = 0
+        self.coalesced = 0
+        self.retried = 0
+        self.dropped = 0
+        self._chats = {}
+        self._ready = None
+        self._tasks = []
+        self._drained = None
+        self._swept_at = time.monotonic()
+
+    def start(self):
+        if self._tasks:
+            return
+        self._ready = asyncio.Queue()
+        self._drained = asyncio.Event()
+        self._drained.set()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    # Дождаться отправки того, что уже в очереди, не дольше timeout
+    async def join(self, timeout=OUTBOX_DRAIN_TIMEOUT):
+        if self._drained is None:
+            return True
+        try:
+            await asyncio.wait_for(self._drained.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    async def stop(self, timeout=OUTBOX_DRAIN_TIMEOUT):
+        if not await self.join(timeout):
+            print(f"Не отправлено при остановке: {self.queued} сообщений")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        # Кто ждёт результата в deliver, получает «не отправлено»
+        for chat in self._chats.values():
+            for message in chat.pending:
+                if message.future is not None and not message.future.done():
+                    message.future.set_result(None)
+
+    # Поставить сообщение в очередь; воркеры запускаются при первой отправке
+    def send(self, chat_id, text, **kwargs):
+        self.start()
+        chat = self._chat(chat_id)
+        if chat.pending and chat.pending[-1].can_merge(text, kwargs):
+            last = chat.pending[-1]
+            last.text = f'{last.text}\n\n{text}'
+            last.parts += 1
+            self.coalesced += 1
+        else:
+            chat.pending.append(Message(text, kwargs))
+        self._queued(chat)
+
+    # Отправить и дождаться результата: True — отправлено, False — бот
+    # заблокирован, None — не вышло после всех повторов
+    async def deliver(self, chat_id, text, **kwargs):
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        chat = self._chat(chat_id)
+        chat.pending.append(Message(text, kwargs, future))
+        self._queued(chat)
+        return await future
+
+    def stats(self):
+        return {
+            'queued': self.queued,
+            'sent': self.sent,
+            'delivered': self.delivered,
+            'coalesced': self.coalesced,
+            'retried': self.retried,
+            'dropped': self.dropped,
+            'chats': len(self._chats),
+        }
+
+    def _chat(self, chat_id):
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            chat = self._chats[chat_id] = ChatQueue(chat_id, self.chat_rate, self.chat_burst)
+        return chat
+
+    def _queued(self, chat):
+        self.queued += 1
+        self._drained.clear()
+        if not chat.scheduled:
+            chat.scheduled = True
+            self._ready.put_nowait(chat.chat_id)
+
+    def _finished(self, message, delivered, result):
+        self.queued -= message.parts
+        if delivered:
+            self.delivered += message.parts
+        else:
+            self.dropped += message.parts
+        if message.future is not None and not message.future.done():
+            message.future.set_result(result)
+        if not self.queued:
+            self._drained.set()
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            chat_id = await self._ready.get()
+            chat = self._chats[chat_id]
+            now = time.monotonic()
+            # Чат ещё не может принять сообщение: вернуть его в очередь
+            # позже, а воркер отдать другим чатам
+            delay = max(chat.bucket.delay(now), chat.resume_at - now)
+            if delay > 0:
+                loop.call_later(delay, self._ready.put_nowait, chat_id)
+                continue
+
+            await self._take_global()
+            chat.bucket.take(time.monotonic())
+            message = chat.pending.popleft()
+            await self._send(chat, message)
+
+            if chat.pending:
+                self._ready.put_nowait(chat_id)
+            else:
+                chat.scheduled = False
+                self._sweep()
+
+    # Проверка и списание жетона идут без await между ними,
+    # поэтому параллельные воркеры не проскочат общий лимит
+    async def _take_global(self):
+        while True:
+            now = time.monotonic()
+            delay = self.bucket.delay(now)
+            if delay <= 0:
+                self.bucket.take(now)
+                return
+            await asyncio.sleep(delay)
+
+    async def _send(self, chat, message):
+        self.sent += 1
+        try:
+            await self.bot.send_message(chat_id=chat.chat_id, text=message.text, **message.kwargs)
+        except RetryAfter as e:
+            self._retry(chat, message, e.retry_after, e)
+            return
+        except Forbidden:
+            # Пользователь заблокировал бота: повторять бесполезно
+            self._finished(message, False, False)
+            return
+        except NetworkError as e:
+            self._retry(chat, message, 0.5 * 2 ** message.attempts, e)
+            return
+        except Exception as e:
+            # Прочие ошибки (BadRequest и т.п.) повтором не исправить,
+            # а воркер должен пережить любую из них
+            print(f"Ошибка отправки сообщения: {e}")
+            self._finished(message, False, None)
+            return
+        self._finished(message, True, True)
+
+    # Сообщение возвращается в начало очереди чата, чат откладывается
+    def _retry(self, chat, message, delay, error):
+        message.attempts += 1
+        if message.attempts > self.retries:
+            print(f"Ошибка отправки сообщения после {self.retries} повторов: {error}")
+            self._finished(message, False, None)
+            return
+        self.retried += 1
+        chat.resume_at = time.monotonic() + delay
+        chat.pending.appendleft(message)
+
+    # Забыть простаивающие чаты с полным запасом жетонов: новый ChatQueue
+    # для них ничем не отличается от старого
+    def _sweep(self):
+        now = time.monotonic()
+        if now - self._swept_at < SWEEP_INTERVAL:
+            return
+        self._swept_at = now
+        idle = [chat_id for chat_id, chat in self._chats.items()
+                if not chat.scheduled and chat.resume_at <= now and chat.bucket.full(now)]
+        for chat_id in idle:
+            del self._chats[chat_id]
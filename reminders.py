@@ -0,0 +1,150 @@
+import asyncio
+import os
+import time
+from collections import deque
+from datetime import date
+
+from telegram.error import Forbidden, RetryAfter, TelegramError
+
+from commands import due_day_month, format_due_date
+from db import run_in_db
+from money import format_money
+
+
+# Как часто проверять, кому пора напомнить, в секундах
+REMINDER_INTERVAL = int(os.environ.get('REMINDER_INTERVAL', 3600))
+# С какого дня месяца напоминать о неоплаченном взносе
+REMINDER_DAY = int(os.environ.get('REMINDER_DAY', 25))
+# Сообщений в секунду: с запасом ниже общего лимита Telegram в 30/с
+SEND_RATE = int(os.environ.get('REMINDER_SEND_RATE', 25))
+# Сколько раз повторять отправку после RetryAfter
+SEND_RETRIES = 3
+
+
+class ReminderScheduler:
+    # Фоновая задача: раз в interval секунд ищет должников по взносам и
+    # просроченные долги и рассылает напоминания пачками не быстрее rate
+    # сообщений в секунду. Разосланное отмечается в reminder_log заранее,
+    # поэтому перезапуск или соседний воркер не пришлют их повторно.
+    # С outbox напоминания идут через общую очередь отправки вместе с
+    # ответами и делят с ними общий лимит Telegram
+    def __init__(self, bot, repo, interval=REMINDER_INTERVAL, rate=SEND_RATE,
+                 reminder_day=REMINDER_DAY, today=date.today, outbox=None):
+        self.bot = bot
+        self.repo = repo
+        self.outbox = outbox
+        self.interval = interval
+        self.rate = rate
+        self.reminder_day = reminder_day
+        self.today = today
+        self._task = None
+        # Моменты последних отправок: в любом окне в секунду их не больше rate
+        self._sent_at = deque()
+
+    def start(self):
+        self._task = asyncio.create_task(self.run_forever())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def run_forever(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception as e:
+                print(f"Ошибка рассылки напоминаний: {e}")
+            await asyncio.sleep(self.interval)
+
+    # Один проход; возвращает, сколько напоминаний отправлено каждого вида
+    async def run_once(self):
+        today = self.today()
+        sent = {'contribution': 0, 'overdue': 0}
+        if today.day >= self.reminder_day:
+            sent['contribution'] = await self._remind_contributions(today)
+        sent['overdue'] = await self._remind_overdue(today)
+        return sent
+
+    async def _remind_contributions(self, today):
+        period = f'{today.month:02d}.{today.year}'
+        sent = 0
+        cursor = -2 ** 63
+        while True:
+            rows = await run_in_db(self.repo.contribution_reminders, period, cursor, self.rate)
+            if not rows:
+                return sent
+            cursor = rows[-1][0]
+            messages = {
+                user_id: f"🔔 Напоминание: взнос {format_money(amount)} за {period} ещё не внесён.\n"
+                         f"Отправьте 'вношу {format_money(amount)} за {period}'"
+                for user_id, amount in rows
+            }
+            sent += await self._send_batch('contribution', period, messages,
+                                           {user_id: user_id for user_id in messages})
+
+    async def _remind_overdue(self, today):
+        # Напоминание о просроченном долге — не чаще раза в день
+        period = today.isoformat()
+        sent = 0
+        cursor = None
+        while True:
+            # Только просроченные, диапазоном по индексу сроков
+            rows = await run_in_db(self.repo.overdue_debts, period, cursor, self.rate)
+            if not rows:
+                return sent
+            cursor = rows[-1][3], rows[-1][0]
+            messages = {
+                debt_id: f"⚠️ Долг {format_money(amount)} нужно было вернуть до {format_due_date(due_date)}.\n"
+                         f"Отправьте 'возвращаю {format_money(amount)} за {due_day_month(due_date)}'"
+                for debt_id, user_id, amount, due_date in rows
+            }
+            sent += await self._send_batch('overdue', period, messages,
+                                           {debt_id: user_id for debt_id, user_id, _, _ in rows})
+
+    async def _send_batch(self, kind, period, messages, chats):
+        if not messages:
+            return 0
+        claimed = await run_in_db(self.repo.claim_reminders, kind, period, list(messages))
+        results = await asyncio.gather(*(self._send(chats[ref_id], messages[ref_id]) for ref_id in claimed))
+        failed = [ref_id for ref_id, ok in zip(claimed, results) if ok is None]
+        if failed:
+            await run_in_db(self.repo.release_reminders, kind, period, failed)
+        return sum(1 for ok in results if ok)
+
+    # Скользящее окно в одну секунду; проверка и запись идут без await
+    # между ними, поэтому параллельные отправки не проскочат лимит
+    async def _throttle(self):
+        while True:
+            now = time.monotonic()
+            while self._sent_at and now - self._sent_at[0] >= 1:
+                self._sent_at.popleft()
+            if len(self._sent_at) < self.rate:
+                self._sent_at.append(now)
+                return
+            await asyncio.sleep(1 - (now - self._sent_at[0]))
+
+    # True — отправлено, False — пользователь заблокировал бота (не повторяем),
+    # None — временная ошибка, напоминание вернётся в следующий проход
+    async def _send(self, chat_id, text):
+        if self.outbox is not None:
+            # Повторы после RetryAfter и сетевых сбоев делает сама очередь
+            await self._throttle()
+            return await self.outbox.deliver(chat_id, text)
+        for _ in range(SEND_RETRIES):
+            await self._throttle()
+            try:
+                await self.bot.send_message(chat_id=chat_id, text=text)
+                return True
+            except RetryAfter as e:
+                await asyncio.sleep(e.retry_after)
+            except Forbidden:
+                return False
+            except TelegramError as e:
+                print(f"Ошибка отправки напоминания {chat_id}: {e}")
+                return None
+        return None
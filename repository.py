@@ -0,0 +1,739 @@
+import os
+import threading
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+from typing import List, Optional, Tuple
+
+import db
+import migrations
+from cache import LRUCache
+
+
+# Все запросы держим константами: одинаковая строка SQL берётся
+# из кэша подготовленных выражений долгоживущего соединения
+SELECT_USER_EXISTS = 'SELECT 1 FROM users WHERE user_id = ?'
+INSERT_USER = '''
+INSERT OR IGNORE INTO users (user_id, username, first_name, last_name, join_date)
+VALUES (?, ?, ?, ?, ?)
+'''
+INSERT_SAVINGS = '''
+INSERT INTO savings (user_id, username, balance, monthly_contribution)
+VALUES (?, ?, 0, 0)
+'''
+SELECT_USER_STATE = '''
+SELECT u.username, s.balance, s.monthly_contribution
+FROM savings s
+LEFT JOIN users u ON u.user_id = s.user_id
+WHERE s.user_id = ?
+'''
+# Постраничные списки по ключу (keyset): страница начинается строго после
+# (или перед) последнего показанного id, поэтому любая страница стоит одинаково
+SELECT_USERS_PAGE = '''
+SELECT u.user_id, u.username, u.first_name, u.last_name, u.join_date, COALESCE(s.balance, 0)
+FROM users u
+LEFT JOIN savings s ON s.user_id = u.user_id
+WHERE u.user_id > ?
+ORDER BY u.user_id
+LIMIT ?
+'''
+SELECT_USERS_PAGE_BEFORE = '''
+SELECT u.user_id, u.username, u.first_name, u.last_name, u.join_date, COALESCE(s.balance, 0)
+FROM users u
+LEFT JOIN savings s ON s.user_id = u.user_id
+WHERE u.user_id < ?
+ORDER BY u.user_id DESC
+LIMIT ?
+'''
+
+SELECT_TOTAL_BALANCE = 'SELECT balance FROM totals WHERE id = 1'
+SELECT_SUM_BALANCE = 'SELECT COALESCE(SUM(balance), 0) FROM savings'
+SELECT_REVISION = 'SELECT revision FROM totals WHERE id = 1'
+UPDATE_TOTAL_BALANCE = 'UPDATE totals SET balance = ?, revision = revision + 1 WHERE id = 1'
+# RETURNING отдаёт состояние после записи в той же транзакции: ответ
+# пользователю и кэш строятся из него без повторного чтения
+UPDATE_BALANCE_ADD = 'UPDATE savings SET balance = balance + ? WHERE user_id = ? RETURNING balance, monthly_contribution'
+UPDATE_BALANCE_SUB = 'UPDATE savings SET balance = balance - ? WHERE user_id = ? RETURNING balance, monthly_contribution'
+UPDATE_BALANCE_SET = 'UPDATE savings SET balance = ? WHERE user_id = ? RETURNING balance, monthly_contribution'
+UPDATE_MONTHLY_CONTRIBUTION = '''
+UPDATE savings SET monthly_contribution = ? WHERE user_id = ?
+RETURNING balance, monthly_contribution
+'''
+
+INSERT_CONTRIBUTION = '''
+INSERT INTO contributions (user_id, username, amount, month_year, contribution_date)
+VALUES (?, ?, ?, ?, ?)
+'''
+# История взносов — вместе с перенесёнными в архив (archive.py)
+SELECT_RECENT_CONTRIBUTIONS = '''
+SELECT amount, month_year, contribution_date FROM contributions_history
+WHERE user_id = ?
+ORDER BY contribution_date DESC
+LIMIT ?
+'''
+# Месячные итоги читаются из contribution_rollups, а не сканом взносов;
+# period — целое ГГГГММ
+SELECT_USER_MONTHS = '''
+SELECT period, amount, contributions FROM contribution_rollups
+WHERE user_id = ?
+ORDER BY period DESC
+LIMIT ?
+'''
+SELECT_MONTHLY_TOTALS = '''
+SELECT period, SUM(amount), COUNT(*) FROM contribution_rollups
+GROUP BY period
+ORDER BY period DESC
+LIMIT ?
+'''
+SELECT_PERIOD_PAYERS = '''
+SELECT user_id, amount FROM contribution_rollups
+WHERE period = ? AND user_id > ?
+ORDER BY user_id
+LIMIT ?
+'''
+
+INSERT_DEBT = '''
+INSERT INTO debts (user_id, username, amount, due_date, creation_date)
+VALUES (?, ?, ?, ?, ?)
+'''
+SELECT_ACTIVE_DEBTS = '''
+SELECT amount, due_date, creation_date FROM debts
+WHERE user_id = ? AND status = 'active'
+ORDER BY due_date
+'''
+# Возврат указывает срок как 'ДД.ММ': подходит долг с таким днём и месяцем
+# в любом году, первым — с самым ранним сроком
+SELECT_ACTIVE_DEBT_BY_DATE = '''
+SELECT debt_id, amount FROM debts
+WHERE user_id = ? AND status = 'active' AND substr(due_date, 6) = ?
+ORDER BY due_date, debt_id
+LIMIT 1
+'''
+SELECT_ACTIVE_DEBTS_PAGE = '''
+SELECT d.debt_id, d.user_id, u.first_name, u.last_name, d.amount, d.due_date
+FROM debts d
+JOIN users u ON d.user_id = u.user_id
+WHERE d.status = 'active' AND d.debt_id > ?
+ORDER BY d.debt_id
+LIMIT ?
+'''
+SELECT_ACTIVE_DEBTS_PAGE_BEFORE = '''
+SELECT d.debt_id, d.user_id, u.first_name, u.last_name, d.amount, d.due_date
+FROM debts d
+JOIN users u ON d.user_id = u.user_id
+WHERE d.status = 'active' AND d.debt_id < ?
+ORDER BY d.debt_id DESC
+LIMIT ?
+'''
+# Проводки по долгам: условие проверяется в самом UPDATE, внутри той же
+# транзакции BEGIN IMMEDIATE, что и остальные изменения
+UPDATE_BALANCE_BORROW = '''
+UPDATE savings SET balance = balance - :amount
+WHERE user_id = :user_id AND (SELECT balance FROM totals WHERE id = 1) >= :amount
+RETURNING balance, monthly_contribution
+'''
+# Полный возврат закрывает долг и оставляет сумму как была, частичный уменьшает её
+UPDATE_DEBT_REPAY = '''
+UPDATE debts
+SET status = CASE WHEN amount = :amount THEN 'returned' ELSE status END,
+    amount = CASE WHEN amount = :amount THEN amount ELSE amount - :amount END
+WHERE debt_id = (
+    SELECT debt_id FROM debts
+    WHERE user_id = :user_id AND status = 'active' AND substr(due_date, 6) = :month_day
+    ORDER BY due_date, debt_id
+    LIMIT 1
+) AND amount >= :amount
+RETURNING debt_id
+'''
+SELECT_DEBT_EXISTS = 'SELECT 1 FROM debts WHERE debt_id = ?'
+UPDATE_DEBT_RETURNED = "UPDATE debts SET status = 'returned' WHERE debt_id = ?"
+UPDATE_DEBT_AMOUNT_SUB = 'UPDATE debts SET amount = amount - ? WHERE debt_id = ?'
+UPDATE_DEBT_AMOUNT_SET = 'UPDATE debts SET amount = ? WHERE debt_id = ?'
+UPDATE_DEBT_DUE_DATE = 'UPDATE debts SET due_date = ? WHERE debt_id = ?'
+
+# Напоминания: должники по взносу за период, которым ещё не напоминали
+SELECT_CONTRIBUTION_REMINDERS = '''
+SELECT s.user_id, s.monthly_contribution FROM savings s
+WHERE s.monthly_contribution > 0 AND s.user_id > :cursor
+  AND NOT EXISTS (
+      SELECT 1 FROM contributions_history c WHERE c.user_id = s.user_id AND c.month_year = :period
+  )
+  AND NOT EXISTS (
+      SELECT 1 FROM reminder_log r WHERE r.kind = 'contribution' AND r.period = :period AND r.ref_id = s.user_id
+  )
+ORDER BY s.user_id
+LIMIT :limit
+'''
+# Активные долги со сроком в [start, end) по возрастанию срока — диапазон
+# по idx_debts_active_due; страница начинается после (срок, debt_id)
+# последней строки предыдущей: поиск в индексе начинается с её срока, а не
+# с начала диапазона. Без ANALYZE планировщик предпочитает
+# равенство по idx_debts_status и сортирует все активные долги, поэтому
+# индекс указан явно
+SELECT_DEBTS_DUE = '''
+SELECT debt_id, user_id, amount, due_date FROM debts INDEXED BY idx_debts_active_due
+WHERE status = 'active' AND due_date >= :after_date AND due_date < :end
+  AND (due_date, debt_id) > (:after_date, :after_id)
+ORDER BY due_date, debt_id
+LIMIT :limit
+'''
+INSERT_REMINDER = 'INSERT OR IGNORE INTO reminder_log (kind, period, ref_id, sent_at) VALUES (?, ?, ?, ?)'
+DELETE_REMINDER = 'DELETE FROM reminder_log WHERE kind = ? AND period = ? AND ref_id = ?'
+
+INSERT_JOURNAL = '''
+INSERT INTO journal (user_id, account, amount, ref_id, created_at)
+VALUES (?, ?, ?, ?, ?)
+'''
+SELECT_LAST_SNAPSHOT_RUN = 'SELECT COALESCE(MAX(entry_id), 0) FROM snapshot_runs'
+SELECT_LAST_ENTRY = 'SELECT COALESCE(MAX(entry_id), 0) FROM journal'
+SELECT_ENTRY_AT = 'SELECT COALESCE(MAX(entry_id), 0) FROM journal WHERE created_at <= ?'
+# Снимок строится из предыдущего снимка и записей после него, то есть
+# стоит O(записей с прошлого снимка), а не всего журнала
+INSERT_SNAPSHOTS = '''
+INSERT INTO balance_snapshots (user_id, entry_id, balance)
+SELECT j.user_id, :upto, SUM(j.amount) + COALESCE((
+    SELECT b.balance FROM balance_snapshots b
+    WHERE b.user_id = j.user_id
+    ORDER BY b.entry_id DESC
+    LIMIT 1
+), 0)
+FROM journal j
+WHERE j.entry_id > :since AND j.entry_id <= :upto
+GROUP BY j.user_id
+'''
+INSERT_SNAPSHOT_RUN = 'INSERT INTO snapshot_runs (entry_id, created_at) VALUES (?, ?)'
+SELECT_SNAPSHOT_BEFORE = '''
+SELECT entry_id, balance FROM balance_snapshots
+WHERE user_id = ? AND entry_id <= ?
+ORDER BY entry_id DESC
+LIMIT 1
+'''
+SELECT_JOURNAL_SUM = '''
+SELECT COALESCE(SUM(amount), 0) FROM journal
+WHERE user_id = ? AND entry_id > ? AND entry_id <= ?
+'''
+# Проверки журнала: остатки по журналу против savings, итог против totals
+# и каждый снимок против предыдущего снимка плюс записей между ними
+SELECT_JOURNAL_BALANCE_MISMATCHES = '''
+SELECT COUNT(*) FROM (
+    SELECT user_id FROM (
+        SELECT user_id, balance FROM savings
+        UNION ALL
+        SELECT user_id, -SUM(amount) FROM journal GROUP BY user_id
+    )
+    GROUP BY user_id
+    HAVING SUM(balance) != 0
+)
+'''
+SELECT_JOURNAL_TOTAL = 'SELECT COALESCE(SUM(amount), 0) FROM journal'
+SELECT_SNAPSHOT_MISMATCHES = '''
+WITH ordered AS (
+    SELECT user_id, entry_id, balance,
+           LAG(entry_id, 1, 0) OVER w AS prev_entry,
+           LAG(balance, 1, 0) OVER w AS prev_balance
+    FROM balance_snapshots
+    WINDOW w AS (PARTITION BY user_id ORDER BY entry_id)
+)
+SELECT COUNT(*) FROM ordered o
+WHERE o.balance - o.prev_balance != (
+    SELECT COALESCE(SUM(j.amount), 0) FROM journal j
+    WHERE j.user_id = o.user_id AND j.entry_id > o.prev_entry AND j.entry_id <= o.entry_id
+)
+'''
+
+INSERT_PROCESSED_UPDATE = 'INSERT OR IGNORE INTO processed_updates (update_id, processed_at) VALUES (?, ?)'
+DELETE_PROCESSED_UPDATES_BEFORE = 'DELETE FROM processed_updates WHERE processed_at < ?'
+
+SELECT_ROLES = 'SELECT user_id, role FROM roles'
+SELECT_ROLES_REVISION = 'SELECT revision FROM roles_revision WHERE id = 1'
+INSERT_ROLE = 'INSERT OR IGNORE INTO roles (user_id, role, granted_by, granted_at) VALUES (?, ?, ?, ?)'
+DELETE_ROLE = 'DELETE FROM roles WHERE user_id = ? AND role = ?'
+# Последний обладатель роли остаётся: условие проверяется в самом DELETE
+DELETE_ROLE_KEEP_LAST = '''
+DELETE FROM roles
+WHERE user_id = :user_id AND role = :role AND (SELECT COUNT(*) FROM roles WHERE role = :role) > 1
+'''
+# Первый администратор группы назначается, только пока их нет ни одного
+SELECT_ANY_ADMIN = "SELECT 1 FROM roles WHERE role = 'admin' LIMIT 1"
+
+
+# Курсор первой страницы: меньше любого id
+FIRST_PAGE = -2 ** 63
+PAGE_SIZE = 10
+
+USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE', 10000))
+
+# Снимок балансов делается после каждых SNAPSHOT_INTERVAL записей журнала
+SNAPSHOT_INTERVAL = int(os.environ.get('JOURNAL_SNAPSHOT_INTERVAL', 10000))
+
+# Сколько помнить обработанные update_id, в секундах: Telegram хранит
+# недоставленные обновления сутки, повтор позже этого не придёт
+PROCESSED_UPDATES_TTL = int(os.environ.get('PROCESSED_UPDATES_TTL', 2 * 24 * 3600))
+# Устаревшие update_id удаляются после каждых PRUNE_INTERVAL обработанных
+PRUNE_INTERVAL = 1000
+
+
+class LedgerError(Exception):
+    pass
+
+
+class InsufficientFunds(LedgerError):
+    def __init__(self, available):
+        super().__init__(f"Недостаточно средств: доступно {available}")
+        self.available = available
+
+
+class DebtNotFound(LedgerError):
+    def __init__(self):
+        super().__init__("Активный долг не найден")
+
+
+class ReturnExceedsDebt(LedgerError):
+    def __init__(self, debt_amount):
+        super().__init__(f"Сумма возврата превышает долг {debt_amount}")
+        self.debt_amount = debt_amount
+
+
+class DuplicateUpdate(LedgerError):
+    def __init__(self, update_id):
+        super().__init__(f"Обновление {update_id} уже обработано")
+        self.update_id = update_id
+
+
+class UnknownUser(LedgerError):
+    def __init__(self, user_id):
+        super().__init__(f"Пользователь {user_id} не найден")
+        self.user_id = user_id
+
+
+def now():
+    return datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+
+class UserState:
+    # То, что нужно почти каждому ответу: имя, баланс и ежемесячный взнос
+    __slots__ = ('username', 'balance', 'monthly_contribution')
+
+    def __init__(self, username, balance, monthly_contribution):
+        self.username = username
+        self.balance = balance
+        self.monthly_contribution = monthly_contribution
+
+
+class SavingsRepository:
+    # Слой доступа к данным: пользователи, копилки, долги и взносы
+    def __init__(self, manager: Optional[db.ConnectionManager] = None, user_cache_size: int = USER_CACHE_SIZE):
+        self._manager = manager
+        # Кэш общего баланса; поколение растёт при каждой записи,
+        # чтобы чтение, начатое до записи, не сохранило старое значение
+        self._total = None
+        self._total_generation = 0
+        self._total_lock = threading.Lock()
+        # Кэш UserState по user_id со сквозной записью: каждая запись в savings
+        # кладёт в него состояние, которое вернул её UPDATE ... RETURNING
+        self.user_cache = LRUCache(user_cache_size)
+        self._writes = threading.Lock()
+        # Последняя известная ревизия totals.revision: если она ушла вперёд
+        # без наших записей, базу менял другой процесс и кэши надо сбросить
+        self._revision = None
+        self._revision_lock = threading.Lock()
+        # Сколько update_id записано этим процессом; меняется под _writes
+        self._processed = 0
+
+    @property
+    def manager(self) -> db.ConnectionManager:
+        return self._manager or db.manager
+
+    def _fetchone(self, sql, params=()):
+        return self.manager.connection().execute(sql, params).fetchone()
+
+    def _fetchall(self, sql, params=()):
+        return self.manager.connection().execute(sql, params).fetchall()
+
+    # Страница по ключу: (строки, есть ли предыдущая, есть ли следующая).
+    # Берём на одну строку больше, чтобы узнать о следующей странице без COUNT
+    def _page(self, sql, sql_before, cursor, backward, limit):
+        if backward:
+            rows = self._fetchall(sql_before, (cursor, limit + 1))
+            has_more = len(rows) > limit
+            return rows[:limit][::-1], has_more, True
+        rows = self._fetchall(sql, (FIRST_PAGE if cursor is None else cursor, limit + 1))
+        return rows[:limit], cursor is not None, len(rows) > limit
+
+    def _execute(self, sql, params=()):
+        with self.manager.transaction() as conn:
+            conn.execute(sql, params)
+
+    def _invalidate_total(self):
+        with self._total_lock:
+            self._total = None
+            self._total_generation += 1
+
+    # Ревизия в базе только растёт; меньше известной она бывает, пока наша
+    # же транзакция ещё не видна читателю
+    def _sync_revision(self, revision):
+        with self._revision_lock:
+            if self._revision is not None and revision <= self._revision:
+                return
+            self._revision = revision
+        self.user_cache.clear()
+        self._invalidate_total()
+
+    # data_version меняется от любого чужого соединения, в том числе соседних
+    # потоков этого процесса; их записи уже в кэше, поэтому сбрасываем его,
+    # только если ревизия в базе не совпадает с известной нам
+    def _check_external(self):
+        if self.manager.changed_externally():
+            self._sync_revision(self._fetchone(SELECT_REVISION)[0])
+
+    # Пишущая транзакция по savings. Запись в кэш идёт после COMMIT, но под
+    # общим замком, чтобы состояния попадали в кэш в порядке коммитов;
+    # в states обработчик кладёт user_id -> UserState (или None, если строки нет)
+    @contextmanager
+    def _write(self):
+        states = {}
+        with self._writes:
+            committing = False
+            try:
+                with self.manager.transaction() as conn:
+                    self._sync_revision(conn.execute(SELECT_REVISION).fetchone()[0])
+                    yield conn, states
+                    # Ревизию запоминаем до COMMIT: читатель, увидевший наш
+                    # коммит раньше, чем мы обновили кэш, не сочтёт его чужим
+                    with self._revision_lock:
+                        self._revision = conn.execute(SELECT_REVISION).fetchone()[0]
+                    committing = True
+            except BaseException:
+                # После отката база и кэш прежние; если же не прошёл сам COMMIT,
+                # ревизия неизвестна, и при следующей сверке кэши сбросятся
+                if committing:
+                    with self._revision_lock:
+                        self._revision = None
+                raise
+            for user_id, state in states.items():
+                if state is None:
+                    self.user_cache.invalidate(user_id)
+                else:
+                    self.user_cache.put(user_id, state)
+        self._invalidate_total()
+
+    def _update_state(self, conn, username, sql, params):
+        row = conn.execute(sql, params).fetchone()
+        return UserState(username, row[0], row[1]) if row else None
+
+    # Запись в журнал идёт в той же транзакции, что и изменение savings
+    def _journal(self, conn, user_id, account, amount, ref_id=None):
+        entry_id = conn.execute(INSERT_JOURNAL, (user_id, account, amount, ref_id, now())).lastrowid
+        if entry_id % SNAPSHOT_INTERVAL == 0:
+            self._snapshot(conn, entry_id)
+
+    # Первая запись транзакции с движением денег: повтор того же обновления
+    # откатывает транзакцию целиком, ничего не изменив
+    def _claim_update(self, conn, update_id):
+        if update_id is None:
+            return
+        if not conn.execute(INSERT_PROCESSED_UPDATE, (update_id, now())).rowcount:
+            raise DuplicateUpdate(update_id)
+        self._processed += 1
+        if self._processed % PRUNE_INTERVAL == 0:
+            self._prune_updates(conn, PROCESSED_UPDATES_TTL)
+
+    def _prune_updates(self, conn, ttl):
+        cutoff = (datetime.now() - timedelta(seconds=ttl)).strftime('%Y-%m-%d %H:%M:%S')
+        return conn.execute(DELETE_PROCESSED_UPDATES_BEFORE, (cutoff,)).rowcount
+
+    def prune_processed_updates(self, ttl: int = PROCESSED_UPDATES_TTL) -> int:
+        with self.manager.transaction() as conn:
+            return self._prune_updates(conn, ttl)
+
+    def _snapshot(self, conn, upto):
+        since = conn.execute(SELECT_LAST_SNAPSHOT_RUN).fetchone()[0]
+        if upto <= since:
+            return since
+        conn.execute(INSERT_SNAPSHOTS, {'since': since, 'upto': upto})
+        conn.execute(INSERT_SNAPSHOT_RUN, (upto, now()))
+        return upto
+
+    def init_schema(self) -> None:
+        migrations.migrate(self.manager.connection())
+
+    # Пользователи
+    def add_user(self, user_id: int, username: Optional[str],
+                 first_name: Optional[str], last_name: Optional[str]) -> None:
+        if self.user_cache.get(user_id) is not None or self._fetchone(SELECT_USER_EXISTS, (user_id,)):
+            return
+        with self._write() as (conn, states):
+            if conn.execute(INSERT_USER, (user_id, username, first_name, last_name, now())).rowcount:
+                conn.execute(INSERT_SAVINGS, (user_id, username))
+                states[user_id] = UserState(username, 0, 0)
+
+    def get_user_state(self, user_id: int) -> Optional[UserState]:
+        self._check_external()
+        state = self.user_cache.get(user_id)
+        if state is not None:
+            return state
+        generation = self.user_cache.generation
+        row = self._fetchone(SELECT_USER_STATE, (user_id,))
+        if row is None:
+            return None
+        state = UserState(*row)
+        self.user_cache.fill(user_id, state, generation)
+        return state
+
+    def get_username(self, user_id: int) -> Optional[str]:
+        state = self.get_user_state(user_id)
+        return state.username if state else None
+
+    # Пользователи вместе с балансом; cursor — id крайней строки соседней страницы
+    def users_page(self, cursor: Optional[int] = None, backward: bool = False,
+                   limit: int = PAGE_SIZE) -> Tuple[List[Tuple[int, str, str, str, str, int]], bool, bool]:
+        return self._page(SELECT_USERS_PAGE, SELECT_USERS_PAGE_BEFORE, cursor, backward, limit)
+
+    # Копилки; без строки в savings (не было /start) — UnknownUser
+    def _known_state(self, user_id: int) -> UserState:
+        state = self.get_user_state(user_id)
+        if state is None:
+            raise UnknownUser(user_id)
+        return state
+
+    def get_balance(self, user_id: int) -> int:
+        return self._known_state(user_id).balance
+
+    def get_savings(self, user_id: int) -> Tuple[int, int]:
+        state = self._known_state(user_id)
+        return state.balance, state.monthly_contribution
+
+    def get_monthly_contribution(self, user_id: int) -> int:
+        return self._known_state(user_id).monthly_contribution
+
+    def get_total_balance(self) -> int:
+        self._check_external()
+        total = self._total
+        if total is not None:
+            return total
+        generation = self._total_generation
+        total = self._fetchone(SELECT_TOTAL_BALANCE)[0]
+        with self._total_lock:
+            if generation == self._total_generation:
+                self._total = total
+        return total
+
+    # Пересчитывает итог по savings и сравнивает с хранимым: (хранимый, фактический)
+    def check_total_balance(self) -> Tuple[int, int]:
+        with self.manager.transaction(immediate=False) as conn:
+            stored = conn.execute(SELECT_TOTAL_BALANCE).fetchone()[0]
+            actual = conn.execute(SELECT_SUM_BALANCE).fetchone()[0]
+        return stored, actual
+
+    def repair_total_balance(self) -> int:
+        with self._write() as (conn, states):
+            actual = conn.execute(SELECT_SUM_BALANCE).fetchone()[0]
+            conn.execute(UPDATE_TOTAL_BALANCE, (actual,))
+        return actual
+
+    # Методы записи возвращают новый баланс, чтобы ответ не перечитывал его
+    def set_balance(self, user_id: int, balance: int) -> int:
+        username = self.get_username(user_id)
+        with self._write() as (conn, states):
+            old = conn.execute(SELECT_USER_STATE, (user_id,)).fetchone()
+            if old is None:
+                raise UnknownUser(user_id)
+            state = states[user_id] = self._update_state(conn, username, UPDATE_BALANCE_SET, (balance, user_id))
+            if state.balance != old[1]:
+                self._journal(conn, user_id, 'adjustment', state.balance - old[1])
+        return state.balance
+
+    def set_monthly_contribution(self, user_id: int, amount: int) -> None:
+        username = self.get_username(user_id)
+        with self._write() as (conn, states):
+            state = states[user_id] = self._update_state(conn, username, UPDATE_MONTHLY_CONTRIBUTION, (amount, user_id))
+            if state is None:
+                raise UnknownUser(user_id)
+
+    # Взносы
+    # update_id — обновление Telegram, из которого пришёл взнос; повтор
+    # того же обновления поднимает DuplicateUpdate. Без строки в savings
+    # (не было /start) — UnknownUser, и транзакция откатывается целиком
+    def add_contribution(self, user_id: int, amount: int, month_year: str,
+                         update_id: Optional[int] = None) -> int:
+        username = self.get_username(user_id)
+        with self._write() as (conn, states):
+            self._claim_update(conn, update_id)
+            state = states[user_id] = self._update_state(conn, username, UPDATE_BALANCE_ADD, (amount, user_id))
+            if state is None:
+                raise UnknownUser(user_id)
+            contribution_id = conn.execute(INSERT_CONTRIBUTION, (user_id, username, amount, month_year, now())).lastrowid
+            self._journal(conn, user_id, 'cash', amount, contribution_id)
+        return state.balance
+
+    def recent_contributions(self, user_id: int, limit: int = 10) -> List[Tuple[int, str, str]]:
+        return self._fetchall(SELECT_RECENT_CONTRIBUTIONS, (user_id, limit))
+
+    # (period, сумма, число взносов) за последние limit месяцев с взносами
+    def user_monthly_totals(self, user_id: int, limit: int = 12) -> List[Tuple[int, int, int]]:
+        return self._fetchall(SELECT_USER_MONTHS, (user_id, limit))
+
+    # (period, сумма, число внёсших) по всей копилке
+    def monthly_totals(self, limit: int = 12) -> List[Tuple[int, int, int]]:
+        return self._fetchall(SELECT_MONTHLY_TOTALS, (limit,))
+
+    # Кто и сколько внёс за период, страницами по user_id
+    def period_payers(self, period: int, cursor: int = FIRST_PAGE, limit: int = PAGE_SIZE) -> List[Tuple[int, int]]:
+        return self._fetchall(SELECT_PERIOD_PAYERS, (period, cursor, limit))
+
+    # Долги
+    def active_debts(self, user_id: int) -> List[Tuple[int, str, str]]:
+        return self._fetchall(SELECT_ACTIVE_DEBTS, (user_id,))
+
+    # Займ из копилки: проверка общего баланса, запись долга и списание идут
+    # одной транзакцией, поэтому два одновременных займа не уведут копилку
+    # в минус. Возвращает новый баланс пользователя
+    def borrow(self, user_id: int, amount: int, due_date: str, update_id: Optional[int] = None) -> int:
+        return db.retry_on_busy(self._borrow, user_id, amount, due_date, update_id)
+
+    # Возврат по долгу со сроком 'ДД.ММ'; долг закрывается, если вернули всё
+    def repay(self, user_id: int, amount: int, due_date: str, update_id: Optional[int] = None) -> int:
+        return db.retry_on_busy(self._repay, user_id, amount, due_date, update_id)
+
+    def _borrow(self, user_id, amount, due_date, update_id):
+        username = self.get_username(user_id)
+        with self._write() as (conn, states):
+            self._claim_update(conn, update_id)
+            params = {'user_id': user_id, 'amount': amount}
+            state = states[user_id] = self._update_state(conn, username, UPDATE_BALANCE_BORROW, params)
+            if state is None:
+                if conn.execute(SELECT_USER_STATE, (user_id,)).fetchone() is None:
+                    raise UnknownUser(user_id)
+                raise InsufficientFunds(conn.execute(SELECT_TOTAL_BALANCE).fetchone()[0])
+            debt_id = conn.execute(INSERT_DEBT, (user_id, username, amount, due_date, now())).lastrowid
+            self._journal(conn, user_id, 'loan', -amount, debt_id)
+        return state.balance
+
+    def _repay(self, user_id, amount, due_date, update_id):
+        username = self.get_username(user_id)
+        with self._write() as (conn, states):
+            self._claim_update(conn, update_id)
+            day, month = due_date.split('.')
+            params = {'user_id': user_id, 'amount': amount, 'month_day': f'{month}-{day}'}
+            repaid = conn.execute(UPDATE_DEBT_REPAY, params).fetchone()
+            if repaid is None:
+                debt = conn.execute(SELECT_ACTIVE_DEBT_BY_DATE, (user_id, params['month_day'])).fetchone()
+                if debt is None:
+                    raise DebtNotFound()
+                raise ReturnExceedsDebt(debt[1])
+            state = states[user_id] = self._update_state(conn, username, UPDATE_BALANCE_ADD, (amount, user_id))
+            self._journal(conn, user_id, 'loan', amount, repaid[0])
+        return state.balance
+
+    def active_debts_page(self, cursor: Optional[int] = None, backward: bool = False,
+                          limit: int = PAGE_SIZE) -> Tuple[List[Tuple[int, int, str, str, int, str]], bool, bool]:
+        return self._page(SELECT_ACTIVE_DEBTS_PAGE, SELECT_ACTIVE_DEBTS_PAGE_BEFORE, cursor, backward, limit)
+
+    def debt_exists(self, debt_id: int) -> bool:
+        return self._fetchone(SELECT_DEBT_EXISTS, (debt_id,)) is not None
+
+    def close_debt(self, debt_id: int) -> None:
+        self._execute(UPDATE_DEBT_RETURNED, (debt_id,))
+
+    def set_debt_amount(self, debt_id: int, amount: int) -> None:
+        self._execute(UPDATE_DEBT_AMOUNT_SET, (amount, debt_id))
+
+    def set_debt_due_date(self, debt_id: int, due_date: str) -> None:
+        self._execute(UPDATE_DEBT_DUE_DATE, (due_date, debt_id))
+
+    # Журнал
+    def take_snapshot(self, upto: Optional[int] = None) -> int:
+        with self.manager.transaction() as conn:
+            if upto is None:
+                upto = conn.execute(SELECT_LAST_ENTRY).fetchone()[0]
+            return self._snapshot(conn, upto)
+
+    # Баланс пользователя после записи entry_id (или на момент at, 'ГГГГ-ММ-ДД ЧЧ:ММ:СС'):
+    # ближайший снимок не позже этой записи плюс записи пользователя после него
+    def balance_at(self, user_id: int, entry_id: Optional[int] = None, at: Optional[str] = None) -> int:
+        with self.manager.transaction(immediate=False) as conn:
+            if at is not None:
+                entry_id = conn.execute(SELECT_ENTRY_AT, (at,)).fetchone()[0]
+            elif entry_id is None:
+                entry_id = conn.execute(SELECT_LAST_ENTRY).fetchone()[0]
+            snapshot = conn.execute(SELECT_SNAPSHOT_BEFORE, (user_id, entry_id)).fetchone()
+            since, balance = snapshot or (0, 0)
+            return balance + conn.execute(SELECT_JOURNAL_SUM, (user_id, since, entry_id)).fetchone()[0]
+
+    # Полная сверка журнала: сколько пользователей и снимков не сходятся
+    # и насколько сумма журнала расходится с общим итогом
+    def verify_journal(self) -> dict:
+        with self.manager.transaction(immediate=False) as conn:
+            return {
+                'balances': conn.execute(SELECT_JOURNAL_BALANCE_MISMATCHES).fetchone()[0],
+                'snapshots': conn.execute(SELECT_SNAPSHOT_MISMATCHES).fetchone()[0],
+                'total': conn.execute(SELECT_TOTAL_BALANCE).fetchone()[0]
+                         - conn.execute(SELECT_JOURNAL_TOTAL).fetchone()[0],
+            }
+
+    # Роли: версия roles_revision и все (user_id, роль) одним читающим снимком
+    def roles(self) -> Tuple[int, List[Tuple[int, str]]]:
+        with self.manager.transaction(immediate=False) as conn:
+            return conn.execute(SELECT_ROLES_REVISION).fetchone()[0], conn.execute(SELECT_ROLES).fetchall()
+
+    def roles_revision(self) -> int:
+        return self._fetchone(SELECT_ROLES_REVISION)[0]
+
+    # True, если роли у пользователя ещё не было
+    def grant_role(self, user_id: int, role: str, granted_by: Optional[int] = None) -> bool:
+        with self.manager.transaction() as conn:
+            return conn.execute(INSERT_ROLE, (user_id, role, granted_by, now())).rowcount > 0
+
+    # True, если роль снята; keep_last не даёт снять последнего её обладателя
+    def revoke_role(self, user_id: int, role: str, keep_last: bool = False) -> bool:
+        with self.manager.transaction() as conn:
+            if keep_last:
+                return conn.execute(DELETE_ROLE_KEEP_LAST, {'user_id': user_id, 'role': role}).rowcount > 0
+            return conn.execute(DELETE_ROLE, (user_id, role)).rowcount > 0
+
+    # Копилку группы без администраторов занимают user_ids — администраторы
+    # группы в Telegram; False, если администраторы у неё уже есть
+    def claim_group(self, user_ids: List[int]) -> bool:
+        with self.manager.transaction() as conn:
+            if conn.execute(SELECT_ANY_ADMIN).fetchone():
+                return False
+            granted_at = now()
+            conn.executemany(INSERT_ROLE, [(user_id, 'admin', None, granted_at) for user_id in user_ids])
+        return True
+
+    # Напоминания
+    def contribution_reminders(self, period: str, cursor: int = FIRST_PAGE,
+                               limit: int = 100) -> List[Tuple[int, int]]:
+        return self._fetchall(SELECT_CONTRIBUTION_REMINDERS, {'period': period, 'cursor': cursor, 'limit': limit})
+
+    # Сроки — 'ГГГГ-ММ-ДД'; cursor — (срок, debt_id) последней строки предыдущей страницы
+    def debts_due(self, start: str, end: str, cursor: Optional[Tuple[str, int]] = None,
+                  limit: int = 100) -> List[Tuple[int, int, int, str]]:
+        after_date, after_id = cursor or (start, 0)
+        return self._fetchall(SELECT_DEBTS_DUE, {'end': end, 'after_date': after_date,
+                                                 'after_id': after_id, 'limit': limit})
+
+    # Срок раньше today
+    def overdue_debts(self, today: str, cursor: Optional[Tuple[str, int]] = None,
+                      limit: int = 100) -> List[Tuple[int, int, int, str]]:
+        return self.debts_due('', today, cursor, limit)
+
+    # Срок от today до today + days включительно
+    def upcoming_debts(self, today: str, days: int, cursor: Optional[Tuple[str, int]] = None,
+                       limit: int = 100) -> List[Tuple[int, int, int, str]]:
+        end = (date.fromisoformat(today) + timedelta(days=days + 1)).isoformat()
+        return self.debts_due(today, end, cursor, limit)
+
+    # Отмечает напоминания отправленными до отправки и возвращает те, что
+    # удалось отметить: их ещё не отправлял ни этот, ни соседний процесс
+    def claim_reminders(self, kind: str, period: str, ref_ids: List[int]) -> List[int]:
+        claimed = []
+        with self.manager.transaction() as conn:
+            for ref_id in ref_ids:
+                if conn.execute(INSERT_REMINDER, (kind, period, ref_id, now())).rowcount:
+                    claimed.append(ref_id)
+        return claimed
+
+    # Снимает отметку, если отправить не удалось: следующий проход повторит
+    def release_reminders(self, kind: str, period: str, ref_ids: List[int]) -> None:
+        with self.manager.transaction() as conn:
+            conn.executemany(DELETE_REMINDER, ((kind, period, ref_id) for ref_id in ref_ids))
@@ -0,0 +1,79 @@
+import asyncio
+import os
+import sqlite3
+import threading
+
+from db import run_in_db
+
+
+ADMIN = 'admin'
+# Как часто воркер сверяет версию ролей с базой, в секундах: за это время
+# до него доходят роли, выданные соседним воркером или maintenance.py
+ROLES_REFRESH = float(os.environ.get('ROLES_REFRESH', 5))
+
+NOBODY = frozenset()
+
+
+class RoleStore:
+    # Роли одной копилки в памяти: неизменяемый снимок {роль: frozenset(user_id)}
+    # вместе с версией roles_revision, с которой он прочитан. Проверка права —
+    # поиск во frozenset без обращения к базе. refresh перечитывает роли,
+    # только если версия в базе ушла вперёд; снимок заменяется целиком, поэтому
+    # обработчики на цикле событий читают его без блокировок
+    def __init__(self, repo):
+        self.repo = repo
+        self._snapshot = (None, {})
+        self._lock = threading.Lock()
+
+    @property
+    def revision(self):
+        return self._snapshot[0]
+
+    def members(self, role=ADMIN):
+        return self._snapshot[1].get(role, NOBODY)
+
+    def has(self, user_id, role=ADMIN):
+        return user_id in self._snapshot[1].get(role, NOBODY)
+
+    # Дальше — в потоке базы (run_in_db)
+    def refresh(self):
+        if self.repo.roles_revision() != self._snapshot[0]:
+            self.reload()
+        return self
+
+    def reload(self):
+        revision, rows = self.repo.roles()
+        members = {}
+        for user_id, role in rows:
+            members.setdefault(role, set()).add(user_id)
+        snapshot = (revision, {role: frozenset(user_ids) for role, user_ids in members.items()})
+        with self._lock:
+            # Два потока могли перечитать роли одновременно: остаётся более свежий снимок
+            if self._snapshot[0] is None or revision >= self._snapshot[0]:
+                self._snapshot = snapshot
+        return self
+
+    def grant(self, user_id, role=ADMIN, granted_by=None):
+        granted = self.repo.grant_role(user_id, role, granted_by)
+        self.reload()
+        return granted
+
+    def revoke(self, user_id, role=ADMIN, keep_last=False):
+        revoked = self.repo.revoke_role(user_id, role, keep_last)
+        self.reload()
+        return revoked
+
+    def claim(self, user_ids):
+        claimed = self.repo.claim_group(user_ids)
+        self.reload()
+        return claimed
+
+
+# Фоновая сверка ролей: refresh() выполняется в потоке базы раз в interval секунд
+async def watch(refresh, interval=ROLES_REFRESH):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await run_in_db(refresh)
+        except sqlite3.Error as e:
+            print(f"Ошибка обновления ролей: {e}")
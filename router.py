@@ -0,0 +1,62 @@
+def normalize(text):
+    return text.strip().lower()
+
+
+class Route:
+    __slots__ = ('prefix', 'handler', 'admin', 'requires')
+
+    def __init__(self, prefix, handler, admin=False, requires=None):
+        self.prefix = prefix
+        self.handler = handler
+        self.admin = admin
+        self.requires = requires
+
+
+class Router:
+    # Маршрутизация текстовых сообщений: кнопки ищутся точным совпадением
+    # в словаре, текстовые команды — по первому слову. Стоимость разбора
+    # O(длины текста) и не зависит от количества зарегистрированных команд.
+    def __init__(self, is_admin):
+        self.is_admin = is_admin
+        self.fallback = None
+        self._buttons = {}
+        self._commands = {}
+
+    def button(self, label, handler, admin=False):
+        self._buttons[normalize(label)] = Route(normalize(label), handler, admin)
+
+    # prefix может состоять из нескольких слов ('установить взнос');
+    # requires — слово, без которого команда не считается распознанной
+    def command(self, prefix, handler, admin=False, requires=None):
+        route = Route(normalize(prefix), handler, admin, requires)
+        routes = self._commands.setdefault(route.prefix.split()[0], [])
+        routes.append(route)
+        routes.sort(key=lambda r: len(r.prefix), reverse=True)
+
+    # group_id — копилка, в которой проверяются права администратора
+    def resolve(self, text, user_id, group_id=0):
+        text = normalize(text)
+        route = self._buttons.get(text)
+        if route is not None:
+            return route.handler if self._allowed(route, user_id, group_id) else None
+
+        first_word = text.split(maxsplit=1)[0] if text else ''
+        for route in self._commands.get(first_word, ()):
+            if not text.startswith(route.prefix):
+                continue
+            if route.requires and route.requires not in text:
+                continue
+            if self._allowed(route, user_id, group_id):
+                return route.handler
+        return None
+
+    # fallback=False — нераспознанный текст остаётся без ответа
+    async def dispatch(self, update, context, group_id=0, fallback=True):
+        handler = self.resolve(update.message.text, update.effective_user.id, group_id)
+        if handler is None and fallback:
+            handler = self.fallback
+        if handler is not None:
+            await handler(update, context)
+
+    def _allowed(self, route, user_id, group_id):
+        return not route.admin or self.is_admin(user_id, group_id)
@@ -0,0 +1,104 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+# Модули бота лежат в корне репозитория, без пакета
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    return str(tmp_path / 'savings_bot.db')
+
+
+@pytest.fixture
+def repo(db_path):
+    import db
+    from repository import SavingsRepository
+
+    repo = SavingsRepository(db.ConnectionManager(db_path))
+    repo.init_schema()
+    yield repo
+    repo.manager.close_all()
+
+
+# Бот целиком на временной базе: основная копилка, каталог групп и
+# подмена Telegram, которая запоминает ответы
+@pytest.fixture
+def bot(db_path, tmp_path, monkeypatch):
+    import db
+    import main
+    from groups import GroupRouter
+    from repository import SavingsRepository
+
+    monkeypatch.setattr(db, 'manager', db.ConnectionManager(db_path))
+    monkeypatch.setattr(main, 'repo', SavingsRepository())
+    monkeypatch.setattr(main, 'groups', GroupRouter(str(tmp_path / 'groups')))
+    monkeypatch.setattr(main, 'admin_lookups', {})
+    main.init_db()
+    yield main
+    main.groups.close_all()
+    db.manager.close_all()
+
+
+@pytest.fixture
+def fake():
+    from fake_bot_api import RecordingBot
+
+    return RecordingBot()
+
+
+# Новое приложение — как после перезапуска процесса: окно update_id в памяти пустое
+@pytest.fixture
+def build(bot, fake):
+    def build(concurrent_updates=8):
+        application = bot.build_application('123:fake', concurrent_updates=concurrent_updates, reminders=False,
+                                            send_rate=0, chat_rate=0, throttling=False)
+        application.bot_data['outbox'].bot = fake
+        return application
+    return build
+
+
+# Первый подходящий обработчик, в области аренды копилок групп, как в
+# LeasingUpdateProcessor
+async def dispatch(application, update):
+    from telegram.ext import CallbackContext
+
+    from main import leased_groups
+
+    async with leased_groups():
+        for handler in application.handlers[0]:
+            check = handler.check_update(update)
+            if check is None or check is False:
+                continue
+            context = CallbackContext.from_update(update, application)
+            await handler.handle_update(update, application, check, context)
+            return True
+    return False
+
+
+# Прогоняет обновления (словари Bot API) через обработчики, не больше
+# concurrency одновременно, и дожидается отправки ответов. Исключения
+# обработчиков не глотаются
+@pytest.fixture
+def send(fake):
+    def send(application, updates, concurrency=1):
+        from telegram import Update
+
+        async def run():
+            semaphore = asyncio.Semaphore(concurrency)
+
+            async def process(update):
+                async with semaphore:
+                    return await dispatch(application, Update.de_json(update, fake))
+
+            try:
+                return await asyncio.gather(*map(process, updates))
+            finally:
+                await application.bot_data['outbox'].stop()
+
+        handled = asyncio.run(run())
+        assert all(handled), [update for update, ok in zip(updates, handled) if not ok]
+    return send
@@ -0,0 +1,68 @@
+import argparse
+import sqlite3
+
+import pytest
+
+import archive
+import db
+import maintenance
+
+
+# База, созданная до auto_vacuum: таблицы появились раньше настроек соединения
+def legacy_db(path):
+    conn = sqlite3.connect(path)
+    conn.execute('CREATE TABLE legacy (data BLOB)')
+    conn.commit()
+    conn.close()
+
+
+# Свободные страницы в файле, как после переноса строк в архив
+def free_pages(manager):
+    with manager.transaction() as conn:
+        conn.execute('CREATE TABLE filler (data BLOB)')
+        conn.executemany('INSERT INTO filler VALUES (?)', [(b'x' * 4000,) for _ in range(200)])
+    with manager.transaction() as conn:
+        conn.execute('DROP TABLE filler')
+    return manager.connection().execute('PRAGMA freelist_count').fetchone()[0]
+
+
+@pytest.fixture
+def manager(db_path, monkeypatch):
+    monkeypatch.setattr(db, 'manager', db.ConnectionManager(db_path))
+    yield db.manager
+    db.manager.close_all()
+
+
+def run_archive(**options):
+    args = dict(days=archive.ARCHIVE_HORIZON_DAYS, vacuum=True, reindex=False, convert_vacuum=False)
+    args.update(options)
+    return maintenance.archive_data(argparse.Namespace(**args))
+
+
+def test_new_database_vacuums_incrementally(manager):
+    maintenance.repo.init_schema()
+    assert free_pages(manager) > 0
+    assert run_archive() == 0
+    assert archive.is_incremental(manager)
+    assert manager.connection().execute('PRAGMA freelist_count').fetchone()[0] == 0
+
+
+# Старая база без --convert-vacuum не переписывается целиком: VACUUM не
+# идёт, свободные страницы остаются внутри файла
+def test_legacy_database_is_not_converted_by_default(db_path, manager, capsys):
+    legacy_db(db_path)
+    maintenance.repo.init_schema()
+    free = free_pages(manager)
+    assert run_archive() == 0
+    assert not archive.is_incremental(manager)
+    assert manager.connection().execute('PRAGMA freelist_count').fetchone()[0] == free
+    assert '--convert-vacuum' in capsys.readouterr().out
+
+
+def test_legacy_database_converted_on_request(db_path, manager):
+    legacy_db(db_path)
+    maintenance.repo.init_schema()
+    free_pages(manager)
+    assert run_archive(convert_vacuum=True) == 0
+    assert archive.is_incremental(manager)
+    assert manager.connection().execute('PRAGMA freelist_count').fetchone()[0] == 0
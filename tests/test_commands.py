@@ -0,0 +1,80 @@
+import random
+
+import pytest
+
+from commands import ParseError, parse
+
+
+SAMPLES = (
+    ('вношу 3000 за 07.2023', 'contribute', {'amount': 300000, 'period': (7, 2023)}),
+    ('установить взнос 3000', 'set_monthly', {'amount': 300000}),
+    ('беру 500 до 15.07', 'borrow', {'amount': 50000, 'due_date': (15, 7)}),
+    ('возвращаю 500 за 15.07', 'return', {'amount': 50000, 'due_date': (15, 7)}),
+    ('баланс 123456789 5000', 'set_balance', {'amount': 500000, 'target_id': 123456789}),
+    ('взнос 123456789 3000', 'set_contribution', {'amount': 300000, 'target_id': 123456789}),
+    ('закрыть 1', 'close_debt', {'debt_id': 1}),
+    ('долг 1 1500', 'set_debt_amount', {'amount': 150000, 'debt_id': 1}),
+    ('дата 1 30.12', 'set_debt_date', {'due_date': (30, 12), 'debt_id': 1}),
+    ('/balance 1 -20.5', 'set_balance', {'amount': -2050, 'target_id': 1}),
+)
+FUZZ_TOKENS = (
+    'вношу', 'беру', 'возвращаю', 'установить', 'взнос', 'баланс', 'закрыть', 'долг', 'дата',
+    'за', 'до', '', '0', '-1', '1e9', 'nan', 'inf', '3000', '3,5', '07.2023', '13.2023',
+    '15.07', '32.01', '1.1.1', '.', '..', '99999999999999999999', '١٢٣', '@bot', '/dolg',
+)
+
+
+@pytest.mark.parametrize('text, action, fields', SAMPLES)
+def test_parse_samples(text, action, fields):
+    command = parse(text)
+    assert command.action == action
+    for name, value in fields.items():
+        assert getattr(command, name) == value
+
+
+@pytest.mark.parametrize('text', ['', 'вношу nan за 07.2023', 'вношу 3000 за 13.2023', 'беру 5 до 32.01',
+                                  'баланс abc 1'])
+def test_parse_rejects(text):
+    with pytest.raises(ParseError):
+        parse(text)
+
+
+# Испорченный образец или набор случайных токенов
+def fuzz_text(rng):
+    if rng.random() < 0.5:
+        tokens = rng.choice(SAMPLES)[0].split()
+        for _ in range(rng.randint(1, 3)):
+            position = rng.randrange(len(tokens) + 1)
+            action = rng.random()
+            if action < 0.4 and tokens:
+                tokens[min(position, len(tokens) - 1)] = rng.choice(FUZZ_TOKENS)
+            elif action < 0.7:
+                tokens.insert(position, rng.choice(FUZZ_TOKENS))
+            elif tokens:
+                del tokens[min(position, len(tokens) - 1)]
+    else:
+        tokens = [rng.choice(FUZZ_TOKENS) for _ in range(rng.randint(0, 5))]
+    text = ' '.join(tokens)
+    if rng.random() < 0.2:
+        text = ''.join(ch for ch in text if rng.random() > 0.1)
+    return text
+
+
+# Любой текст либо разбирается в команду с допустимыми полями, либо
+# отклоняется ParseError — других исключений разбор не поднимает
+def test_parse_fuzz():
+    rng = random.Random(1)
+    for _ in range(50_000):
+        text = fuzz_text(rng)
+        try:
+            command = parse(text)
+        except ParseError:
+            continue
+        if command.amount is not None:
+            assert command.amount == command.amount and abs(command.amount) < 10 ** 14, text
+        if command.period is not None:
+            month, year = command.period
+            assert 1 <= month <= 12 and year >= 2020, text
+        if command.due_date is not None:
+            day, month = command.due_date
+            assert 1 <= day <= 31 and 1 <= month <= 12, text
@@ -0,0 +1,154 @@
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from fake_bot_api import make_update
+from groups import GroupRouter
+
+
+GROUPS = [-1000 - i for i in range(8)]
+USERS = range(1, 6)
+
+
+def group_update(update_id, user_id, text, group_id=-1001):
+    update = make_update(update_id, user_id, text)
+    update['message']['chat'] = {'id': group_id, 'type': 'group', 'title': 'Группа'}
+    return update
+
+
+# Открытыми остаются последние limit групп, вытесненная открывается заново со своими данными
+def test_eviction_keeps_limit(tmp_path):
+    router = GroupRouter(str(tmp_path), limit=4)
+    try:
+        for group_id in range(1, 31):
+            router.open(-group_id).add_user(1, 'user1', 'Тест', None)
+            router.get(-1)
+        assert router.stats() == {'open': 4, 'leased': 0, 'limit': 4, 'evictions': 26}
+        assert router.get(-2) is None
+        assert router.open(-2).get_username(1) == 'user1'
+    finally:
+        router.close_all()
+
+
+@pytest.mark.skipif(not os.path.isdir('/proc/self/fd'), reason='нужен /proc')
+def test_eviction_bounds_descriptors(tmp_path):
+    router = GroupRouter(str(tmp_path), limit=4)
+    fds = lambda: len(os.listdir('/proc/self/fd'))
+    try:
+        for group_id in range(1, 11):
+            router.open(-group_id).add_user(1, 'user1', 'Тест', None)
+        before = fds()
+        for group_id in range(11, 101):
+            router.open(-group_id).add_user(1, 'user1', 'Тест', None)
+        assert fds() <= before
+    finally:
+        router.close_all()
+
+
+# Арендованную копилку вытеснение не закрывает, а закрывает последний release
+def test_leased_group_is_not_closed(tmp_path):
+    router = GroupRouter(str(tmp_path), limit=1)
+    try:
+        first = router.acquire(-1)
+        second = router.acquire(-2)
+        assert router.stats()['open'] == 2 and router.evictions == 0
+        first.add_user(1, 'user1', 'Тест', None)
+        router.release(first)
+        assert router.get(-1) is None and router.evictions == 1
+        assert first.manager._connections == []
+        assert router.lease(-2) is second
+        router.release(second, second)
+        assert router.stats() == {'open': 1, 'leased': 0, 'limit': 1, 'evictions': 1}
+    finally:
+        router.close_all()
+
+
+# Потоки базы работают с восемью группами при лимите 2: вытеснение не
+# закрывает соединения, которыми пользуется соседний поток, и ни один взнос
+# не теряется
+def test_eviction_under_concurrent_use(tmp_path):
+    router = GroupRouter(str(tmp_path), limit=2)
+    for group_id in GROUPS:
+        group = router.open(group_id)
+        for user_id in USERS:
+            group.add_user(user_id, f'user{user_id}', 'Тест', None)
+    paid = {group_id: 0 for group_id in GROUPS}
+    paid_lock = threading.Lock()
+
+    def work(seed):
+        rng = random.Random(seed)
+        for _ in range(1000):
+            group_id = rng.choice(GROUPS)
+            action = rng.random()
+            if action < 0.05:
+                router.refresh_roles()
+            elif action < 0.1:
+                router.claim(group_id, [seed + 1])
+            else:
+                group = router.acquire(group_id)
+                try:
+                    if action < 0.5:
+                        group.add_contribution(rng.choice(USERS), 100, '07.2023')
+                        with paid_lock:
+                            paid[group_id] += 100
+                    else:
+                        group.get_savings(rng.choice(USERS))
+                        group.get_total_balance()
+                finally:
+                    router.release(group)
+
+    try:
+        with ThreadPoolExecutor(4) as pool:
+            list(pool.map(work, range(4)))
+        stats = router.stats()
+        assert stats['leased'] == 0 and stats['open'] <= 2 and stats['evictions'] > 0, stats
+        for group_id in GROUPS:
+            group = router.open(group_id)
+            assert group.get_total_balance() == paid[group_id]
+            assert not any(group.verify_journal().values())
+    finally:
+        router.close_all()
+
+
+# Копилку новой группы занимают её администраторы в Telegram, а не тот,
+# кто раньше нажал /start; если Telegram никого не отдал — добавивший бота
+def test_group_admins_seeded_from_telegram(bot, fake, build, send):
+    seeded, added = -1001, -1002
+    fake.chat_admins[seeded] = [7, 8]
+    updates = [group_update(i, user_id, text, seeded)
+               for i, (user_id, text) in enumerate([(5, '/start'), (5, '👥 Список пользователей'), (7, '/start'),
+                                                    (7, '👥 Список пользователей')], 1)]
+    bot_user = {'id': 1, 'is_bot': True, 'first_name': 'Копилка'}
+    updates.append({'update_id': 10, 'my_chat_member': {
+        'chat': {'id': added, 'type': 'group', 'title': 'Группа'},
+        'from': {'id': 9, 'is_bot': False, 'first_name': 'Тест'}, 'date': int(time.time()),
+        'old_chat_member': {'status': 'left', 'user': bot_user},
+        'new_chat_member': {'status': 'member', 'user': bot_user},
+    }})
+    send(build(), updates)
+    assert bot.groups.admins(seeded) == {7, 8}
+    assert bot.groups.admins(added) == {9}
+    assert [chat_id for chat_id, text, _ in fake.sent if text.startswith('👥')] == [seeded]
+    assert bot.groups.stats()['leased'] == 0
+
+
+# Участник группы без /start заводится в её файле при первой команде
+def test_group_member_registered_on_first_command(bot, fake, build, send):
+    texts = ('👀 Мой баланс', '💸 Мои взносы', 'вношу 100 за 07.2024', 'установить взнос 300', 'вношу 100 за 07.2024')
+    send(build(), [group_update(i, 6, text) for i, text in enumerate(texts, 20)])
+    group = bot.groups.get(-1001)
+    assert group.get_savings(6) == (20000, 30000)
+    assert not any(group.verify_journal().values())
+
+
+# Обычная переписка в группе: бот молчит и не заводит копилку отправителю
+def test_group_chatter_is_ignored(bot, fake, build, send):
+    send(build(), [group_update(1, 6, 'привет всем'), group_update(2, 6, 'кто сегодня платит?')])
+    assert fake.sent == []
+    group = bot.groups.get(-1001)
+    assert group.get_user_state(6) is None
+    assert group.get_total_balance() == 0
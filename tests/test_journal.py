@@ -0,0 +1,64 @@
+import random
+
+import repository
+
+
+def seed_journal(conn, entries, users):
+    # Журнал генерируется внутри SQLite: суммы со знаком, время растёт вместе с номером
+    conn.execute('BEGIN')
+    conn.execute('''
+    INSERT INTO journal (user_id, account, amount, created_at)
+    WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < :entries)
+    SELECT i % :users, 'cash', (i * 7919) % 20001 - 10000,
+           printf('2024-%02d-%02d %02d:00:00', 1 + i * 12 / (:entries + 1), 1 + i % 28, i % 24)
+    FROM n
+    ''', {'entries': entries, 'users': users})
+    conn.execute('''
+    UPDATE savings SET balance = (SELECT COALESCE(SUM(amount), 0) FROM journal j WHERE j.user_id = savings.user_id)
+    ''')
+    conn.execute('UPDATE totals SET balance = (SELECT COALESCE(SUM(balance), 0) FROM savings) WHERE id = 1')
+    conn.execute('COMMIT')
+
+
+def test_operations_are_journaled(repo):
+    repo.add_user(1, 'user1', 'Тест', None)
+    repo.add_user(2, 'user2', 'Тест', None)
+    repo.add_contribution(1, 10000, '07.2024')
+    repo.borrow(2, 3000, '2024-07-15')
+    repo.repay(2, 1000, '15.07')
+    repo.set_balance(1, 12000)
+    assert repo.balance_at(1) == 12000
+    assert repo.balance_at(2) == -2000
+    assert repo.verify_journal() == {'balances': 0, 'snapshots': 0, 'total': 0}
+
+
+# Баланс на любую запись через ближайший снимок совпадает с суммой всех
+# записей пользователя с начала журнала
+def test_balance_at_replays_from_snapshots(repo):
+    users, entries, interval = 50, 5000, 700
+    for user_id in range(users):
+        repo.add_user(user_id, f'user{user_id}', 'Тест', None)
+    conn = repo.manager.connection()
+    seed_journal(conn, entries, users)
+    for upto in range(interval, entries + 1, interval):
+        repo.take_snapshot(upto)
+    assert conn.execute('SELECT COUNT(*) FROM balance_snapshots').fetchone()[0] > 0
+    assert repo.verify_journal() == {'balances': 0, 'snapshots': 0, 'total': 0}
+
+    rng = random.Random(1)
+    for _ in range(500):
+        user_id, entry_id = rng.randrange(users), rng.randint(1, entries)
+        full = conn.execute(repository.SELECT_JOURNAL_SUM, (user_id, 0, entry_id)).fetchone()[0]
+        assert repo.balance_at(user_id, entry_id) == full, (user_id, entry_id)
+
+
+# Баланс, изменённый в обход журнала, сверка находит
+def test_verify_journal_finds_untracked_change(repo):
+    repo.add_user(1, 'user1', 'Тест', None)
+    repo.add_contribution(1, 10000, '07.2024')
+    repo.take_snapshot()
+    with repo.manager.transaction() as conn:
+        conn.execute('UPDATE savings SET balance = balance + 1 WHERE user_id = 1')
+    problems = repo.verify_journal()
+    assert problems['balances'] == 1
+    assert problems['total'] == 1
@@ -0,0 +1,169 @@
+import random
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import db
+import repository
+from repository import (DebtNotFound, InsufficientFunds, LedgerError, ReturnExceedsDebt, SavingsRepository,
+                        UnknownUser)
+
+
+def count_rows(path, table):
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+    finally:
+        conn.close()
+
+
+# Всё, что оставляет после себя движение денег
+MONEY_TABLES = ('contributions', 'contribution_rollups', 'debts', 'journal', 'processed_updates')
+
+
+def money_rows(path):
+    return {table: count_rows(path, table) for table in MONEY_TABLES}
+
+
+def test_borrow_and_repay(repo):
+    repo.add_user(1, 'user1', 'Тест', None)
+    repo.add_user(2, 'user2', 'Тест', None)
+    repo.add_contribution(1, 10000, '07.2024')
+    assert repo.borrow(2, 4000, '2024-07-15') == -4000
+    assert repo.get_total_balance() == 6000
+    assert repo.repay(2, 1000, '15.07') == -3000
+    assert repo.repay(2, 3000, '15.07') == 0
+    assert repo.active_debts(2) == []
+    assert repo.get_total_balance() == 10000
+
+
+def test_borrow_more_than_pot(repo):
+    repo.add_user(1, 'user1', 'Тест', None)
+    repo.add_contribution(1, 10000, '07.2024')
+    with pytest.raises(InsufficientFunds) as error:
+        repo.borrow(1, 10001, '2024-07-15')
+    assert error.value.available == 10000
+    assert repo.get_balance(1) == 10000
+
+
+def test_repay_errors(repo):
+    repo.add_user(1, 'user1', 'Тест', None)
+    repo.add_contribution(1, 10000, '07.2024')
+    repo.borrow(1, 5000, '2024-07-15')
+    with pytest.raises(DebtNotFound):
+        repo.repay(1, 1000, '16.07')
+    with pytest.raises(ReturnExceedsDebt) as error:
+        repo.repay(1, 6000, '15.07')
+    assert error.value.debt_amount == 5000
+    assert repo.get_balance(1) == 5000
+
+
+# Взнос без строки в savings (не было /start): отказ и ни одной строки в
+# базе, в том числе update_id — иначе повтор после /start сочли бы дублем
+def test_unknown_user_contribution_leaves_nothing(repo, db_path):
+    repo.add_user(1, 'user1', 'Тест', None)
+    repo.add_contribution(1, 10000, '07.2024')
+    before = money_rows(db_path)
+    with pytest.raises(UnknownUser):
+        repo.add_contribution(2, 10000, '07.2024', 1)
+    assert money_rows(db_path) == before
+    assert repo.get_total_balance() == 10000
+
+    repo.add_user(2, 'user2', 'Тест', None)
+    assert repo.add_contribution(2, 10000, '07.2024', 1) == 10000
+
+
+def test_unknown_user_reads_and_setters(repo):
+    with pytest.raises(UnknownUser):
+        repo.get_savings(1)
+    with pytest.raises(UnknownUser):
+        repo.set_balance(1, 100)
+    with pytest.raises(UnknownUser):
+        repo.set_monthly_contribution(1, 100)
+    with pytest.raises(UnknownUser):
+        repo.borrow(1, 100, '2024-07-15')
+
+
+# Строка в users без строки в savings — такой же неизвестный пользователь,
+# как во взносе, а не нехватка денег в копилке
+def test_borrow_without_savings_row(repo, db_path):
+    repo.add_user(1, 'user1', 'Тест', None)
+    repo.add_contribution(1, 10000, '07.2024')
+    repo.add_user(2, 'user2', 'Тест', None)
+    with repo.manager.transaction(immediate=True) as conn:
+        conn.execute('DELETE FROM savings WHERE user_id = 2')
+    repo.user_cache.clear()
+    before = money_rows(db_path)
+    with pytest.raises(UnknownUser):
+        repo.borrow(2, 100, '2024-07-15', 1)
+    assert money_rows(db_path) == before
+
+
+# Без /start в личном чате бот просит нажать /start и ничего не пишет в базу
+def test_unknown_user_handlers(bot, fake, build, send, db_path):
+    from fake_bot_api import make_update
+
+    texts = ('👀 Мой баланс', '💸 Мои взносы', 'вношу 100 за 07.2024', 'установить взнос 300', 'вношу 100 за 07.2024')
+    updates = [make_update(i, 5, text) for i, text in enumerate(texts, 1)]
+    updates.append(make_update(10, min(bot.ADMINS), 'баланс 5 1000'))
+    before = money_rows(db_path)
+    send(build(), updates)
+    assert [text for _, text, _ in fake.sent] == ['Сначала нажмите /start'] * len(texts) + ['❌ Пользователь 5 не найден']
+    assert money_rows(db_path) == before
+
+
+# Займы и возвраты из нескольких потоков и нескольких менеджеров
+# соединений (как из соседних процессов): итог сходится с savings и с
+# суммой операций, копилка не уходит в минус, журнал сходится
+def test_concurrent_ledger_invariants(db_path):
+    users, pot, threads, operations = 20, 200_000, 8, 200
+    seed = SavingsRepository(db.ConnectionManager(db_path))
+    seed.init_schema()
+    for user_id in range(users):
+        seed.add_user(user_id, f'user{user_id}', 'Тест', None)
+    seed.add_contribution(0, pot, '07.2024')
+    seed.manager.close_all()
+
+    repos = [SavingsRepository(db.ConnectionManager(db_path)) for _ in range(3)]
+    lock = threading.Lock()
+    totals = {'borrowed': 0, 'returned': 0}
+
+    def worker(seed):
+        rng = random.Random(seed)
+        repo = repos[seed % len(repos)]
+        borrowed = returned = 0
+        for _ in range(operations):
+            user_id = rng.randrange(users)
+            day = rng.randint(1, 3)
+            amount = rng.choice((1000, 5000, 10000))
+            try:
+                if rng.random() < 0.6:
+                    repo.borrow(user_id, amount, f'2024-07-{day:02d}')
+                    borrowed += amount
+                else:
+                    repo.repay(user_id, amount, f'{day:02d}.07')
+                    returned += amount
+            except LedgerError:
+                pass
+        with lock:
+            totals['borrowed'] += borrowed
+            totals['returned'] += returned
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(worker, range(threads)))
+
+    conn = sqlite3.connect(db_path)
+    stored = conn.execute(repository.SELECT_TOTAL_BALANCE).fetchone()[0]
+    actual = conn.execute(repository.SELECT_SUM_BALANCE).fetchone()[0]
+    bad_debts = conn.execute('SELECT COUNT(*) FROM debts WHERE amount <= 0').fetchone()[0]
+    conn.close()
+    assert totals['borrowed'] > 0
+    assert stored == actual
+    assert actual == pot - totals['borrowed'] + totals['returned']
+    assert actual >= 0
+    assert bad_debts == 0
+    assert repos[0].verify_journal() == {'balances': 0, 'snapshots': 0, 'total': 0}
+    for repo in repos:
+        repo.manager.close_all()
@@ -0,0 +1,97 @@
+import sqlite3
+
+import pytest
+
+import repository
+from cache import RecentIds
+from fake_bot_api import make_update
+from metrics import metrics
+
+
+USERS = range(1, 6)
+
+
+# Всё, что меняет движение денег: повтор обновлений не должен это сдвинуть
+def ledger_state(path):
+    conn = sqlite3.connect(path)
+    try:
+        return {
+            'total': conn.execute(repository.SELECT_TOTAL_BALANCE).fetchone()[0],
+            'balances': conn.execute(repository.SELECT_SUM_BALANCE).fetchone()[0],
+            'contributions': conn.execute('SELECT COUNT(*) FROM contributions').fetchone()[0],
+            'debts': conn.execute('SELECT COUNT(*), COALESCE(SUM(amount), 0) FROM debts').fetchone(),
+            'journal': conn.execute('SELECT COUNT(*) FROM journal').fetchone()[0],
+            'processed': conn.execute('SELECT COUNT(*) FROM processed_updates').fetchone()[0],
+        }
+    finally:
+        conn.close()
+
+
+def duplicates(source):
+    return metrics.counters.get(('bot_duplicate_updates_total', (('source', source),)), 0)
+
+
+# Взносы, займы и возвраты пользователей USERS с update_id от 100
+def money_updates():
+    texts = []
+    for user_id in USERS:
+        texts += [(user_id, 'вношу 100 за 07.2024'), (user_id, 'беру 30 до 15.07'), (user_id, 'возвращаю 10 за 15.07')]
+    return [make_update(update_id, user_id, text) for update_id, (user_id, text) in enumerate(texts, 100)]
+
+
+@pytest.fixture
+def registered(build, send):
+    send(build(), [make_update(user_id, user_id, '/start') for user_id in USERS])
+
+
+def test_replay_moves_money_once(registered, build, send, fake, db_path):
+    updates = money_updates()
+    application = build()
+    send(application, updates)
+    state = ledger_state(db_path)
+    assert state['processed'] == len(updates)
+    assert state['contributions'] == len(USERS)
+    replies = len(fake.sent)
+
+    memory, stored = duplicates('memory'), duplicates('db')
+    send(application, updates)
+    assert ledger_state(db_path) == state
+    assert duplicates('memory') - memory == len(updates)
+
+    # Новый процесс: окно в памяти пустое, повторы видит только processed_updates
+    send(build(), updates)
+    assert ledger_state(db_path) == state
+    assert duplicates('db') - stored == len(updates)
+    assert len(fake.sent) == replies
+
+
+# Каждое обновление дважды и конкурентно: копии гонятся друг с другом,
+# деньги двигаются один раз. Займ может обогнать взносы, а возврат — займ:
+# такие обновления отклоняются и update_id не занимают
+def test_concurrent_copies_move_money_once(registered, bot, build, send, db_path):
+    updates = money_updates()
+    send(build(), [update for update in updates for _ in range(2)], concurrency=8)
+    state = ledger_state(db_path)
+    assert state['contributions'] == len(USERS)
+    assert state['debts'][0] <= len(USERS)
+    assert state['journal'] == state['processed'] <= len(updates)
+    assert state['total'] == state['balances']
+    assert bot.repo.verify_journal() == {'balances': 0, 'snapshots': 0, 'total': 0}
+    assert bot.repo.prune_processed_updates(-1) == state['processed']
+    assert ledger_state(db_path)['processed'] == 0
+
+
+def test_duplicate_update_id_is_rejected(repo):
+    repo.add_user(1, 'user1', 'Тест', None)
+    repo.add_contribution(1, 10000, '07.2024', 7)
+    with pytest.raises(repository.DuplicateUpdate):
+        repo.borrow(1, 100, '2024-07-15', 7)
+    assert repo.get_balance(1) == 10000
+
+
+def test_recent_ids_window():
+    window = RecentIds(3)
+    for update_id in (1, 2, 3, 4):
+        window.add(update_id)
+    assert not window.seen(1)
+    assert all(window.seen(update_id) for update_id in (2, 3, 4))
@@ -0,0 +1,175 @@
+import contextvars
+import functools
+import os
+import time
+
+from groups import group_of
+from metrics import metrics
+from outbox import TokenBucket
+
+
+# Защиту от флуда можно выключить целиком: THROTTLE=0
+THROTTLE = os.environ.get('THROTTLE', '1') == '1'
+# Все обновления одного пользователя: жетонов в секунду и запас на всплеск
+THROTTLE_RATE = float(os.environ.get('THROTTLE_RATE', 1))
+THROTTLE_BURST = int(os.environ.get('THROTTLE_BURST', 5))
+# Одна и та же команда одного пользователя
+THROTTLE_COMMAND_RATE = float(os.environ.get('THROTTLE_COMMAND_RATE', 0.5))
+THROTTLE_COMMAND_BURST = int(os.environ.get('THROTTLE_COMMAND_BURST', 3))
+# Сколько секунд читающая команда отвечает прежним текстом без обращения к базе
+RESPONSE_CACHE_TTL = float(os.environ.get('RESPONSE_CACHE_TTL', 3))
+# Как часто забывать полные корзины и истёкшие ответы
+SWEEP_INTERVAL = 60
+
+# Ответы обработчика, который сейчас кэшируется: reply() складывает сюда (текст, kwargs)
+captured_replies = contextvars.ContextVar('captured_replies', default=None)
+
+
+class Throttle:
+    # Жетоны по пользователю и по (пользователь, команда) плюс кэш ответов
+    # читающих команд по (копилка, пользователь). Корзина, которая успела
+    # наполниться, ничем не отличается от новой, поэтому при чистке полные
+    # корзины просто удаляются — в памяти остаются только те, кто активен
+    # последние секунды. Работает на цикле событий, поэтому без блокировок
+    def __init__(self, rate=THROTTLE_RATE, burst=THROTTLE_BURST, command_rate=THROTTLE_COMMAND_RATE,
+                 command_burst=THROTTLE_COMMAND_BURST, ttl=RESPONSE_CACHE_TTL):
+        self.rate = rate
+        self.burst = burst
+        self.command_rate = command_rate
+        self.command_burst = command_burst
+        self.ttl = ttl
+        self._users = {}
+        self._commands = {}
+        # (копилка, пользователь) -> {команда: (истекает, [(текст, kwargs)])}
+        self._responses = {}
+        # Кого уже предупредили о флуде с последнего пропущенного обновления
+        self._warned = set()
+        self._swept_at = time.monotonic()
+        self.rejected = 0
+        self.hits = 0
+
+    # Жетон пользователя; False — обновление отбрасывается
+    def allow_user(self, user_id, now):
+        self._sweep(now)
+        bucket = self._users.get(user_id)
+        if bucket is None:
+            bucket = self._users[user_id] = TokenBucket(self.rate, self.burst)
+        if bucket.delay(now):
+            self.rejected += 1
+            return False
+        bucket.take(now)
+        return True
+
+    def allow_command(self, user_id, command, now):
+        bucket = self._commands.get((user_id, command))
+        if bucket is None:
+            bucket = self._commands[(user_id, command)] = TokenBucket(self.command_rate, self.command_burst)
+        if bucket.delay(now):
+            self.rejected += 1
+            return False
+        bucket.take(now)
+        return True
+
+    # Предупреждать один раз на серию отброшенных обновлений
+    def warn(self, user_id):
+        if user_id in self._warned:
+            return False
+        self._warned.add(user_id)
+        return True
+
+    def passed(self, user_id):
+        self._warned.discard(user_id)
+
+    def cached(self, key, command, now):
+        entry = self._responses.get(key, {}).get(command)
+        if entry is None or entry[0] <= now:
+            return None
+        self.hits += 1
+        return entry[1]
+
+    def store(self, key, command, replies, now):
+        if self.ttl > 0:
+            self._responses.setdefault(key, {})[command] = (now + self.ttl, replies)
+
+    # Пользователь что-то изменил: его прежние ответы в этой копилке устарели
+    def invalidate(self, key):
+        self._responses.pop(key, None)
+
+    def _sweep(self, now):
+        if now - self._swept_at < SWEEP_INTERVAL:
+            return
+        self._swept_at = now
+        for buckets in (self._users, self._commands):
+            for key in [key for key, bucket in buckets.items() if bucket.full(now)]:
+                del buckets[key]
+        for key, entries in list(self._responses.items()):
+            for command in [command for command, (expires, _) in entries.items() if expires <= now]:
+                del entries[command]
+            if not entries:
+                del self._responses[key]
+        self._warned.intersection_update(self._users)
+
+    def stats(self):
+        return {
+            'users': len(self._users),
+            'commands': len(self._commands),
+            'responses': sum(map(len, self._responses.values())),
+            'rejected': self.rejected,
+            'hits': self.hits,
+        }
+
+
+async def reject(update, context, throttle):
+    if update.callback_query is not None:
+        await update.callback_query.answer("⏳ Слишком часто, подождите немного")
+    elif throttle.warn(update.effective_user.id):
+        context.bot_data['outbox'].send(update.effective_chat.id, "⏳ Слишком часто, подождите немного")
+
+
+# Обёртка обработчика перед базой: жетон пользователя, затем для читающих
+# команд (cache=True) — ответ из кэша, и только потом жетон команды и
+# сам обработчик. Любая другая команда сбрасывает кэш ответов пользователя,
+# чтобы после взноса «Мой баланс» не показал старую сумму
+def throttled(cache=False):
+    def decorate(handler):
+        command = handler.__name__
+
+        @functools.wraps(handler)
+        async def wrapper(update, context):
+            throttle = context.bot_data.get('throttle')
+            user = update.effective_user
+            if throttle is None or user is None:
+                return await handler(update, context)
+            now = time.monotonic()
+            if not throttle.allow_user(user.id, now):
+                metrics.inc('bot_throttled_total', (('handler', command), ('limit', 'user')))
+                await reject(update, context, throttle)
+                return None
+            key = (group_of(update.effective_chat), user.id)
+            if cache:
+                replies = throttle.cached(key, command, now)
+                if replies is not None:
+                    metrics.inc('bot_response_cache_hits_total', (('handler', command),))
+                    throttle.passed(user.id)
+                    for text, kwargs in replies:
+                        context.bot_data['outbox'].send(update.effective_chat.id, text, **kwargs)
+                    return None
+            else:
+                throttle.invalidate(key)
+            if not throttle.allow_command(user.id, command, now):
+                metrics.inc('bot_throttled_total', (('handler', command), ('limit', 'command')))
+                await reject(update, context, throttle)
+                return None
+            throttle.passed(user.id)
+            if not cache:
+                return await handler(update, context)
+            replies = []
+            token = captured_replies.set(replies)
+            try:
+                result = await handler(update, context)
+            finally:
+                captured_replies.reset(token)
+            throttle.store(key, command, replies, time.monotonic())
+            return result
+        return wrapper
+    return decorate
@@ -0,0 +1,96 @@
+import asyncio
+import os
+import threading
+
+from flask import Flask, abort, request
+from telegram import Update
+
+
+WEBHOOK_PATH = os.environ.get('WEBHOOK_PATH', '/webhook')
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET', '')
+
+
+class ApplicationRunner:
+    # Application PTB со своим циклом событий в фоновом потоке; Flask только
+    # кладёт входящие обновления в очередь и сразу отвечает Telegram
+    def __init__(self, application):
+        self.application = application
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        self._call(self._startup())
+
+    def stop(self):
+        self._call(self._shutdown())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+
+    def submit(self, data):
+        update = Update.de_json(data, self.application.bot)
+        asyncio.run_coroutine_threadsafe(self.application.update_queue.put(update), self.loop)
+
+    def _call(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    # post_init, post_stop и post_shutdown PTB вызывает только из
+    # run_polling/run_webhook, здесь их приходится вызывать самим
+    async def _startup(self):
+        await self.application.initialize()
+        if self.application.post_init:
+            await self.application.post_init(self.application)
+        await self.application.start()
+
+    async def _shutdown(self):
+        await self.application.stop()
+        if self.application.post_stop:
+            await self.application.post_stop(self.application)
+        await self.application.shutdown()
+        if self.application.post_shutdown:
+            await self.application.post_shutdown(self.application)
+
+
+def create_app(build_application=None):
+    flask_app = Flask(__name__)
+    state = {'runner': None}
+    lock = threading.Lock()
+
+    # Приложение бота создаётся при первом запросе, то есть уже в воркере
+    # gunicorn после fork, а не в мастер-процессе
+    def get_runner():
+        runner = state['runner']
+        if runner is None:
+            with lock:
+                runner = state['runner']
+                if runner is None:
+                    if build_application is not None:
+                        application = build_application()
+                    else:
+                        import main as bot
+                        application = bot.build_application(os.environ['BOT_TOKEN'])
+                    runner = ApplicationRunner(application)
+                    runner.start()
+                    state['runner'] = runner
+        return runner
+
+    @flask_app.post(WEBHOOK_PATH)
+    def receive_update():
+        if WEBHOOK_SECRET and request.headers.get('X-Telegram-Bot-Api-Secret-Token') != WEBHOOK_SECRET:
+            abort(403)
+        data = request.get_json(force=True, silent=True)
+        if not data:
+            abort(400)
+        get_runner().submit(data)
+        return ''
+
+    @flask_app.get('/health')
+    def health():
+        return 'ok'
+
+    flask_app.extensions['bot_runner'] = state
+    return flask_app
+
+
+# Точка входа для gunicorn: gunicorn -c gunicorn.conf.py webhook:app
+app = create_app()